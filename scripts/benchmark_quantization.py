@@ -0,0 +1,256 @@
+import os
+import json
+import argparse
+import logging
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from config import get_config, get_batch_config, VALID_CONFIGS
+from preprocessing import expression_statistics, select_genes, process_expression_compendium
+from process_data import load_tsv_files
+from storage import read_expression_matrix, read_expression_tsv, read_sparse_expression, write_quantized_expression
+from storage import PARSERS, default_parser
+
+"""
+Benchmark the quantized storage of the processed compendium against float64 values. The reference is the processed TSV
+or sparse file when it exists, and otherwise the raw compendia processed again, since processing with --quantize
+removes them. Reports file sizes, load times and rounding errors, checks that gene filters select the same genes on
+decoded values, and compares layouts of the decoded matrix to layouts of the original matrix. The report is saved as
+quantization-benchmark.json in the visualization directory, and the script exits with status 1 when the errors, filter
+differences or layout agreement exceed the given thresholds.
+"""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Filter settings checked on the decoded values, as (variance_threshold, minimum_expression)
+FILTER_SETTINGS = [(20, None), (50, None), (None, 1.0), (20, 2.0)]
+
+
+def timed_read(file_path, parser="c"):
+    """
+    Read a processed compendium and time it. TSV files are parsed with the given parser.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids, seconds)
+    """
+    start_time = time.time()
+    matrix, sample_ids, gene_ids = read_expression_matrix(file_path, parser=parser)
+    return matrix, sample_ids, gene_ids, time.time() - start_time
+
+
+def read_reference(config, parser="c", variance_threshold=None, minimum_expression=None):
+    """
+    Read the float64 values quantization is checked against. The processed TSV or sparse file is used when it exists,
+    otherwise the raw compendia are processed with the given filters, ie after process_data.py --quantize removed them.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids, seconds, source) where source is the path the values were read from.
+    """
+    start_time = time.time()
+    if os.path.exists(config.expression_file_path()):
+        source = config.expression_file_path()
+        matrix, sample_ids, gene_ids = read_expression_tsv(source, parser=parser, dtype=np.float64)
+    elif os.path.exists(config.sparse_expression_file_path()):
+        source = config.sparse_expression_file_path()
+        matrix, sample_ids, gene_ids = read_sparse_expression(source, dtype=np.float64)
+        matrix = matrix.toarray()
+    else:
+        source = config.raw_data_dir_path()
+        logging.info(f"No processed TSV or sparse compendium exists, processing the raw compendia in {source}...")
+        expression_dict = load_tsv_files(source, parser=parser)
+        if not expression_dict:
+            raise FileNotFoundError(f"No processed TSV or sparse compendium nor raw compendia in {source} exist.")
+        processed_compendium = process_expression_compendium(expression_dict, variance_threshold, minimum_expression)
+        matrix = processed_compendium.to_numpy(dtype=np.float64)
+        sample_ids, gene_ids = processed_compendium.index, processed_compendium.columns
+    return matrix, sample_ids, gene_ids, time.time() - start_time, source
+
+
+def check_thresholds(report, max_abs_error, max_filter_differences, layout_tolerance):
+    """
+    List the checks of a benchmark report that exceed their threshold. Decoded layouts must share about as many 2D
+    neighbors with the original layout as a fit of the original matrix with another seed does, within layout_tolerance.
+    The Procrustes disparity is only reported, as it varies too much between UMAP seeds to bound.
+
+    Returns:
+        list: Descriptions of the failed checks, empty when every check passes.
+    """
+    failures = []
+    for mode in ("global", "per_gene"):
+        if report[mode]["max_abs_error"] > max_abs_error:
+            failures.append(f"{mode}: max abs error {report[mode]['max_abs_error']:.2e} > {max_abs_error:.2e}")
+        for key, differences in report[mode]["filter_differences"].items():
+            if differences > max_filter_differences:
+                failures.append(f"{mode}: {differences} genes change filter decision with {key}")
+    for name, layout_report in report["layouts"].items():
+        decoded, baseline = layout_report["decoded"], layout_report["seed_baseline"]
+        if decoded["neighbor_overlap"] < baseline["neighbor_overlap"] - layout_tolerance:
+            failures.append(f"{name}: neighbor overlap {decoded['neighbor_overlap']:.3f} is below the seed baseline "
+                            f"{baseline['neighbor_overlap']:.3f} by more than {layout_tolerance}")
+    return failures
+
+
+def compare_filters(matrix, decoded, gene_ids):
+    """
+    Count the genes whose filter decision differs between the original and the decoded matrix.
+    """
+    original_stats = expression_statistics(pd.DataFrame(matrix, columns=gene_ids, copy=False))
+    decoded_stats = expression_statistics(pd.DataFrame(decoded, columns=gene_ids, copy=False))
+    differences = {}
+    for variance_threshold, minimum_expression in FILTER_SETTINGS:
+        original_genes = select_genes(original_stats, variance_threshold, minimum_expression)
+        decoded_genes = select_genes(decoded_stats, variance_threshold, minimum_expression)
+        key = f"variance_threshold={variance_threshold}, minimum_expression={minimum_expression}"
+        differences[key] = len(original_genes.symmetric_difference(decoded_genes))
+    return differences
+
+
+def compare_layouts(matrix, decoded, sample_ids, layouts):
+    """
+    Fit each layout on the original and the decoded matrix and compare the results. UMAP layouts change with any
+    perturbation of the input, including the random seed, so each comparison comes with a baseline comparing two fits of
+    the original matrix with different seeds.
+    """
+    import layout_algorithms
+    from layout_algorithms.landmark_umap import landmark_quality_report
+
+    layout_classes = {"pca": layout_algorithms.MCMPca, "umap": layout_algorithms.MCMUmap}
+    reports = {}
+    for name in layouts:
+        logging.info(f"Comparing {name.upper()} layouts...")
+        layout_kwargs = {"fast_correlation": True} if name == "umap" else {}
+        original_layout = layout_classes[name](**layout_kwargs).fit_transform_array(matrix, sample_ids)
+        decoded_layout = layout_classes[name](**layout_kwargs).fit_transform_array(decoded, sample_ids)
+        reseeded_layout = layout_classes[name](random_state=0, **layout_kwargs).fit_transform_array(matrix, sample_ids)
+        reports[name] = {
+            "decoded": landmark_quality_report(decoded_layout, original_layout),
+            "seed_baseline": landmark_quality_report(reseeded_layout, original_layout),
+        }
+    return reports
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark quantized storage of the processed compendium.")
+    parser.add_argument(
+        "--config",
+        type=str,
+        required=True,
+        help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the results written by run_batch.py, in results/<configuration>, instead of results."
+    )
+    parser.add_argument(
+        "--layouts",
+        type=str,
+        nargs="*",
+        default=["pca", "umap"],
+        choices=["pca", "umap"],
+        help="Layouts to compare on original and decoded values."
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
+    parser.add_argument(
+        "--variance-threshold",
+        type=int,
+        default=20,
+        help="Percentile of low variance genes to remove when the reference is processed from the raw compendia."
+    )
+    parser.add_argument(
+        "--minimum-expression",
+        type=float,
+        default=None,
+        help="Minimum mean log2(TPM+1) expression when the reference is processed from the raw compendia."
+    )
+    parser.add_argument(
+        "--max-abs-error",
+        type=float,
+        default=1e-3,
+        help="Largest allowed absolute rounding error, in log2(TPM+1) units."
+    )
+    parser.add_argument(
+        "--max-filter-differences",
+        type=int,
+        default=0,
+        help="Largest allowed number of genes whose filter decision changes on decoded values."
+    )
+    parser.add_argument(
+        "--layout-tolerance",
+        type=float,
+        default=0.05,
+        help="How far the neighbor overlap of decoded and original layouts may fall below the seed baseline."
+    )
+    args = parser.parse_args()
+
+    config = get_batch_config(args.config) if args.batch else get_config(args.config)
+    if config is None:
+        exit(1)
+    logging.info(f"Using configuration: {args.config}")
+
+    matrix, sample_ids, gene_ids, reference_seconds, reference_path = read_reference(
+        config, parser=args.parser, variance_threshold=args.variance_threshold,
+        minimum_expression=args.minimum_expression)
+    report = {
+        "n_samples": len(sample_ids),
+        "n_genes": len(gene_ids),
+        "reference": {"path": reference_path, "read_seconds": reference_seconds, "parser": args.parser},
+        "float64_bytes": matrix.size * 8,
+    }
+    if reference_path == config.expression_file_path():
+        report["tsv"] = {"bytes": os.path.getsize(reference_path), "read_seconds": reference_seconds,
+                         "parser": args.parser}
+        logging.info(f"TSV: {report['tsv']['bytes'] / 1024 ** 2:.1f} MB, read in {reference_seconds:.2f}s")
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        for mode in ("global", "per_gene"):
+            npz_path = os.path.join(scratch_dir, f"{mode}.npz")
+            write_quantized_expression(npz_path, matrix, sample_ids, gene_ids, per_gene=mode == "per_gene")
+            decoded, _, _, npz_seconds = timed_read(npz_path)
+            errors = np.abs(decoded.astype(np.float64) - matrix)
+            report[mode] = {
+                "bytes": os.path.getsize(npz_path),
+                "read_seconds": npz_seconds,
+                "size_vs_float64": report["float64_bytes"] / os.path.getsize(npz_path),
+                "max_abs_error": float(errors.max(initial=0)),
+                "mean_abs_error": float(errors.mean()),
+                "filter_differences": compare_filters(matrix, decoded, gene_ids),
+            }
+            if "tsv" in report:
+                report[mode]["size_vs_tsv"] = report["tsv"]["bytes"] / report[mode]["bytes"]
+            logging.info(f"{mode}: {report[mode]['bytes'] / 1024 ** 2:.1f} MB "
+                         f"({report[mode]['size_vs_float64']:.1f}x smaller than float64), read in {npz_seconds:.2f}s, "
+                         f"max error {report[mode]['max_abs_error']:.2e}")
+            logging.info(f"{mode}: genes with a different filter decision: {report[mode]['filter_differences']}")
+
+        # Layouts are compared for the coarser global scale only
+        decoded, _, _, _ = timed_read(os.path.join(scratch_dir, "global.npz"))
+    report["layouts"] = compare_layouts(matrix, decoded, sample_ids, args.layouts)
+    for name, layout_report in report["layouts"].items():
+        logging.info(f"{name.upper()} decoded vs original: {layout_report['decoded']}")
+        logging.info(f"{name.upper()} reseeded vs original: {layout_report['seed_baseline']}")
+
+    report["thresholds"] = {"max_abs_error": args.max_abs_error, "max_filter_differences": args.max_filter_differences,
+                            "layout_tolerance": args.layout_tolerance}
+    report["failures"] = check_thresholds(report, args.max_abs_error, args.max_filter_differences,
+                                          args.layout_tolerance)
+
+    os.makedirs(config.get_vis_dir_path(), exist_ok=True)
+    report_path = config.gen_figure_file_path("quantization-benchmark.json")
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    logging.info(f"Benchmark report saved at: {report_path}")
+
+    for failure in report["failures"]:
+        logging.error(f"Threshold exceeded, {failure}")
+    if report["failures"]:
+        exit(1)
+    logging.info("Every check is within its threshold.")
@@ -0,0 +1,56 @@
+import argparse
+import logging
+import time
+from config import get_config, get_batch_config, VALID_CONFIGS
+from similarity import SimilarityIndex
+from storage import read_expression_matrix, PARSERS, default_parser
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the patient similarity index over a processed compendium.")
+    parser.add_argument(
+        "--config",
+        type=str,
+        required=True,
+        help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the results written by run_batch.py, in results/<configuration>, instead of results."
+    )
+    parser.add_argument(
+        "--graph-neighbors",
+        type=int,
+        default=30,
+        help="Degree of the NN-descent graph. Higher values give better recall and slower builds."
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
+    args = parser.parse_args()
+
+    config = get_batch_config(args.config) if args.batch else get_config(args.config)
+    if config is None:
+        exit(1)
+    logging.info(f"Using configuration: {args.config}")
+
+    start_time = time.time()
+    logging.info("Loading expression data...")
+    expression_matrix, sample_ids, gene_ids = read_expression_matrix(config.expression_matrix_file_path(),
+                                                                   parser=args.parser)
+    logging.info(f"Expression data loaded: {expression_matrix.shape[0]} samples, {expression_matrix.shape[1]} genes.")
+
+    # The matrix is not used after the index is built so let it be normalized in place
+    logging.info("Building similarity index...")
+    index = SimilarityIndex.build(expression_matrix, sample_ids, gene_ids, n_neighbors=args.graph_neighbors,
+                                  copy=False)
+    index.save(config.similarity_index_dir_path())
+    logging.info(f"Similarity index saved to {config.similarity_index_dir_path()}. "
+                 f"Time taken: {time.time() - start_time:.2f}s")
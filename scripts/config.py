@@ -18,7 +18,21 @@ class ScriptConfig:
         raw_data_dir (str): The name of the raw data directory.
         processed_dir (str): The name of the processed data directory.
         expression_file (str): The name of the expression data file.
+        quantized_expression_file (str): The name of the quantized expression data file, written instead of the
+            expression data file when processing with quantization.
+        sparse_expression_file (str): The name of the sparse expression data file, written instead of the expression
+            data file when processing with a sparse matrix.
         clinical_file (str): The name of the clinical data file.
+        sample_index_file (str): The name of the file holding the positional index from expression samples to clinical
+            rows, with a fingerprint of the ids it was built from.
+        gene_vocabulary_file (str): The name of the file holding the gene vocabulary, stored beside the raw files.
+        similarity_index_dir (str): The name of the directory holding the patient similarity index.
+        subgroup_dir (str): The name of the directory holding per subgroup layouts inside the visualization directory.
+        layout_file (str): The name of a layout data file.
+        metrics_file (str): The name of a layout quality metrics file, written next to each layout.
+        knn_graph_file (str): The name of the expression space kNN graph file written next to a layout, which lets the
+            next release warm start from it.
+        clinical_columns (list): Clinical columns to load from raw clinical files in addition to the sample id.
         expression_targets (dict): A dictionary for file targets of expression data. Keys should be the file name with
             proper extension and values should be the URL to download the file.
             Example: {"file_expression.tsv": "https://example.com/file_expression.tsv"}
@@ -36,7 +50,17 @@ class ScriptConfig:
     visualization_dir = 'vis'
     figure_file = 'plot.png'
     expression_file = 'processed_compendium.tsv'
+    quantized_expression_file = 'processed_compendium.npz'
+    sparse_expression_file = 'processed_compendium.sparse.npz'
     clinical_file = 'processed_clinical_data.tsv'
+    sample_index_file = 'sample_index.npz'
+    gene_vocabulary_file = 'gene_vocabulary.npz'
+    similarity_index_dir = 'similarity_index'
+    subgroup_dir = 'subgroups'
+    layout_file = 'layout.tsv'
+    metrics_file = 'metrics.json'
+    knn_graph_file = 'knn-graph.npz'
+    clinical_columns = ['disease']
     expression_targets = {}
     clinical_targets = {}
 
@@ -93,6 +117,17 @@ class ScriptConfig:
         return os.path.join(cls.get_vis_dir_path(), file_name)
 
 
+    @classmethod
+    def subgroup_dir_path(cls, group_by: str, group: str):
+        """
+        Get the path to the output directory of one subgroup layout relative to the project root directory.
+
+        Args:
+            group_by (str): The clinical column the subgroups are split by, ie 'disease'.
+            group (str): The directory name of the subgroup.
+        """
+        return os.path.join(cls.get_vis_dir_path(), cls.subgroup_dir, group_by, group)
+
     @classmethod
     def expression_file_path(cls):
         """
@@ -100,6 +135,38 @@ class ScriptConfig:
         """
         return os.path.join(cls.processed_dir_path(), cls.expression_file)
 
+    @classmethod
+    def quantized_expression_file_path(cls):
+        """
+        Get the path to the quantized expression data file relative to the project root directory.
+        """
+        return os.path.join(cls.processed_dir_path(), cls.quantized_expression_file)
+
+    @classmethod
+    def sparse_expression_file_path(cls):
+        """
+        Get the path to the sparse expression data file relative to the project root directory.
+        """
+        return os.path.join(cls.processed_dir_path(), cls.sparse_expression_file)
+
+    @classmethod
+    def processed_expression_file_paths(cls):
+        """
+        Get the paths of every format the processed expression data can be saved in, in the order they are loaded.
+        """
+        return [cls.quantized_expression_file_path(), cls.sparse_expression_file_path(), cls.expression_file_path()]
+
+    @classmethod
+    def expression_matrix_file_path(cls):
+        """
+        Get the path of the processed expression data to load, the quantized or sparse file when it exists and the
+        expression data file otherwise.
+        """
+        for file_path in cls.processed_expression_file_paths()[:-1]:
+            if os.path.exists(file_path):
+                return file_path
+        return cls.expression_file_path()
+
     @classmethod
     def clinical_file_path(cls):
         """
@@ -107,6 +174,27 @@ class ScriptConfig:
         """
         return os.path.join(cls.processed_dir_path(), cls.clinical_file)
 
+    @classmethod
+    def sample_index_file_path(cls):
+        """
+        Get the path to the sample index file relative to the project root directory.
+        """
+        return os.path.join(cls.processed_dir_path(), cls.sample_index_file)
+
+    @classmethod
+    def gene_vocabulary_file_path(cls):
+        """
+        Get the path to the gene vocabulary file relative to the project root directory.
+        """
+        return os.path.join(cls.raw_data_dir_path(), cls.gene_vocabulary_file)
+
+    @classmethod
+    def similarity_index_dir_path(cls):
+        """
+        Get the path to the patient similarity index directory relative to the project root directory.
+        """
+        return os.path.join(cls.processed_dir_path(), cls.similarity_index_dir)
+
     @classmethod
     def get_path_expression_url_targets(cls):
         """
@@ -266,4 +354,23 @@ def get_config(config_name):
         return ProductionConfigWithoutTumorPolyA
     else:
         print(f"Invalid configuration name: {config_name}. Valid configurations are: {', '.join(VALID_CONFIGS)}")
-        return None
\ No newline at end of file
+        return None
+
+
+def get_batch_config(config_name):
+    """
+    Returns the configuration class of get_config with its results in their own directory, results/<config_name>,
+    where run_batch.py writes them. Every configuration shares the results directory, so configurations running together
+    would otherwise overwrite each other's processed files and figures.
+
+    Args:
+        config_name (str): The name of the configuration to use, see get_config.
+
+    Returns:
+        ScriptConfig: A subclass of the configuration class with its own results directory, or None if an invalid
+            configuration name is provided.
+    """
+    config = get_config(config_name)
+    if config is None:
+        return None
+    return type(config.__name__, (config,), {"results_dir": os.path.join(config.results_dir, config_name)})
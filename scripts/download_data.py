@@ -73,6 +73,45 @@ def download_files(file_dict):
         logging.info(f"Downloading {filename} from {url}...")
         download_file(url, file_path)
 
+def link_file(source_path: str, file_path: str):
+    """
+    Make a file available at another path without copying it, with a hard link or a symbolic link when hard links are
+    not possible, ie across filesystems.
+
+    Parameters:
+    source_path (str): The existing file.
+    file_path (str): The path to link to it.
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    try:
+        os.link(source_path, file_path)
+    except OSError:
+        os.symlink(os.path.abspath(source_path), file_path)
+    logging.info(f"Linked {file_path} to {source_path}")
+
+def download_shared_files(file_dict, download=True):
+    """
+    Download every URL once, even when several paths request it, ie the raw directories of configurations sharing a
+    compendium, and link the other paths to the downloaded file. Paths of a URL already downloaded to one of its paths
+    are linked to that file.
+
+    Parameters:
+    file_dict (dict): Keys are file paths and values are URLs.
+    download (bool): Whether URLs missing from all of their paths are downloaded. Default True.
+    """
+    paths_by_url = {}
+    for file_path, url in file_dict.items():
+        paths_by_url.setdefault(url, []).append(file_path)
+
+    for url, file_paths in paths_by_url.items():
+        existing = [file_path for file_path in file_paths if os.path.exists(file_path)]
+        if not existing and download:
+            download_file(url, file_paths[0])
+            existing = [file_path for file_path in file_paths[:1] if os.path.exists(file_path)]
+        for file_path in file_paths:
+            if existing and not os.path.exists(file_path):
+                link_file(existing[0], file_path)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download genomic data files.")
     parser.add_argument(
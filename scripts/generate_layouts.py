@@ -1,15 +1,16 @@
+import json
 import pandas as pd
+from scipy import sparse as sp
 import argparse
-import matplotlib.pyplot as plt
 import os
 import logging
-from layout_algorithms.mcm_umap import MCMUmap
-from config import get_config, VALID_CONFIGS
-from plotting import generate_compendium_plot, generate_disease_plot
-
-# Set the interactive backend for Matplotlib
-import matplotlib
-matplotlib.use('TkAgg')
+import layout_algorithms
+from layout_algorithms.landmark_umap import landmark_quality_report
+from config import get_config, get_batch_config, VALID_CONFIGS
+from preprocessing import align_clinical, load_sample_index
+from metrics import embedding_metrics, write_metrics
+from neighbors import save_knn_graph, load_knn_graph
+from storage import read_expression_matrix, read_tsv, PARSERS, default_parser
 
 # Configure logging
 logging.basicConfig(
@@ -17,8 +18,18 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Layout algorithms selectable with --layout. Keys are used in plot titles and figure file names and values are class
+# names in the layout_algorithms package.
+LAYOUT_ALGORITHMS = {
+    "umap": "MCMUmap",
+    "pca": "MCMPca",
+    "tsne": "MCMTsne",
+}
+# Layouts that work on a sparse compendium without densifying it, when none of the dense only options is used
+SPARSE_LAYOUTS = ("umap", "pca")
+
 if __name__ == '__main__':
-    logging.info("Starting UMAP layout generation process...")
+    logging.info("Starting layout generation process...")
 
     # Command line argument parser to get configuration
     parser = argparse.ArgumentParser(description="Process genomic data files.")
@@ -28,49 +39,210 @@ if __name__ == '__main__':
         required=True,
         help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the results written by run_batch.py, in results/<configuration>, instead of results."
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        default="umap",
+        choices=list(LAYOUT_ALGORITHMS),
+        help="Layout algorithm to use."
+    )
+    parser.add_argument(
+        "--fast-correlation",
+        action="store_true",
+        help="UMAP only. Normalize samples once and use a fast euclidean neighbor search that is equivalent to "
+             "correlation distance."
+    )
+    parser.add_argument(
+        "--knn-workers",
+        type=int,
+        default=None,
+        help="UMAP only. Find exact neighbors with a brute force search sharded across this many worker processes, "
+             "-1 for one per CPU. Default is UMAP's approximate search."
+    )
+    parser.add_argument(
+        "--landmarks",
+        type=int,
+        default=None,
+        help="UMAP only. Fit UMAP on this many landmark samples, stratified by compendium and disease, and place the "
+             "remaining samples afterwards."
+    )
+    parser.add_argument(
+        "--placement",
+        type=str,
+        default="knn",
+        choices=["knn", "transform"],
+        help="How samples that are not landmarks are placed."
+    )
+    parser.add_argument(
+        "--quality-report",
+        action="store_true",
+        help="With --landmarks, also run a full UMAP fit and save a report comparing both layouts."
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="UMAP only. Warm start from the layout and kNN graph saved by the previous run, ie when a compendium "
+             "release adds samples. Previous samples keep their positions and only a short optimization is run."
+    )
+    parser.add_argument(
+        "--incremental-epochs",
+        type=int,
+        default=100,
+        help="Number of optimization epochs of an incremental layout."
+    )
+    parser.add_argument(
+        "--skip-metrics",
+        action="store_true",
+        help="Do not compute the layout quality metrics saved next to the figures."
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
     args = parser.parse_args()
+    if args.layout != "umap":
+        if args.fast_correlation:
+            parser.error("--fast-correlation is only supported with --layout umap")
+        if args.landmarks is not None:
+            parser.error("--landmarks is only supported with --layout umap")
+        if args.knn_workers is not None:
+            parser.error("--knn-workers is only supported with --layout umap")
+        if args.incremental:
+            parser.error("--incremental is only supported with --layout umap")
+    if args.incremental and args.landmarks is not None:
+        parser.error("--incremental and --landmarks cannot be combined")
+    if args.quality_report and args.landmarks is None:
+        parser.error("--quality-report requires --landmarks")
+    if args.landmarks is not None and args.placement == "transform" and args.fast_correlation:
+        parser.error("--placement transform cannot be combined with --fast-correlation")
+    if args.landmarks is not None and args.placement == "transform" and args.knn_workers is not None:
+        parser.error("--placement transform cannot be combined with --knn-workers")
+    layout_name = args.layout.upper()
 
     # Get configuration
-    config = get_config(args.config)
+    config = get_batch_config(args.config) if args.batch else get_config(args.config)
     logging.info(f"Using configuration: {args.config}")
 
-    # Load expression data
+    # Load expression data. File format is (gene, sample). Layout algorithms expect a (sample, gene) matrix.
     logging.info("Loading expression data...")
-    expression_df = pd.read_csv(config.expression_file_path(), sep="\t", index_col=0)
-
-    # File format is (gene, sample). Layout algorithms expect (sample, gene)
-    expression_df = expression_df.T
-    logging.info(f"Expression data loaded: {expression_df.shape[0]} samples, {expression_df.shape[1]} genes.")
-
-    # Initialize layout algorithm
-    layout_algorithm = MCMUmap()
-
-    # Perform layout algorithm
-    logging.info("Performing UMAP dimensionality reduction...")
-    layout_df = layout_algorithm.fit_transform(expression_df)
-    logging.info("UMAP transformation complete.")
-
-    # Load clinical data and merge with expression dataframe
+    keep_sparse = args.layout in SPARSE_LAYOUTS and not (args.fast_correlation or args.knn_workers is not None
+                                                          or args.incremental or args.landmarks is not None)
+    expression_matrix, sample_ids, _ = read_expression_matrix(config.expression_matrix_file_path(),
+                                                           parser=args.parser, sparse=keep_sparse)
+    logging.info(f"Expression data loaded: {expression_matrix.shape[0]} samples, {expression_matrix.shape[1]} genes"
+                 f"{' as a sparse matrix' if sp.issparse(expression_matrix) else ''}.")
+
+    # Load clinical data aligned with the expression samples using the precomputed sample index
     logging.info("Loading clinical data...")
-    clinical_df = pd.read_csv(config.clinical_file_path(), sep="\t", index_col=0)
-    umap_df = layout_df.merge(clinical_df, left_index=True, right_index=True, how='inner')
-    logging.info(f"Clinical data merged: {umap_df.shape[0]} total samples.")
-
-    # Generate UMAP figure using the method defined above
-    logging.info("Generating UMAP plot...")
+    clinical_df = read_tsv(config.clinical_file_path(), parser=args.parser, index_col=0,
+                           dtype={'compendium': 'category', 'disease': 'category'})
+    sample_index = load_sample_index(config.sample_index_file_path(), sample_ids, clinical_df.index)
+    samples_df = align_clinical(pd.DataFrame(index=sample_ids), clinical_df, sample_index)
 
-    disease_fig = generate_disease_plot(umap_df, "UMAP Disease Plot")
-    compendium_fig = generate_compendium_plot(umap_df, "UMAP Compendium Plot")
+    # Initialize layout algorithm
+    layout_kwargs = {}
+    if args.fast_correlation:
+        layout_kwargs["fast_correlation"] = True
+    if args.knn_workers is not None:
+        layout_kwargs["knn_workers"] = args.knn_workers
+    layout_file_path = config.gen_figure_file_path(f"{args.layout}-{config.layout_file}")
+    knn_graph_file_path = config.gen_figure_file_path(f"{args.layout}-{config.knn_graph_file}")
+    if args.incremental:
+        if not os.path.exists(layout_file_path):
+            logging.error(f"No previous layout at {layout_file_path}. Run without --incremental first.")
+            exit(1)
+        previous_layout = read_tsv(layout_file_path, index_col=0)[["x", "y"]]
+        previous_graph = None
+        if os.path.exists(knn_graph_file_path):
+            previous_graph = load_knn_graph(knn_graph_file_path)
+        else:
+            logging.warning(f"No previous kNN graph at {knn_graph_file_path}, the graph is rebuilt.")
+        logging.info(f"Warm starting from the previous layout of {len(previous_layout)} samples...")
+        layout_algorithm = layout_algorithms.MCMIncrementalUmap(previous_layout, previous_graph,
+                                                                n_epochs=args.incremental_epochs, **layout_kwargs)
+    elif args.landmarks is not None:
+        layout_algorithm = layout_algorithms.MCMLandmarkUmap(n_landmarks=args.landmarks, placement=args.placement,
+                                           strata=samples_df[["compendium", "disease"]], **layout_kwargs)
+    else:
+        layout_algorithm = getattr(layout_algorithms, LAYOUT_ALGORITHMS[args.layout])(**layout_kwargs)
+
+    # A full fit for the quality report needs the untouched matrix, otherwise the matrix is not used after the layout
+    # so let the algorithm preprocess it in place
+    logging.info(f"Performing {layout_name} dimensionality reduction...")
+    layout_df = layout_algorithm.fit_transform_array(expression_matrix, sample_ids, copy=args.quality_report)
+    logging.info(f"{layout_name} transformation complete.")
+    if args.incremental:
+        logging.info(f"{len(layout_algorithm.new_samples_)} new samples placed, {len(layout_algorithm.updated_rows_)} "
+                     f"kNN graph rows updated.")
+
+    # Keep the layout of every sample and its kNN graph so the next release can warm start from them
+    os.makedirs(config.get_vis_dir_path(), exist_ok=True)
+    layout_df.join(samples_df).to_csv(layout_file_path, sep="\t")
+    if getattr(layout_algorithm, "knn_dists_", None) is not None:
+        save_knn_graph(knn_graph_file_path, sample_ids, layout_algorithm.knn_indices_, layout_algorithm.knn_dists_)
+
+    if not args.skip_metrics:
+        # Without a copy the neighbor based layouts standardize a dense matrix in place, PCA never modifies it
+        standardized = not args.quality_report and args.layout != "pca" and not sp.issparse(expression_matrix)
+        logging.info(f"Computing {layout_name} quality metrics...")
+        metrics = embedding_metrics(expression_matrix, layout_df, samples_df[["compendium", "disease"]],
+                                    knn_indices=getattr(layout_algorithm, "knn_indices_", None),
+                                    standardize=not standardized)
+        os.makedirs(config.get_vis_dir_path(), exist_ok=True)
+        metrics_path = config.gen_figure_file_path(f"{args.layout}-{config.metrics_file}")
+        write_metrics(metrics_path, metrics, layout_algorithm)
+        logging.info(f"Trustworthiness {metrics['trustworthiness']:.3f}, kNN preservation "
+                     f"{metrics['knn_preservation']:.3f}. Metrics saved at: {metrics_path}")
+
+    if args.quality_report:
+        logging.info(f"Performing full {layout_name} fit for the quality report...")
+        full_layout = layout_algorithms.MCMUmap(**layout_kwargs)
+        full_layout_df = full_layout.fit_transform_array(expression_matrix, sample_ids, copy=False)
+        report = landmark_quality_report(layout_df, full_layout_df)
+        report["n_landmarks"] = len(layout_algorithm.landmarks_)
+        os.makedirs(config.get_vis_dir_path(), exist_ok=True)
+        report_path = config.gen_figure_file_path(f"{args.layout}-landmark-report.json")
+        with open(report_path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        logging.info(f"Landmark quality report saved at: {report_path}")
+    del expression_matrix
+
+    umap_df = align_clinical(layout_df, clinical_df, sample_index)
+    logging.info(f"Clinical data aligned: {umap_df.shape[0]} total samples.")
+
+    # Matplotlib is imported only now so --help and configuration errors do not wait for it. Set the interactive
+    # backend, falling back to saving figures only on headless machines
+    import matplotlib.pyplot as plt
+    try:
+        plt.switch_backend('TkAgg')
+    except ImportError:
+        logging.warning("TkAgg backend is not available, figures will only be saved.")
+        plt.switch_backend('Agg')
+    from plotting import generate_compendium_plot, generate_disease_plot
+
+    # Generate layout figures using the method defined above
+    logging.info(f"Generating {layout_name} plot...")
+
+    disease_fig = generate_disease_plot(umap_df, f"{layout_name} Disease Plot")
+    compendium_fig = generate_compendium_plot(umap_df, f"{layout_name} Compendium Plot")
 
     # Show the figure
     plt.show()
 
     # Save the figure
     os.makedirs(config.get_vis_dir_path(), exist_ok=True)
-    disease_fig_path = config.gen_figure_file_path("umap-disease.png")
+    disease_fig_path = config.gen_figure_file_path(f"{args.layout}-disease.png")
     disease_fig.savefig(disease_fig_path, dpi=300, bbox_inches='tight')
 
-    compendium_fig_path = config.gen_figure_file_path("umap-compendium.png")
+    compendium_fig_path = config.gen_figure_file_path(f"{args.layout}-compendium.png")
     compendium_fig.savefig(compendium_fig_path, dpi=300, bbox_inches='tight')
 
-    logging.info(f"UMAP figure saved at: {disease_fig_path}")
+    logging.info(f"{layout_name} figure saved at: {disease_fig_path}")
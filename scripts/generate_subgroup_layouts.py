@@ -0,0 +1,135 @@
+import pandas as pd
+import argparse
+import os
+import logging
+from layout_algorithms.mcm_umap import MCMUmap
+from metrics import embedding_metrics, write_metrics
+from config import get_config, get_batch_config, VALID_CONFIGS
+from preprocessing import align_clinical, load_sample_index, standardize_matrix
+from storage import read_expression_matrix, read_tsv, PARSERS, default_parser
+from subgroups import split_subgroups, subgroup_dir_names, fit_subgroup_layouts
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+GROUP_BY_COLUMNS = ["disease", "compendium"]
+
+if __name__ == '__main__':
+    logging.info("Starting subgroup UMAP layout generation process...")
+
+    # Command line argument parser to get configuration
+    parser = argparse.ArgumentParser(description="Generate one UMAP layout per clinical subgroup.")
+    parser.add_argument(
+        "--config",
+        type=str,
+        required=True,
+        help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the results written by run_batch.py, in results/<configuration>, instead of results."
+    )
+    parser.add_argument(
+        "--group-by",
+        type=str,
+        default="disease",
+        choices=GROUP_BY_COLUMNS,
+        help="Clinical column to split samples by."
+    )
+    parser.add_argument(
+        "--groups",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only lay out these subgroups, ie --groups neuroblastoma osteosarcoma. Default is every subgroup."
+    )
+    parser.add_argument(
+        "--min-samples",
+        type=int,
+        default=30,
+        help="Skip subgroups with fewer samples."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes. Default is one per CPU."
+    )
+    parser.add_argument(
+        "--skip-metrics",
+        action="store_true",
+        help="Do not compute the layout quality metrics saved next to each subgroup's figures."
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
+    args = parser.parse_args()
+
+    # Get configuration
+    config = get_batch_config(args.config) if args.batch else get_config(args.config)
+    if config is None:
+        exit(1)
+    logging.info(f"Using configuration: {args.config}")
+
+    # Load and standardize expression data once for all subgroups
+    logging.info("Loading expression data...")
+    expression_matrix, sample_ids, _ = read_expression_matrix(config.expression_matrix_file_path(),
+                                                           parser=args.parser)
+    logging.info(f"Expression data loaded: {expression_matrix.shape[0]} samples, {expression_matrix.shape[1]} genes.")
+    expression_matrix = standardize_matrix(expression_matrix, copy=False)
+
+    # Load clinical data aligned with the expression samples
+    logging.info("Loading clinical data...")
+    clinical_df = read_tsv(config.clinical_file_path(), parser=args.parser, index_col=0,
+                           dtype={'compendium': 'category', 'disease': 'category'})
+    sample_index = load_sample_index(config.sample_index_file_path(), sample_ids, clinical_df.index)
+    samples_df = align_clinical(pd.DataFrame(index=sample_ids), clinical_df, sample_index)
+    labels = samples_df[args.group_by].reindex(sample_ids)
+
+    subgroups = split_subgroups(labels, min_samples=args.min_samples, groups=args.groups)
+    if not subgroups:
+        logging.error(f"No subgroups of '{args.group_by}' with at least {args.min_samples} samples were found.")
+        exit(1)
+    logging.info(f"Fitting layouts for {len(subgroups)} subgroups of '{args.group_by}'...")
+
+    layouts = fit_subgroup_layouts(expression_matrix, sample_ids, subgroups, MCMUmap,
+                                   layout_kwargs={"standardize": False}, max_workers=args.workers)
+
+    # Figures are only saved in batch mode so use a non-interactive backend. Matplotlib is imported only now so --help
+    # and configuration errors do not wait for it.
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from plotting import generate_compendium_plot, generate_disease_plot
+
+    # Save a layout and figures for every subgroup, in directories named from every label so names never collide
+    dir_names = subgroup_dir_names(labels.dropna().unique())
+    for group, layout_df in layouts.items():
+        output_dir = config.subgroup_dir_path(args.group_by, dir_names[group])
+        os.makedirs(output_dir, exist_ok=True)
+
+        umap_df = layout_df.join(samples_df[["compendium", "disease"]], how="inner")
+        umap_df.to_csv(os.path.join(output_dir, config.layout_file), sep="\t")
+
+        if not args.skip_metrics:
+            # The layouts were fit on the globally standardized matrix so measure neighbors on the same values
+            positions = sample_ids.get_indexer(layout_df.index)
+            metrics = embedding_metrics(expression_matrix[positions], layout_df, umap_df[["compendium", "disease"]],
+                                        standardize=False)
+            write_metrics(os.path.join(output_dir, config.metrics_file), metrics)
+
+        disease_fig = generate_disease_plot(umap_df, f"UMAP Disease Plot: {group}")
+        disease_fig.savefig(os.path.join(output_dir, "umap-disease.png"), dpi=300, bbox_inches='tight')
+        compendium_fig = generate_compendium_plot(umap_df, f"UMAP Compendium Plot: {group}")
+        compendium_fig.savefig(os.path.join(output_dir, "umap-compendium.png"), dpi=300, bbox_inches='tight')
+        plt.close(disease_fig)
+        plt.close(compendium_fig)
+        logging.info(f"Subgroup '{group}' saved at: {output_dir}")
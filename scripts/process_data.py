@@ -1,16 +1,39 @@
 import os
+import numpy as np
 import pandas as pd
 import argparse
 import time
 from config import get_config, VALID_CONFIGS
 import logging
-from preprocessing import process_expression_compendium
+from preprocessing import process_expression_compendium_sparse
 from preprocessing import process_clinical_compendium
+from preprocessing import build_sample_index, save_sample_index
+from out_of_core import process_expression_files_blockwise, read_header, compendium_statistics, select_compendium_genes
+from storage import write_quantized_expression, write_sparse_expression
+from storage import read_expression_frame, read_tsv, read_tsv_header, PARSERS, default_parser
+from gene_vocabulary import GeneVocabulary, read_gene_aliases, build_coded_compendium
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-def load_tsv_files(directory):
+def list_expression_files(directory):
+    """
+    List the expression TSV files in the given directory. The order matches the order compendia are loaded in by
+    load_tsv_files so blockwise processing concatenates samples the same way.
+
+    Args:
+        directory (str): Path to the directory containing TSV files.
+
+    Returns:
+        list: Paths to expression files.
+    """
+    if not os.path.exists(directory):
+        raise FileNotFoundError(f"Directory '{directory}' does not exist.")
+
+    return [os.path.join(directory, file_name) for file_name in os.listdir(directory)
+            if file_name.endswith("_expression.tsv")]
+
+def load_tsv_files(directory, parser="c"):
     """
     Load all expression TSV files in the given directory into a dictionary of DataFrames. Data is stored in files in
     (gene, sample) format. The DataFrames are transposed to (sample, gene) format when read from file. (Sample, gene)
@@ -18,6 +41,7 @@ def load_tsv_files(directory):
 
     Args:
         directory (str): Path to the directory containing TSV files.
+        parser (str): 'c' or 'pyarrow', see storage.read_tsv. Default 'c'.
 
     Returns:
         dict: Dictionary where keys are file names (without extension) and values are DataFrames. The data frames are in
@@ -25,19 +49,14 @@ def load_tsv_files(directory):
     """
     expression_dict = {}
 
-    if not os.path.exists(directory):
-        raise FileNotFoundError(f"Directory '{directory}' does not exist.")
-
-    for file_name in os.listdir(directory):
-        if file_name.endswith("_expression.tsv"):  # Only load expression files
-            file_path = os.path.join(directory, file_name)
-            try:
-                df = pd.read_csv(file_path, sep="\t", index_col=0)
-                df = df.T  # Transpose so samples are rows and genes are columns
-                expression_dict[os.path.splitext(file_name)[0]] = df
-                logging.info(f"Loaded {file_name} ({df.shape[0]} rows, {df.shape[1]} columns)")
-            except Exception as e:
-                logging.warning(f"Failed to load {file_name}: {e}")
+    for file_path in list_expression_files(directory):
+        file_name = os.path.basename(file_path)
+        try:
+            df = read_expression_frame(file_path, parser=parser)  # Samples are rows and genes are columns
+            expression_dict[os.path.splitext(file_name)[0]] = df
+            logging.info(f"Loaded {file_name} ({df.shape[0]} rows, {df.shape[1]} columns)")
+        except Exception as e:
+            logging.warning(f"Failed to load {file_name}: {e}")
 
     if not expression_dict:
         logging.error("No expression TSV files found in the directory.")
@@ -45,12 +64,15 @@ def load_tsv_files(directory):
 
     return expression_dict
 
-def load_clinical_files(directory):
+def load_clinical_files(directory, columns=None, parser="c"):
     """
     Load all clinical TSV files in the given directory into a dictionary of DataFrames.
 
     Args:
         directory (str): Path to the directory containing clinical TSV files.
+        columns (list): Clinical columns to load in addition to the sample id in the first column. Columns missing from
+            a file are skipped. Default None, load all columns.
+        parser (str): 'c' or 'pyarrow', see storage.read_tsv. Default 'c'.
 
     Returns:
         dict: Dictionary where keys are compendium names and values are DataFrames.
@@ -64,7 +86,11 @@ def load_clinical_files(directory):
         if "clinical" in file_name and file_name.endswith(".tsv"):  # Only load clinical files
             file_path = os.path.join(directory, file_name)
             try:
-                df = pd.read_csv(file_path, sep="\t", index_col=0)
+                usecols = None
+                if columns is not None:
+                    header = read_tsv_header(file_path)
+                    usecols = [header[0]] + [column for column in columns if column in header[1:]]
+                df = read_tsv(file_path, parser=parser, index_col=0, usecols=usecols)
                 compendium_name = os.path.splitext(file_name)[0]  # Use filename as key
                 clinical_dict[compendium_name] = df
                 logging.info(f"Loaded {file_name} ({df.shape[0]} rows, {df.shape[1]} columns)")
@@ -77,6 +103,23 @@ def load_clinical_files(directory):
 
     return clinical_dict
 
+def open_gene_vocabulary(file_path, aliases_path=None):
+    """
+    Load the gene vocabulary saved beside the raw files, or start a new one, and add aliases to it.
+
+    Args:
+        file_path (str): Path of the vocabulary .npz file.
+        aliases_path (str): Path to a TSV file of aliases and their current symbols, see
+            gene_vocabulary.read_gene_aliases. Default None, no new aliases.
+
+    Returns:
+        GeneVocabulary: The vocabulary. Save it after encoding compendia to keep the codes of new genes.
+    """
+    vocabulary = GeneVocabulary.load(file_path) if os.path.exists(file_path) else GeneVocabulary()
+    if aliases_path is not None:
+        vocabulary.add_aliases(read_gene_aliases(aliases_path))
+    return vocabulary
+
 def main():
     """
     Main function to process genomic data files. Reads expression and clinical data files, processes them, merges them
@@ -94,7 +137,69 @@ def main():
         required=True,
         help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
     )
+    parser.add_argument(
+        "--max-memory",
+        type=str,
+        default=None,
+        help="Memory budget for expression processing, e.g. 4G or 512M. When set, expression files are processed "
+             "blockwise from disk instead of being loaded into memory. Compendia are aligned on their string gene "
+             "labels instead of the gene vocabulary, so output is identical unless a compendium has duplicated gene "
+             "symbols."
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["global", "per_gene"],
+        help="Save the processed compendium as uint16 codes in a .npz file instead of a TSV file, with one scale for "
+             "all values or one per gene. Rounding errors are about 1.5e-4 for log2(TPM+1) data."
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="Build the merged expression matrix as a sparse matrix, which saves memory when compendia have different "
+             "genes, and save it as processed_compendium.sparse.npz. Layouts load it as a sparse matrix. Each raw "
+             "compendium is still parsed into a dense frame in full, so this does not bound the peak memory of parsing."
+    )
+    parser.add_argument(
+        "--variance-threshold",
+        type=int,
+        default=20,
+        help="Percentile of low variance genes to remove."
+    )
+    parser.add_argument(
+        "--minimum-expression",
+        type=float,
+        default=None,
+        help="Remove genes with a mean log2(TPM+1) expression at or below this value. Default is no filtering."
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
+    parser.add_argument(
+        "--gene-aliases",
+        type=str,
+        default=None,
+        help="TSV file with gene aliases in the first column and their current symbols in the second, ie previous "
+             "HGNC symbols. Aliases are resolved when compendia are aligned on the gene vocabulary, which --sparse, "
+             "--max-memory and --genes-only do not use."
+    )
+    parser.add_argument(
+        "--genes-only",
+        action="store_true",
+        help="Only report how many genes the filters keep, from the statistics cached beside each raw file. Files are "
+             "only read when they have no cached statistics yet."
+    )
     args = parser.parse_args()
+    if args.sparse and args.max_memory is not None:
+        parser.error("--sparse and --max-memory are alternative processing modes, use only one")
+    if args.gene_aliases is not None and (args.sparse or args.max_memory is not None or args.genes_only):
+        parser.error("--gene-aliases is only resolved by in-memory processing, it cannot be combined with --sparse, "
+                     "--max-memory or --genes-only")
 
     config = get_config(args.config)
     if config is None:
@@ -103,31 +208,96 @@ def main():
 
     raw_dir = config.raw_data_dir_path()
     expression_file_path = config.expression_file_path()
+    if args.quantize:
+        expression_file_path = config.quantized_expression_file_path()
+    elif args.sparse:
+        expression_file_path = config.sparse_expression_file_path()
     clinical_file_path = config.clinical_file_path()
+    sample_index_file_path = config.sample_index_file_path()
+
+    if args.genes_only:
+        start_time = time.time()
+        expression_files = list_expression_files(raw_dir)
+        genes, statistics = select_compendium_genes(expression_files, args.variance_threshold, args.minimum_expression,
+                                                    parser=args.parser)
+        n_samples = int(statistics["count"].max())
+        logging.info(f"Filters keep {len(genes)} of {len(statistics)} genes for {n_samples} samples "
+                     f"from {len(expression_files)} compendia. Time taken: {time.time() - start_time:.2f}s")
+        return
 
     logging.info("Starting data processing pipeline...")
 
     # Ensure the processed data directory exists
     os.makedirs(config.processed_dir_path(), exist_ok=True)
 
+    # Remove a compendium left in another format so layouts do not load stale data
+    for stale_file_path in config.processed_expression_file_paths():
+        if stale_file_path != expression_file_path and os.path.exists(stale_file_path):
+            logging.info(f"Removing stale processed expression data {stale_file_path}...")
+            os.remove(stale_file_path)
+
     # Load and process expression data
     logging.info(f"Reading expression data files from {raw_dir}...")
     start_time = time.time()
-    expression_dict = load_tsv_files(raw_dir)
-    logging.info("Processing expression data...")
-    processed_compendium = process_expression_compendium(expression_dict, variance_threshold=20)
-    logging.info(f"Writing processed expression data to {expression_file_path}...")
-    processed_compendium.T.to_csv(expression_file_path, sep="\t")
+    if args.max_memory is not None:
+        logging.info(f"Processing expression data blockwise with a memory budget of {args.max_memory}...")
+        expression_files = list_expression_files(raw_dir)
+        if not expression_files:
+            raise ValueError("No expression data files were found. Please check your input directory.")
+        process_expression_files_blockwise(expression_files, expression_file_path, args.max_memory,
+                                           variance_threshold=args.variance_threshold,
+                                           minimum_expression=args.minimum_expression, quantize=args.quantize,
+                                           parser=args.parser)
+        sample_ids = pd.Index(np.concatenate([read_header(file_path)[1] for file_path in expression_files]))
+    elif args.sparse:
+        expression_dict = load_tsv_files(raw_dir, parser=args.parser)
+        logging.info("Processing expression data as a sparse matrix...")
+        matrix, sample_ids, gene_ids = process_expression_compendium_sparse(expression_dict, args.variance_threshold,
+                                                                            args.minimum_expression)
+        del expression_dict
+        logging.info(f"Sparse expression matrix has {matrix.nnz / max(np.prod(matrix.shape), 1):.1%} stored values.")
+        logging.info(f"Writing processed expression data to {expression_file_path}...")
+        if args.quantize:
+            write_quantized_expression(expression_file_path, matrix, sample_ids, gene_ids,
+                                       per_gene=args.quantize == "per_gene")
+        else:
+            write_sparse_expression(expression_file_path, matrix, sample_ids, gene_ids)
+    else:
+        expression_dict = load_tsv_files(raw_dir, parser=args.parser)
+        logging.info("Processing expression data...")
+        # Gene selection only needs per gene statistics, which are cached beside each raw file for later runs
+        statistics = [compendium_statistics(os.path.join(raw_dir, f"{name}.tsv"), expression_df=df)
+                      for name, df in expression_dict.items()]
+        # Compendia are aligned on the int32 codes of a shared gene vocabulary instead of their string labels
+        vocabulary = open_gene_vocabulary(config.gene_vocabulary_file_path(), args.gene_aliases)
+        processed_compendium = build_coded_compendium(expression_dict, statistics, vocabulary, args.variance_threshold,
+                                                      args.minimum_expression)
+        vocabulary.save(config.gene_vocabulary_file_path())
+        del expression_dict
+        logging.info(f"Writing processed expression data to {expression_file_path}...")
+        if args.quantize:
+            write_quantized_expression(expression_file_path, processed_compendium.to_numpy(),
+                                       processed_compendium.index, processed_compendium.columns,
+                                       per_gene=args.quantize == "per_gene")
+        else:
+            processed_compendium.T.to_csv(expression_file_path, sep="\t")
+        sample_ids = processed_compendium.index
     logging.info(f"Processed expression data saved to {expression_file_path}. Time taken: {time.time() - start_time:.2f}s")
 
     # Load, process, and merge clinical data
     logging.info("Reading clinical data files...")
-    clinical_dict = load_clinical_files(raw_dir)
+    clinical_dict = load_clinical_files(raw_dir, columns=config.clinical_columns, parser=args.parser)
     logging.info("Processing clinical data...")
     processed_clinical = process_clinical_compendium(clinical_dict)
     logging.info(f"Writing processed clinical data to {clinical_file_path}...")
     processed_clinical.to_csv(clinical_file_path, sep="\t")
     logging.info(f"Merged clinical data saved to {clinical_file_path}")
 
+    # Precompute the clinical row of every expression sample so layouts can align clinical data positionally
+    sample_index = build_sample_index(sample_ids, processed_clinical.index)
+    save_sample_index(sample_index_file_path, sample_index, sample_ids, processed_clinical.index)
+    logging.info(f"Sample index saved to {sample_index_file_path} ({(sample_index >= 0).sum()} of {len(sample_index)} "
+                 f"samples have clinical data)")
+
 if __name__ == "__main__":
     main()
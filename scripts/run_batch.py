@@ -0,0 +1,86 @@
+import os
+import argparse
+import logging
+import time
+from config import get_batch_config, VALID_CONFIGS
+from download_data import download_shared_files
+from out_of_core import parse_memory_size
+from pipeline import Pipeline
+from run_pipeline import build_pipeline, add_workflow_arguments, check_workflow_arguments
+
+"""
+Run the workflow of run_pipeline.py for several configurations at once, ie every configuration for a data refresh.
+Configurations share raw compendia, ie PDX_polyA is used by four of them, so every URL is downloaded once and linked
+into the raw directory of each configuration using it. The stages of all configurations then run in a single pipeline,
+where each shared compendium is parsed by one stage whose result feeds every configuration. Results of each
+configuration are written to results/<configuration name>, see config.get_batch_config, where the other scripts read
+them with --batch.
+
+Stages run as soon as their inputs are ready and their estimated peak memory, derived from the size of the raw files
+and of the data each stage receives, fits in the memory budget next to the running stages and the data still held for
+later stages. Small configurations therefore run alongside the large ones instead of after them.
+"""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Fraction of physical memory used as the memory budget when none is given
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+def default_memory_budget():
+    """
+    Default memory budget, DEFAULT_MEMORY_FRACTION of physical memory.
+
+    Returns:
+        int: The budget in bytes.
+    """
+    return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * DEFAULT_MEMORY_FRACTION)
+
+
+def build_batch_pipeline(configs, args):
+    """
+    Build one pipeline holding the stages of every configuration, prefixed by the configuration name.
+
+    Args:
+        configs (dict): Keys are configuration names and values are ScriptConfig classes.
+        args (argparse.Namespace): Parsed command line arguments, shared by every configuration.
+
+    Returns:
+        Pipeline: The workflow of every configuration, ready to run.
+    """
+    pipeline = Pipeline()
+    # Raw files are fetched for every configuration up front, so the stages never download
+    stage_args = argparse.Namespace(**{**vars(args), "download": False})
+    for name, config in configs.items():
+        build_pipeline(config, stage_args, pipeline=pipeline, prefix=f"{name}:")
+    return pipeline
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the workflow for several configurations within a memory budget.")
+    parser.add_argument(
+        "--configs",
+        type=str,
+        nargs="+",
+        default=VALID_CONFIGS,
+        choices=VALID_CONFIGS,
+        help="Configurations to run. Default is every configuration."
+    )
+    add_workflow_arguments(parser)
+    args = parser.parse_args()
+    check_workflow_arguments(parser, args)
+
+    configs = {name: get_batch_config(name) for name in dict.fromkeys(args.configs)}
+    max_memory = parse_memory_size(args.max_memory) if args.max_memory else default_memory_budget()
+    logging.info(f"Running {', '.join(configs)} within {max_memory / 1024 ** 3:.1f}GB.")
+
+    start_time = time.time()
+    raw_files = {}
+    for config in configs.values():
+        raw_files.update(config.get_path_expression_url_targets())
+        raw_files.update(config.get_path_clinical_url_targets())
+    download_shared_files(raw_files, download=args.download)
+
+    build_batch_pipeline(configs, args).run(outputs=[], max_memory=max_memory)
+    logging.info(f"Batch complete. Time taken: {time.time() - start_time:.2f}s")
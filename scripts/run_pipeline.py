@@ -0,0 +1,372 @@
+import os
+import argparse
+import itertools
+import logging
+import threading
+import time
+import pandas as pd
+import layout_algorithms
+from config import get_config, VALID_CONFIGS
+from download_data import download_files
+from generate_layouts import LAYOUT_ALGORITHMS
+from process_data import list_expression_files, load_clinical_files, open_gene_vocabulary
+from gene_vocabulary import build_coded_compendium
+from preprocessing import process_clinical_compendium, build_sample_index, align_clinical, save_sample_index
+from out_of_core import compendium_statistics, parse_memory_size, PARSE_OVERHEAD
+from metrics import embedding_metrics, write_metrics
+from pipeline import Pipeline
+from storage import read_expression_frame, write_quantized_expression, PARSERS, default_parser
+
+"""
+Run the whole workflow, download -> process -> layout -> render, for one configuration in a single process. Data is
+handed from stage to stage in memory, so the processed compendium is not written to TSV and parsed again, and clinical
+processing runs alongside expression processing. Pass --save-intermediates to also write the processed files that
+process_data.py writes, so the other scripts can reuse them.
+
+Raw expression files are parsed by one stage each, named after their download URL, so a pipeline holding several
+configurations, see run_batch.py, parses a compendium they share only once. Every stage estimates its peak memory from
+the data it receives so stages can be scheduled within --max-memory.
+
+Stages:
+    download -> parse:<url> --> expression --------> sample_index -> layout -> render
+             \\-> clinical ---------------------------/                       \\-> metrics
+    expression -> save_expression and expression, clinical, sample_index -> save_clinical with --save-intermediates
+"""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# Peak memory of a stage relative to the float64 values it receives. Assembling the compendium holds float64 copies of
+# the parsed compendia next to its output, a layout standardizes a float32 copy and a neighbor search may normalize
+# another, metrics standardize a float32 copy and saving formats the compendium in chunks.
+EXPRESSION_MEMORY = 2.0
+LAYOUT_MEMORY = 1.0
+METRICS_MEMORY = 0.5
+SAVE_MEMORY = 0.5
+# Lines read to estimate the number of genes of a raw expression file from its size
+SIZE_SAMPLE_LINES = 200
+# Matplotlib figures share global state, so configurations running together render one at a time
+RENDER_LOCK = threading.Lock()
+
+
+def frame_bytes(df):
+    """
+    Size of the values of a dataframe stored as float64.
+
+    Args:
+        df (pd.DataFrame): The dataframe, or None.
+
+    Returns:
+        int: Size in bytes, 0 for None.
+    """
+    return 0 if df is None else df.shape[0] * df.shape[1] * 8
+
+
+def estimate_expression_bytes(file_path, sample_lines=SIZE_SAMPLE_LINES):
+    """
+    Estimate the size of the float64 values of a raw (gene, sample) expression file without parsing it, from the
+    number of samples in the header and the average length of the first lines.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        sample_lines (int): Number of lines to average. Default SIZE_SAMPLE_LINES.
+
+    Returns:
+        int: Estimated size in bytes, 0 when the file is missing or empty.
+    """
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, "rb") as file:
+        header = file.readline()
+        lines = list(itertools.islice(file, sample_lines))
+    if not lines:
+        return 0
+    n_genes = (os.path.getsize(file_path) - len(header)) * len(lines) / sum(len(line) for line in lines)
+    return int(n_genes * header.count(b"\t") * 8)
+
+
+def build_pipeline(config, args, pipeline=None, prefix=""):
+    """
+    Build the stages of the workflow for a configuration.
+
+    Args:
+        config (ScriptConfig): The configuration to run.
+        args (argparse.Namespace): Parsed command line arguments.
+        pipeline (Pipeline): Pipeline to add the stages to, ie one holding several configurations. Parse stages that are
+            already in it are reused. Default None, a new pipeline.
+        prefix (str): Prefix of the names of the stages of this configuration, ie 'pdx_polya:'. Default "", none.
+
+    Returns:
+        Pipeline: The workflow, ready to run.
+    """
+    raw_dir = config.raw_data_dir_path()
+    pipeline = pipeline or Pipeline()
+
+    def add_stage(name, function, dependencies=(), **kwargs):
+        pipeline.add_stage(prefix + name, function, {dependency: prefix + dependency for dependency in dependencies},
+                           **kwargs)
+
+    def download():
+        os.makedirs(raw_dir, exist_ok=True)
+        targets = {**config.get_path_expression_url_targets(), **config.get_path_clinical_url_targets()}
+        missing = {file_path: url for file_path, url in targets.items() if not os.path.exists(file_path)}
+        logging.info(f"{len(targets) - len(missing)} of {len(targets)} raw files already downloaded.")
+        download_files(missing)
+
+    def parse(file_path):
+        def parse_file(download):
+            if not os.path.exists(file_path):
+                logging.warning(f"Raw expression file {file_path} is missing.")
+                return None
+            try:
+                expression_df = read_expression_frame(file_path, parser=args.parser)
+            except Exception as e:
+                logging.warning(f"Failed to load {os.path.basename(file_path)}: {e}")
+                return None
+            logging.info(f"Loaded {os.path.basename(file_path)} ({expression_df.shape[0]} rows, "
+                         f"{expression_df.shape[1]} columns)")
+            return expression_df, compendium_statistics(file_path, expression_df=expression_df)
+        return parse_file
+
+    def expression(**parsed):
+        # Compendia are assembled in the order process_data.py loads them
+        names = [os.path.splitext(os.path.basename(file_path))[0] for file_path in list_expression_files(raw_dir)]
+        names = [name for name in names if parsed.get(name) is not None]
+        if not names:
+            raise ValueError("No expression data files were loaded. Please check your input directory.")
+        expression_dict = {name: parsed[name][0] for name in names}
+        statistics = [parsed[name][1] for name in names]
+        vocabulary = open_gene_vocabulary(config.gene_vocabulary_file_path(), args.gene_aliases)
+        processed_compendium = build_coded_compendium(expression_dict, statistics, vocabulary, args.variance_threshold,
+                                                      args.minimum_expression)
+        vocabulary.save(config.gene_vocabulary_file_path())
+        logging.info(f"Processed expression data: {processed_compendium.shape[0]} samples, "
+                     f"{processed_compendium.shape[1]} genes.")
+        return processed_compendium
+
+    def clinical(download):
+        clinical_dict = load_clinical_files(raw_dir, columns=config.clinical_columns, parser=args.parser)
+        return process_clinical_compendium(clinical_dict)
+
+    def sample_index(expression, clinical):
+        return build_sample_index(expression.index, clinical.index)
+
+    def save_expression(expression):
+        os.makedirs(config.processed_dir_path(), exist_ok=True)
+        expression_file_path = config.expression_file_path()
+        if args.quantize:
+            expression_file_path = config.quantized_expression_file_path()
+            write_quantized_expression(expression_file_path, expression.to_numpy(), expression.index,
+                                       expression.columns, per_gene=args.quantize == "per_gene")
+        else:
+            expression.T.to_csv(expression_file_path, sep="\t")
+        # Remove a compendium left in another format so layouts do not load stale data
+        for stale_file_path in config.processed_expression_file_paths():
+            if stale_file_path != expression_file_path and os.path.exists(stale_file_path):
+                os.remove(stale_file_path)
+        logging.info(f"Processed expression data saved to {expression_file_path}")
+
+    def save_clinical(expression, clinical, sample_index):
+        os.makedirs(config.processed_dir_path(), exist_ok=True)
+        clinical.to_csv(config.clinical_file_path(), sep="\t")
+        save_sample_index(config.sample_index_file_path(), sample_index, expression.index, clinical.index)
+        logging.info(f"Processed clinical data and sample index saved to {config.processed_dir_path()}")
+
+    def layout(expression):
+        layout_kwargs = {"fast_correlation": True} if args.fast_correlation else {}
+        if args.knn_workers is not None:
+            layout_kwargs["knn_workers"] = args.knn_workers
+        layout_algorithm = getattr(layout_algorithms, LAYOUT_ALGORITHMS[args.layout])(**layout_kwargs)
+        # The compendium may still be being saved, so it must be left untouched. Standardizing writes a float32 copy.
+        layout_df = layout_algorithm.fit_transform_array(expression.to_numpy(), expression.index, copy=True)
+        return layout_df, layout_algorithm
+
+    def metrics(expression, layout, clinical, sample_index):
+        layout_df, layout_algorithm = layout
+        labels_df = align_clinical(pd.DataFrame(index=layout_df.index), clinical, sample_index)
+        layout_metrics = embedding_metrics(expression.to_numpy(), layout_df, labels_df[["compendium", "disease"]],
+                                           knn_indices=getattr(layout_algorithm, "knn_indices_", None))
+        os.makedirs(config.get_vis_dir_path(), exist_ok=True)
+        metrics_path = config.gen_figure_file_path(f"{args.layout}-{config.metrics_file}")
+        write_metrics(metrics_path, layout_metrics, layout_algorithm)
+        logging.info(f"Trustworthiness {layout_metrics['trustworthiness']:.3f}, kNN preservation "
+                     f"{layout_metrics['knn_preservation']:.3f}. Metrics saved at: {metrics_path}")
+
+    def render(layout, clinical, sample_index):
+        layout = align_clinical(layout[0], clinical, sample_index)
+        # Figures are only saved in batch mode so use a non-interactive backend
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from plotting import generate_compendium_plot, generate_disease_plot
+
+        os.makedirs(config.get_vis_dir_path(), exist_ok=True)
+        layout.to_csv(config.gen_figure_file_path(f"{args.layout}-{config.layout_file}"), sep="\t")
+        layout_name = args.layout.upper()
+        with RENDER_LOCK:
+            for kind, generate_plot in (("disease", generate_disease_plot), ("compendium", generate_compendium_plot)):
+                fig = generate_plot(layout, f"{layout_name} {kind.capitalize()} Plot")
+                fig_path = config.gen_figure_file_path(f"{args.layout}-{kind}.png")
+                fig.savefig(fig_path, dpi=300, bbox_inches='tight')
+                plt.close(fig)
+                logging.info(f"{layout_name} figure saved at: {fig_path}")
+
+    # Raw expression files from the same URL are parsed once, whichever configuration adds the stage first
+    parse_stages = {}
+    for file_path, url in config.get_path_expression_url_targets().items():
+        # Keyed on the full URL, since different URLs can end in the same file name
+        parse_stage = f"parse:{url}"
+        if parse_stage not in pipeline.stages:
+            pipeline.add_stage(parse_stage, parse(file_path), {"download": prefix + "download"},
+                               memory=lambda download, file_path=file_path:
+                                   PARSE_OVERHEAD * estimate_expression_bytes(file_path),
+                               result_memory=lambda parsed: frame_bytes(parsed and parsed[0]))
+        parse_stages[os.path.splitext(os.path.basename(file_path))[0]] = parse_stage
+
+    add_stage("download", download if args.download else lambda: None)
+    pipeline.add_stage(prefix + "expression", expression, parse_stages,
+                       memory=lambda **parsed: EXPRESSION_MEMORY * sum(frame_bytes(result and result[0])
+                                                                       for result in parsed.values()),
+                       result_memory=frame_bytes)
+    add_stage("clinical", clinical, dependencies=["download"])
+    add_stage("sample_index", sample_index, dependencies=["expression", "clinical"])
+    add_stage("layout", layout, dependencies=["expression"],
+              memory=lambda expression: LAYOUT_MEMORY * frame_bytes(expression))
+    add_stage("render", render, dependencies=["layout", "clinical", "sample_index"])
+    if not args.skip_metrics:
+        add_stage("metrics", metrics, dependencies=["expression", "layout", "clinical", "sample_index"],
+                  memory=lambda expression, **_: METRICS_MEMORY * frame_bytes(expression))
+    if args.save_intermediates:
+        add_stage("save_expression", save_expression, dependencies=["expression"],
+                  memory=lambda expression: SAVE_MEMORY * frame_bytes(expression))
+        add_stage("save_clinical", save_clinical, dependencies=["expression", "clinical", "sample_index"])
+    return pipeline
+
+
+def add_workflow_arguments(parser):
+    """
+    Add the command line arguments of the workflow shared by run_pipeline.py and run_batch.py.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser to add the arguments to.
+    """
+    parser.add_argument(
+        "--download",
+        action="store_true",
+        help="Download raw files that are missing before processing. Default is to use the files already downloaded."
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        default="umap",
+        choices=list(LAYOUT_ALGORITHMS),
+        help="Layout algorithm to use."
+    )
+    parser.add_argument(
+        "--fast-correlation",
+        action="store_true",
+        help="UMAP only. Normalize samples once and use a fast euclidean neighbor search that is equivalent to "
+             "correlation distance."
+    )
+    parser.add_argument(
+        "--knn-workers",
+        type=int,
+        default=None,
+        help="UMAP only. Find exact neighbors with a brute force search sharded across this many worker processes, "
+             "-1 for one per CPU. Default is UMAP's approximate search."
+    )
+    parser.add_argument(
+        "--variance-threshold",
+        type=int,
+        default=20,
+        help="Percentile of low variance genes to remove."
+    )
+    parser.add_argument(
+        "--minimum-expression",
+        type=float,
+        default=None,
+        help="Remove genes with a mean log2(TPM+1) expression at or below this value. Default is no filtering."
+    )
+    parser.add_argument(
+        "--gene-aliases",
+        type=str,
+        default=None,
+        help="TSV file with gene aliases in the first column and their current symbols in the second, resolved when "
+             "compendia are aligned."
+    )
+    parser.add_argument(
+        "--skip-metrics",
+        action="store_true",
+        help="Do not compute the layout quality metrics saved next to the figures."
+    )
+    parser.add_argument(
+        "--save-intermediates",
+        action="store_true",
+        help="Also write the processed expression data, clinical data and sample index like process_data.py, while "
+             "the layout runs."
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default=None,
+        choices=["global", "per_gene"],
+        help="With --save-intermediates, save the processed compendium as uint16 codes in a .npz file."
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=str,
+        default=None,
+        help="Memory budget for stages running together, ie 48G. Stages whose estimated memory does not fit wait for "
+             "others to finish. Default is no budget."
+    )
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
+
+
+def check_workflow_arguments(parser, args):
+    """
+    Check the workflow arguments added by add_workflow_arguments, exiting with a usage error when they conflict.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser the arguments were parsed with.
+        args (argparse.Namespace): Parsed command line arguments.
+    """
+    if args.fast_correlation and args.layout != "umap":
+        parser.error("--fast-correlation is only supported with --layout umap")
+    if args.knn_workers is not None and args.layout != "umap":
+        parser.error("--knn-workers is only supported with --layout umap")
+    if args.quantize and not args.save_intermediates:
+        parser.error("--quantize requires --save-intermediates")
+    if args.max_memory is not None:
+        try:
+            parse_memory_size(args.max_memory)
+        except ValueError as e:
+            parser.error(str(e))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run download, processing, layout and rendering in one process.")
+    parser.add_argument(
+        "--config",
+        type=str,
+        required=True,
+        help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
+    )
+    add_workflow_arguments(parser)
+    args = parser.parse_args()
+    check_workflow_arguments(parser, args)
+
+    config = get_config(args.config)
+    if config is None:
+        exit(1)
+    logging.info(f"Using configuration: {args.config}")
+
+    start_time = time.time()
+    max_memory = parse_memory_size(args.max_memory) if args.max_memory else None
+    build_pipeline(config, args).run(outputs=[], max_memory=max_memory)
+    logging.info(f"Pipeline complete. Time taken: {time.time() - start_time:.2f}s")
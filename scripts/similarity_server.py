@@ -0,0 +1,138 @@
+import argparse
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from config import get_config, get_batch_config, VALID_CONFIGS
+from similarity import SimilarityIndex
+from storage import read_tsv, PARSERS, default_parser
+
+"""
+Local HTTP service answering patient similarity queries from a saved index.
+
+Endpoints:
+    GET /health: Number of indexed samples and genes.
+    POST /neighbors: Body {"expression": {"<gene>": <log2(TPM + 1)>, ...}, "k": 10}. Returns the k most correlated
+        compendium samples with their clinical annotations, and the number of indexed genes missing from the query.
+        Invalid requests, and queries without any indexed gene or constant over them, get a 400 error and failed
+        queries a 500 error, both with an "error" message.
+
+Example:
+    curl -X POST localhost:8765/neighbors -d '{"expression": {"TP53": 5.1, "MYCN": 9.8}, "k": 5}'
+"""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+
+def make_handler(index, max_k):
+    """
+    Create a request handler class bound to a similarity index.
+
+    Args:
+        index (SimilarityIndex): The loaded index.
+        max_k (int): Largest number of neighbors a query may ask for.
+
+    Returns:
+        type: A BaseHTTPRequestHandler subclass.
+    """
+
+    class SimilarityHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_json(404, {"error": f"Unknown path '{self.path}'."})
+                return
+            self.send_json(200, {"n_samples": len(index.sample_ids), "n_genes": len(index.gene_ids)})
+
+        def do_POST(self):
+            if self.path != "/neighbors":
+                self.send_json(404, {"error": f"Unknown path '{self.path}'."})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                expression = pd.Series(request["expression"], dtype=float, name="query")
+                k = int(request.get("k", 10))
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {"error": f"Invalid request: {e}"})
+                return
+            if not 1 <= k <= max_k:
+                self.send_json(400, {"error": f"k must be between 1 and {max_k}."})
+                return
+
+            start_time = time.perf_counter()
+            try:
+                neighbors_df = index.query(expression, k=k).drop(columns="query")
+            except ValueError as e:
+                self.send_json(400, {"error": f"Invalid query: {e}"})
+                return
+            except Exception as e:
+                logging.exception("Similarity query failed")
+                self.send_json(500, {"error": f"Query failed: {e}"})
+                return
+            self.send_json(200, {
+                "neighbors": json.loads(neighbors_df.to_json(orient="records")),
+                "missing_genes": int((~index.gene_ids.isin(expression.dropna().index)).sum()),
+                "query_ms": round((time.perf_counter() - start_time) * 1000, 3),
+            })
+
+        def log_message(self, format, *args):
+            logging.info(f"{self.address_string()} - {format % args}")
+
+    return SimilarityHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve patient similarity queries over HTTP.")
+    parser.add_argument(
+        "--config",
+        type=str,
+        required=True,
+        help=f"Configuration name (e.g., {', '.join(VALID_CONFIGS)})"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Use the results written by run_batch.py, in results/<configuration>, instead of results."
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--max-k", type=int, default=100, help="Largest number of neighbors a query may ask for.")
+    parser.add_argument(
+        "--parser",
+        type=str,
+        default=default_parser(),
+        choices=PARSERS,
+        help="TSV parser. pyarrow parses in parallel and is the default when it is installed."
+    )
+    args = parser.parse_args()
+
+    config = get_batch_config(args.config) if args.batch else get_config(args.config)
+    if config is None:
+        exit(1)
+    logging.info(f"Using configuration: {args.config}")
+
+    logging.info("Loading similarity index and clinical data...")
+    clinical_df = read_tsv(config.clinical_file_path(), parser=args.parser, index_col=0)
+    index = SimilarityIndex.load(config.similarity_index_dir_path(), clinical_df=clinical_df)
+    # Run one query so numba compilation happens before the first request, with a spread so it is not constant
+    warmup = index.mean + index.scale * np.linspace(-1, 1, len(index.gene_ids), dtype=np.float32)
+    index.query(pd.Series(warmup, index=index.gene_ids, name="warmup"), k=1)
+
+    server = HTTPServer((args.host, args.port), make_handler(index, args.max_k))
+    logging.info(f"Serving similarity queries on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down.")
+        server.server_close()
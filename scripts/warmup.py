@@ -0,0 +1,59 @@
+import os
+import argparse
+import logging
+import time
+
+"""
+Fill numba's on-disk cache ahead of time, ie while building a container image, so the first layout in a fresh
+container does not pay JIT compilation latency. Runs every numba backed code path of the layouts once on a small random
+matrix. Numba caches compiled functions next to their source files, or in NUMBA_CACHE_DIR when it is set. Set the same
+NUMBA_CACHE_DIR when running the layouts.
+
+Functions that umap and pynndescent compile eagerly at import time are not cacheable by numba and are compiled on
+every import. The scripts only import them when a layout runs.
+"""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# umap only builds its neighbor graph with NN-descent above 4096 samples, so the warm-up matrix is just above that
+WARMUP_SAMPLES = 4200
+WARMUP_GENES = 32
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile and cache the numba functions used by the layouts.")
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory for numba's cache. Default is NUMBA_CACHE_DIR if set, otherwise next to the package sources."
+    )
+    args = parser.parse_args()
+
+    # NUMBA_CACHE_DIR is read when numba is first imported
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        os.environ["NUMBA_CACHE_DIR"] = os.path.abspath(args.cache_dir)
+
+    import numpy as np
+    import pandas as pd
+    from layout_algorithms import MCMUmap
+    from similarity import SimilarityIndex
+
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(WARMUP_SAMPLES, WARMUP_GENES)).astype(np.float32)
+    sample_ids = pd.Index([f"warmup_{i}" for i in range(WARMUP_SAMPLES)])
+    gene_ids = pd.Index([f"gene_{i}" for i in range(WARMUP_GENES)])
+
+    # Correlation neighbors, the fast correlation euclidean search and the UMAP optimization
+    for fast_correlation in (False, True):
+        start_time = time.time()
+        MCMUmap(fast_correlation=fast_correlation).fit_transform_array(matrix, sample_ids)
+        logging.info(f"Warmed up UMAP (fast_correlation={fast_correlation}) in {time.time() - start_time:.2f}s")
+
+    # Index search used by landmark placement and similarity queries
+    start_time = time.time()
+    SimilarityIndex.build(matrix, sample_ids, gene_ids).query(pd.Series(matrix[0], index=gene_ids, name="warmup"))
+    logging.info(f"Warmed up nearest neighbor queries in {time.time() - start_time:.2f}s")
+
+    logging.info(f"Numba cache filled in {os.environ.get('NUMBA_CACHE_DIR', 'the package directories')}.")
@@ -16,5 +16,10 @@ setup(
         'matplotlib',
         'ipython',
         'requests',
+        'pynndescent',
     ],
+    extras_require={
+        'tsne': ['openTSNE'],
+        'arrow': ['pyarrow'],
+    },
 )
\ No newline at end of file
@@ -0,0 +1,309 @@
+import logging
+import numpy as np
+import pandas as pd
+from preprocessing import auto_block_size, merge_expression_statistics, select_genes
+
+"""
+A shared vocabulary of gene symbols with int32 codes. Every compendium carries tens of thousands of string gene labels,
+and aligning them with pd.concat hashes every label and builds a union object index on each run. Once the labels of a
+compendium are encoded, the union of genes, gene selection and the assembly of the processed compendium only work on
+int32 arrays: a lookup table from code to output column turns alignment into one gather per block of samples.
+
+Codes are only ever appended, so a vocabulary saved beside the raw files keeps the codes of every gene stable across
+runs. Aliases, ie previous HGNC symbols, map to the code of their current symbol so compendia annotated with different
+releases line up. An alias that was already encoded as a symbol of its own, ie by a run without aliases, is redirected
+to the code of its current symbol. When several columns of one compendium resolve to the same code, ie a duplicated
+symbol or an alias next to its current symbol, the first column is used.
+
+Classes:
+    GeneVocabulary: Gene symbols and aliases mapped to int32 codes, with disk persistence.
+
+Functions:
+    read_gene_aliases(file_path: str) -> dict:
+        Read an alias to symbol mapping from a two column TSV file.
+
+    first_code_positions(codes: np.ndarray) -> np.ndarray:
+        Positions of the first occurrence of every known code.
+
+    encode_expression(expression_df: pd.DataFrame, vocabulary: GeneVocabulary) -> tuple:
+        Store a (sample, gene) dataframe as values, sample ids and gene codes.
+
+    encode_statistics(statistics: pd.DataFrame, vocabulary: GeneVocabulary) -> pd.DataFrame:
+        Index per gene statistics by gene code.
+
+    assemble_coded_compendium(coded_compendia: list, gene_codes: np.ndarray, n_codes: int) -> np.ndarray:
+        Scatter coded compendia into a (sample, gene) matrix of the selected genes.
+
+    build_coded_compendium(expression_dict: dict, statistics: list, vocabulary: GeneVocabulary,
+                           variance_threshold: int, minimum_expression: float) -> pd.DataFrame:
+        Coded equivalent of selecting genes and assembling the processed compendium.
+"""
+
+
+class GeneVocabulary:
+    """
+    Gene symbols mapped to int32 codes, the position of the symbol in the vocabulary. Aliases map to the code of a
+    symbol. A symbol that later turns out to be an alias keeps its position but is redirected to the code of its current
+    symbol.
+
+    Args:
+        symbols (list): Gene symbols in code order. Default (), an empty vocabulary.
+        alias_names (list): Aliases. Default (), none.
+        alias_codes (np.ndarray): Code of the symbol of each alias. Default (), none.
+        symbol_codes (np.ndarray): Code each symbol encodes to. Default None, the position of the symbol.
+    """
+
+    def __init__(self, symbols=(), alias_names=(), alias_codes=(), symbol_codes=None):
+        self.symbols = pd.Index(np.asarray(symbols, dtype=str), dtype=object)
+        self.alias_names = pd.Index(np.asarray(alias_names, dtype=str), dtype=object)
+        self.alias_codes = np.asarray(alias_codes, dtype=np.int32)
+        if symbol_codes is None:
+            symbol_codes = np.arange(len(self.symbols))
+        self.symbol_codes = np.asarray(symbol_codes, dtype=np.int32)
+        if not self.symbols.is_unique or not self.alias_names.is_unique:
+            raise ValueError("Gene symbols and aliases must be unique.")
+        if len(self.symbol_codes) != len(self.symbols):
+            raise ValueError("There must be one symbol code per symbol.")
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def encode(self, gene_ids, add=False):
+        """
+        Encode gene ids, resolving aliases.
+
+        Args:
+            gene_ids (list): Gene symbols or aliases.
+            add (bool): Whether unknown genes are added to the vocabulary. Default False, they are encoded as -1.
+
+        Returns:
+            np.ndarray: int32 code of each gene id.
+        """
+        gene_ids = pd.Index(np.asarray(gene_ids, dtype=str), dtype=object)
+        codes = self.symbols.get_indexer(gene_ids)
+        codes[codes >= 0] = self.symbol_codes[codes[codes >= 0]]
+        missing = np.flatnonzero(codes < 0)
+        if len(missing) and len(self.alias_names):
+            alias_positions = self.alias_names.get_indexer(gene_ids[missing])
+            resolved = alias_positions >= 0
+            codes[missing[resolved]] = self.alias_codes[alias_positions[resolved]]
+            missing = missing[~resolved]
+        if add and len(missing):
+            new_symbols = gene_ids[missing].unique()
+            n_known = len(self.symbols)
+            self.symbols = self.symbols.append(new_symbols)
+            self.symbol_codes = np.concatenate([self.symbol_codes,
+                                                np.arange(n_known, len(self.symbols), dtype=np.int32)])
+            codes[missing] = len(self.symbols) - len(new_symbols) + new_symbols.get_indexer(gene_ids[missing])
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        """
+        Decode gene codes to symbols.
+
+        Args:
+            codes (np.ndarray): Codes of known genes.
+
+        Returns:
+            pd.Index: The symbol of each code.
+        """
+        return self.symbols[np.asarray(codes)]
+
+    def add_aliases(self, aliases):
+        """
+        Map aliases to the code of their symbol. Symbols missing from the vocabulary are added. An alias already in the
+        vocabulary as a symbol, ie from a run without aliases, is redirected to the code of its current symbol unless it
+        is itself the current symbol of another alias. Aliases that already map to another code, and such current
+        symbols, are ignored with a warning.
+
+        Args:
+            aliases (dict): Keys are aliases and values are the current symbols.
+        """
+        alias_names = pd.Index(np.asarray(list(aliases), dtype=str), dtype=object)
+        alias_codes = self.encode(list(aliases.values()), add=True)
+        current_codes = self.encode(alias_names)
+        symbol_positions = self.symbols.get_indexer(alias_names)
+        candidates = ~alias_names.duplicated() & (current_codes != alias_codes)
+        candidates &= ~alias_names.isin(pd.Index(np.asarray(list(aliases.values()), dtype=str)))
+        new = candidates & (current_codes < 0)
+        redirected = candidates & (symbol_positions >= 0)
+        redirected[redirected] = self.symbol_codes[symbol_positions[redirected]] == symbol_positions[redirected]
+        ignored = ~alias_names.duplicated() & (current_codes >= 0) & (current_codes != alias_codes) & ~redirected
+
+        self.alias_names = self.alias_names.append(alias_names[new])
+        self.alias_codes = np.concatenate([self.alias_codes, alias_codes[new]])
+        if redirected.any():
+            self.symbol_codes[symbol_positions[redirected]] = alias_codes[redirected]
+            # Follow chains of redirects, ie a symbol redirected to a symbol that is now redirected in turn
+            while not np.array_equal(self.symbol_codes[self.symbol_codes], self.symbol_codes):
+                self.symbol_codes = self.symbol_codes[self.symbol_codes]
+            self.alias_codes = self.symbol_codes[self.alias_codes]
+            logging.info(f"Redirected {redirected.sum()} gene symbols to the current symbol they are an alias of.")
+        if ignored.any():
+            logging.warning(f"Ignored {ignored.sum()} gene aliases that are current symbols or aliases of another "
+                            f"gene, ie {', '.join(alias_names[ignored][:5])}.")
+
+    def save(self, file_path):
+        """
+        Save the vocabulary to a .npz file.
+
+        Args:
+            file_path (str): Path of the .npz file.
+        """
+        np.savez(file_path, symbols=self.symbols.to_numpy(dtype=str), alias_names=self.alias_names.to_numpy(dtype=str),
+                 alias_codes=self.alias_codes, symbol_codes=self.symbol_codes)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Load a vocabulary saved with save.
+
+        Args:
+            file_path (str): Path of the .npz file.
+
+        Returns:
+            GeneVocabulary: The vocabulary.
+        """
+        with np.load(file_path) as saved:
+            symbol_codes = saved["symbol_codes"] if "symbol_codes" in saved.files else None
+            return cls(saved["symbols"], saved["alias_names"], saved["alias_codes"], symbol_codes)
+
+
+def read_gene_aliases(file_path):
+    """
+    Read aliases from a TSV file with an alias in the first column and its current symbol in the second, ie previous
+    symbols exported from HGNC. Rows with a missing value are skipped.
+
+    Args:
+        file_path (str): Path to the TSV file, with a header row.
+
+    Returns:
+        dict: Keys are aliases and values are symbols.
+    """
+    aliases_df = pd.read_csv(file_path, sep="\t", usecols=[0, 1], dtype=str).dropna()
+    return dict(zip(aliases_df.iloc[:, 0], aliases_df.iloc[:, 1]))
+
+
+def first_code_positions(codes):
+    """
+    Positions of the first occurrence of every code, skipping unknown codes (-1), in their original order.
+
+    Args:
+        codes (np.ndarray): Gene codes, ie of the columns of a compendium.
+
+    Returns:
+        np.ndarray: Positions into codes.
+    """
+    known = np.flatnonzero(codes >= 0)
+    _, first = np.unique(codes[known], return_index=True)
+    return known[np.sort(first)]
+
+
+def encode_expression(expression_df, vocabulary):
+    """
+    Store a compendium as its values, sample ids and gene codes. Genes unknown to the vocabulary are added to it and
+    columns resolving to the same code are reduced to the first one.
+
+    Args:
+        expression_df (pd.DataFrame): Gene expression data in (sample, gene) format.
+        vocabulary (GeneVocabulary): The shared vocabulary.
+
+    Returns:
+        tuple: (values, sample_ids, codes) where values is a float64 (sample, gene) array, sample_ids a pd.Index and
+            codes an int32 array with one unique code per column of values.
+    """
+    codes = vocabulary.encode(expression_df.columns, add=True)
+    values = expression_df.to_numpy(dtype=np.float64)
+    columns = first_code_positions(codes)
+    if len(columns) < len(codes):
+        values, codes = values[:, columns], codes[columns]
+    return values, expression_df.index, codes
+
+
+def encode_statistics(statistics, vocabulary):
+    """
+    Index per gene statistics by gene code, keeping the first row of genes resolving to the same code like
+    encode_expression.
+
+    Args:
+        statistics (pd.DataFrame): Statistics as returned by preprocessing.expression_statistics.
+        vocabulary (GeneVocabulary): The shared vocabulary.
+
+    Returns:
+        pd.DataFrame: The statistics indexed by int32 gene codes, with the name of the gene index kept.
+    """
+    codes = vocabulary.encode(statistics.index, add=True)
+    rows = first_code_positions(codes)
+    coded = statistics.iloc[rows]
+    coded.index = pd.Index(codes[rows], name=statistics.index.name)
+    return coded
+
+
+def assemble_coded_compendium(coded_compendia, gene_codes, n_codes):
+    """
+    Scatter coded compendia into one (sample, gene) matrix of the selected genes. A lookup table from code to output
+    column replaces label alignment: it gives the source column of every output column, so each block of rows is
+    filled with a single gather straight into the output. Genes missing from a compendium and missing values are 0,
+    like process_expression_compendium.
+
+    Args:
+        coded_compendia (list): (values, sample_ids, codes) tuples as returned by encode_expression.
+        gene_codes (np.ndarray): Codes of the genes to keep, in output order.
+        n_codes (int): Size of the vocabulary.
+
+    Returns:
+        np.ndarray: float64 matrix with the samples of every compendium in order and one column per gene code.
+    """
+    gene_codes = np.asarray(gene_codes, dtype=np.int32)
+    columns = np.full(n_codes, -1, dtype=np.int32)
+    columns[gene_codes] = np.arange(len(gene_codes), dtype=np.int32)
+
+    matrix = np.empty((sum(len(values) for values, _, _ in coded_compendia), len(gene_codes)))
+    row_offset = 0
+    for values, _, codes in coded_compendia:
+        targets = columns[codes]
+        sources = np.full(len(gene_codes), -1, dtype=np.intp)
+        sources[targets[targets >= 0]] = np.flatnonzero(targets >= 0)
+        missing = np.flatnonzero(sources < 0)
+        block_size = auto_block_size(len(gene_codes))
+        for start in range(0, len(values), block_size):
+            stop = min(start + block_size, len(values))
+            block = matrix[row_offset + start:row_offset + stop]
+            if values.shape[1]:
+                # Missing genes gather the last column and are zeroed afterwards
+                np.take(values[start:stop], sources, axis=1, out=block, mode="wrap")
+                block[np.isnan(block)] = 0
+            block[:, missing] = 0
+        row_offset += len(values)
+    return matrix
+
+
+def build_coded_compendium(expression_dict, statistics, vocabulary, variance_threshold=None, minimum_expression=None):
+    """
+    Coded equivalent of selecting genes from per compendium statistics and running
+    preprocessing.assemble_expression_compendium. Without aliases or duplicated symbols the result is identical. Unknown
+    genes are added to the vocabulary, so save it afterwards to keep their codes.
+
+    Args:
+        expression_dict (dict): Dictionary where keys are compendium names and values are dataframes in (sample, gene)
+            format.
+        statistics (list): Statistics of each compendium in the order of expression_dict, as returned by
+            preprocessing.expression_statistics.
+        vocabulary (GeneVocabulary): The shared vocabulary.
+        variance_threshold (int): What percentile of low variance genes to remove. Default None, no filtering.
+        minimum_expression (float): The threshold for minimum expression exclusive. Units: mean log2(TPM+1). Default
+            None, no filtering.
+
+    Returns:
+        pd.DataFrame: The compendium in (sample, gene) format with gene symbols as columns.
+    """
+    coded_compendia = [encode_expression(df, vocabulary) for df in expression_dict.values()]
+    merged = merge_expression_statistics([encode_statistics(stats, vocabulary) for stats in statistics])
+    gene_codes = select_genes(merged, variance_threshold, minimum_expression)
+
+    matrix = assemble_coded_compendium(coded_compendia, gene_codes.to_numpy(), len(vocabulary))
+    sample_ids = pd.Index(np.concatenate([np.asarray(sample_ids) for _, sample_ids, _ in coded_compendia]))
+    sample_names = {df.index.name for df in expression_dict.values()}
+    sample_ids = sample_ids.rename(sample_names.pop() if len(sample_names) == 1 else None)
+    gene_ids = vocabulary.decode(gene_codes).rename(gene_codes.name)
+    return pd.DataFrame(matrix, index=sample_ids, columns=gene_ids, copy=False)
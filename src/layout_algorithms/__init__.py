@@ -1,2 +1,24 @@
-from .base_layout import BaseLayout
-from .mcm_umap import MCMUmap
\ No newline at end of file
+import importlib
+
+# Layout classes are imported on first access, so importing the package does not load umap or openTSNE and pay their
+# JIT compilation until a layout actually runs
+_LAYOUT_MODULES = {
+    "BaseLayout": ".base_layout",
+    "MCMUmap": ".mcm_umap",
+    "MCMPca": ".mcm_pca",
+    "MCMTsne": ".mcm_tsne",
+    "MCMLandmarkUmap": ".landmark_umap",
+    "MCMIncrementalUmap": ".incremental_umap",
+}
+
+__all__ = list(_LAYOUT_MODULES)
+
+
+def __getattr__(name):
+    if name in _LAYOUT_MODULES:
+        return getattr(importlib.import_module(_LAYOUT_MODULES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
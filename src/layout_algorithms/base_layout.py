@@ -1,10 +1,11 @@
 from abc import ABC, abstractmethod
+import numpy as np
 import pandas as pd
 
 class BaseLayout(ABC):
     """
     API for layout algorithms. To make a new layout algorithm, inherit from this class and implement the fit_transform
-    method.
+    method. Algorithms that can work on a raw array without copying it should also override fit_transform_array.
     """
 
     @abstractmethod
@@ -22,3 +23,20 @@ class BaseLayout(ABC):
         pd.DataFrame: This dataframe should have dimension 2. The index should be the sample ids.
         """
         pass
+
+    def fit_transform_array(self, matrix: np.ndarray, sample_index: pd.Index, copy: bool = True) -> pd.DataFrame:
+        """
+        Perform the layout algorithm on a raw (sample, gene) array, ie a C-contiguous np.memmap. Only the 2D result is
+        wrapped in a dataframe. The default implementation wraps the array in a dataframe without copying it and calls
+        fit_transform.
+
+        Parameters:
+        matrix (np.ndarray): The gene expression data in (sample, gene) format with no missing values.
+        sample_index (pd.Index): The sample ids of the matrix rows.
+        copy (bool): Whether the matrix must be left untouched. When False, implementations may preprocess the matrix
+            in place to avoid copying it. Default True.
+
+        Returns:
+        pd.DataFrame: This dataframe should have dimension 2. The index should be the sample ids.
+        """
+        return self.fit_transform(pd.DataFrame(matrix, index=sample_index, copy=False))
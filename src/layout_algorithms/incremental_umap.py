@@ -0,0 +1,199 @@
+import numpy as np
+import pandas as pd
+from neighbors import EXACT_METRICS, nearest_neighbors, prepare_exact_rows, update_nearest_neighbors
+from .mcm_umap import MCMUmap
+
+
+def remap_knn_graph(previous_graph, sample_index, n_neighbors):
+    """
+    Map a kNN graph saved for a previous release onto the samples of the current one.
+
+    Args:
+        previous_graph (tuple): (sample_ids, indices, distances) as returned by neighbors.load_knn_graph.
+        sample_index (pd.Index): Sample ids of the current matrix rows.
+        n_neighbors (int): Number of neighbors per sample. Only the nearest columns of a larger graph are kept.
+
+    Returns:
+        tuple: (indices, distances, new_rows, stale_rows) in the order of sample_index. new_rows are the samples missing
+            from the previous graph and stale_rows the samples that lost a neighbor, ie a removed sample.
+    """
+    previous_ids, previous_indices, previous_distances = previous_graph
+    previous_indices = previous_indices[:, :n_neighbors]
+    previous_distances = previous_distances[:, :n_neighbors]
+    previous_rows = pd.Index(previous_ids).get_indexer(sample_index)
+    current_positions = np.append(pd.Index(sample_index).get_indexer(previous_ids), -1)
+
+    indices = np.full((len(sample_index), n_neighbors), -1, dtype=np.int64)
+    distances = np.full((len(sample_index), n_neighbors), np.inf, dtype=np.float32)
+    kept = np.flatnonzero(previous_rows >= 0)
+    # Disconnected entries (-1) pick the appended -1 so they stay disconnected and mark the row stale
+    indices[kept] = current_positions[previous_indices[previous_rows[kept]]]
+    distances[kept] = previous_distances[previous_rows[kept]]
+
+    new_rows = np.flatnonzero(previous_rows < 0)
+    stale_rows = kept[(indices[kept] < 0).any(axis=1)]
+    return indices, distances, new_rows, stale_rows
+
+
+def neighbor_positions(embedding, placed, indices, distances):
+    """
+    Place samples at the weighted mean of the embedding of their placed neighbors, with the weights of
+    landmark_umap.interpolate_positions. Samples whose neighbors are all unplaced are left unplaced.
+
+    Args:
+        embedding (np.ndarray): (sample, 2) embedding. Rows of unplaced samples are ignored.
+        placed (np.ndarray): Boolean mask of the samples with a position.
+        indices (np.ndarray): (sample, k) neighbor indices of the samples to place, -1 for no neighbor.
+        distances (np.ndarray): (sample, k) neighbor distances.
+
+    Returns:
+        tuple: (sample, 2) positions and a boolean mask of the samples that could be placed.
+    """
+    usable = (indices >= 0) & placed[np.maximum(indices, 0)]
+    found = usable.any(axis=1)
+    nearest = np.where(usable, distances, np.inf).min(axis=1, keepdims=True)
+    offsets = np.where(usable, distances - np.where(found[:, None], nearest, 0), 0)
+    scale = np.maximum(offsets.sum(axis=1, keepdims=True) / np.maximum(usable.sum(axis=1, keepdims=True), 1), 1e-12)
+    weights = np.where(usable, np.exp(-offsets / scale), 0)
+    weights /= np.maximum(weights.sum(axis=1, keepdims=True), 1e-12)
+    return np.einsum("ik,ikd->id", weights, embedding[np.maximum(indices, 0)]), found
+
+
+class MCMIncrementalUmap(MCMUmap):
+    """
+    Warm started UMAP for a compendium release that adds samples to a laid out compendium. Existing samples start at
+    their position in the previous layout and new samples start at the weighted mean of their placed expression space
+    neighbors. The kNN graph of the previous run is updated instead of rebuilt, only the rows of new samples and of
+    samples they displace change, and UMAP runs a short optimization from the warm start. The layout stays in the
+    coordinates of the previous one, so figures of both releases can be compared directly.
+
+    Neighbors are computed exactly with matrix products, so only the euclidean, cosine and correlation metrics are
+    supported. Genes are standardized over the current release, so distances kept from the previous graph are off by
+    the small shift the new samples cause in the gene means and deviations.
+
+    Args:
+        previous_layout (pd.DataFrame): Previous layout indexed by sample id with 'x' and 'y' columns.
+        previous_graph (tuple): (sample_ids, indices, distances) of the previous run, as saved by
+            neighbors.save_knn_graph. Default None, the graph is built from scratch with NN-descent, or exactly with
+            knn_workers.
+        n_epochs (int): Number of optimization epochs. A cold fit runs 200 to 500. Default 100.
+        learning_rate (float): Initial learning rate of the optimization. Lower values keep the layout closer to the
+            warm start. Default 0.25.
+        **kwargs: Arguments of MCMUmap. fast_correlation has no effect as neighbors are exact.
+
+    After fitting, knn_indices_ and knn_dists_ hold the updated graph, new_samples_ the positions of the samples
+    missing from the previous layout and updated_rows_ the positions of the graph rows that changed.
+    """
+
+    def __init__(self, previous_layout, previous_graph=None, n_epochs=100, learning_rate=0.25, **kwargs):
+        super().__init__(**kwargs)
+        if self.metric not in EXACT_METRICS:
+            raise ValueError(f"Invalid metric '{self.metric}' for an incremental layout. Use one of "
+                             f"{', '.join(EXACT_METRICS)}.")
+        self.previous_layout = previous_layout
+        self.previous_graph = previous_graph
+        self.n_epochs = n_epochs
+        self.learning_rate = learning_rate
+
+    def fit_transform_array(self, matrix, sample_index, copy=True):
+        """
+        Perform the warm started layout on a raw (sample, gene) array.
+
+        Args:
+            matrix (np.ndarray): The gene expression data in (sample, gene) format, ie an np.memmap.
+            sample_index (pd.Index): The sample ids of the matrix rows.
+            copy (bool): Whether the matrix must be left untouched. Default True.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y'.
+        """
+        sample_index = pd.Index(sample_index)
+        expression_scaled = self.scale(matrix, copy=copy)
+        # A standardized matrix is already a working copy, otherwise it may be the caller's matrix
+        rows = prepare_exact_rows(expression_scaled, self.metric, copy=copy and not self.standardize)
+        del expression_scaled
+
+        self.knn_indices_, self.knn_dists_, self.updated_rows_ = self.update_graph(rows, sample_index)
+        del rows
+
+        previous_positions = self.previous_layout.index.get_indexer(sample_index)
+        placed = previous_positions >= 0
+        self.new_samples_ = np.flatnonzero(~placed)
+        embedding = np.zeros((len(sample_index), 2))
+        embedding[placed] = self.previous_layout[["x", "y"]].to_numpy()[previous_positions[placed]]
+        if not placed.any():
+            raise ValueError("No sample of the previous layout is in the matrix, use a cold fit instead.")
+
+        # New samples next to new samples are placed once their neighbors are
+        while not placed.all():
+            pending = np.flatnonzero(~placed)
+            positions, found = neighbor_positions(embedding, placed, self.knn_indices_[pending],
+                                                  self.knn_dists_[pending])
+            if not found.any():
+                embedding[pending] = embedding[placed].mean(axis=0)
+                break
+            embedding[pending[found]] = positions[found]
+            placed[pending[found]] = True
+
+        embedding = self.optimize(embedding, self.knn_indices_, self.knn_dists_)
+        return pd.DataFrame(embedding, index=sample_index, columns=['x', 'y'])
+
+    def update_graph(self, rows, sample_index):
+        """
+        Update the previous kNN graph for the current samples, or build one when there is no usable previous graph.
+
+        Args:
+            rows (np.ndarray): Every sample, prepared with neighbors.prepare_exact_rows.
+            sample_index (pd.Index): The sample ids of the rows.
+
+        Returns:
+            tuple: The (indices, distances) of the graph and the positions of the rows that changed.
+        """
+        n_neighbors = min(self.n_neighbors, len(sample_index))
+        if self.previous_graph is not None and self.previous_graph[1].shape[1] >= n_neighbors:
+            indices, distances, new_rows, stale_rows = remap_knn_graph(self.previous_graph, sample_index, n_neighbors)
+            return update_nearest_neighbors(rows, indices, distances, new_rows, stale_rows, metric=self.metric)
+
+        if self.knn_workers is not None:
+            # Preparing rows is idempotent, so the prepared rows can be searched with the layout's metric
+            indices, distances, _ = self.sharded_neighbors(rows)
+            return indices, distances, np.arange(len(sample_index))
+        indices, distances = nearest_neighbors(rows, n_neighbors, metric="euclidean", random_state=self.random_state)
+        if self.metric != "euclidean":
+            # For unit length rows the squared euclidean distance is twice the cosine or correlation distance
+            distances = np.square(distances) / 2
+        return indices, distances, np.arange(len(sample_index))
+
+    def optimize(self, embedding, indices, distances):
+        """
+        Run UMAP's optimization from a warm start. umap.UMAP rescales an initial embedding to a 10 by 10 box, which
+        would move every sample, so the fuzzy graph is built and optimized with UMAP's own functions instead.
+
+        Args:
+            embedding (np.ndarray): (sample, 2) initial embedding.
+            indices (np.ndarray): (sample, k) kNN graph indices, -1 for no neighbor.
+            distances (np.ndarray): (sample, k) kNN graph distances.
+
+        Returns:
+            np.ndarray: The optimized float32 (sample, 2) embedding.
+        """
+        from sklearn.utils import check_random_state
+        from umap.layouts import optimize_layout_euclidean
+        from umap.umap_ import find_ab_params, fuzzy_simplicial_set, make_epochs_per_sample
+
+        random_state = check_random_state(self.random_state)
+        graph, _, _ = fuzzy_simplicial_set(np.empty((len(indices), 0), dtype=np.float32), indices.shape[1],
+                                           random_state, self.metric, knn_indices=indices,
+                                           knn_dists=distances.astype(np.float32))
+        graph = graph.tocoo()
+        graph.sum_duplicates()
+        # Edges too weak to be sampled during the epochs are dropped, like UMAP does
+        graph.data[graph.data < graph.data.max() / float(max(self.n_epochs, 1))] = 0.0
+        graph.eliminate_zeros()
+
+        a, b = find_ab_params(1.0, self.min_dist)
+        rng_state = random_state.randint(np.iinfo(np.int32).min + 1, np.iinfo(np.int32).max - 1, 3).astype(np.int64)
+        embedding = np.ascontiguousarray(embedding, dtype=np.float32)
+        return optimize_layout_euclidean(embedding, embedding, graph.row, graph.col, self.n_epochs, graph.shape[1],
+                                         make_epochs_per_sample(graph.data, self.n_epochs), a, b, rng_state,
+                                         initial_alpha=self.learning_rate, move_other=True)
@@ -0,0 +1,212 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from preprocessing import center_and_normalize_rows
+from .mcm_umap import MCMUmap
+
+
+def stratified_sample(strata, n_samples, random_state=42):
+    """
+    Draw a sample of rows that keeps the proportions of every stratum. Each stratum gets at least one row when there
+    are at least as many rows to draw as strata, and the remaining rows are allocated by largest remainder.
+
+    Args:
+        strata (pd.DataFrame or pd.Series): Labels of every row, ie the 'compendium' and 'disease' columns. Rows with the
+            same combination of labels form a stratum. Missing labels form their own stratum.
+        n_samples (int): Number of rows to draw.
+        random_state (int): Seed for the draw. Default 42.
+
+    Returns:
+        np.ndarray: Sorted positions of the drawn rows.
+    """
+    if isinstance(strata, pd.Series):
+        strata = strata.to_frame()
+    n_rows = len(strata)
+    if n_samples >= n_rows:
+        return np.arange(n_rows)
+
+    codes = np.zeros(n_rows, dtype=np.int64)
+    for column in strata.columns:
+        column_codes, uniques = pd.factorize(strata[column], use_na_sentinel=False)
+        codes = codes * len(uniques) + column_codes
+    _, codes = np.unique(codes, return_inverse=True)
+    sizes = np.bincount(codes)
+
+    # Proportional allocation with at least one row per stratum, then largest remainder
+    quota = sizes * n_samples / n_rows
+    allocation = np.floor(quota).astype(np.int64)
+    if n_samples >= len(sizes):
+        allocation = np.maximum(allocation, 1)
+    remainder = n_samples - allocation.sum()
+    if remainder > 0:
+        candidates = np.argsort(-(quota - allocation), kind="stable")
+        candidates = candidates[allocation[candidates] < sizes[candidates]]
+        allocation[candidates[:remainder]] += 1
+    elif remainder < 0:
+        largest = np.argsort(-allocation, kind="stable")[:-remainder]
+        allocation[largest] -= 1
+
+    rng = np.random.default_rng(random_state)
+    positions = [rng.choice(np.flatnonzero(codes == code), size=count, replace=False)
+                 for code, count in enumerate(allocation) if count > 0]
+    return np.sort(np.concatenate(positions))
+
+
+def landmark_quality_report(landmark_layout, full_layout, n_neighbors=15):
+    """
+    Compare a landmark layout to a full UMAP fit of the same samples.
+
+    Args:
+        landmark_layout (pd.DataFrame): Layout from MCMLandmarkUmap with 'x' and 'y' columns.
+        full_layout (pd.DataFrame): Layout from a full fit with 'x' and 'y' columns and the same samples.
+        n_neighbors (int): Neighborhood size for the neighbor overlap. Default 15.
+
+    Returns:
+        dict: 'neighbor_overlap' is the mean fraction of each sample's 2D neighbors shared by both layouts and
+            'procrustes_disparity' is the residual after optimally scaling, rotating and reflecting one layout onto the
+            other, from 0 for identical shapes to 1.
+    """
+    from scipy.spatial import cKDTree, procrustes
+
+    full_layout = full_layout.loc[landmark_layout.index]
+    landmark_points = landmark_layout[['x', 'y']].to_numpy()
+    full_points = full_layout[['x', 'y']].to_numpy()
+
+    n_neighbors = min(n_neighbors + 1, len(landmark_points))
+    _, landmark_neighbors = cKDTree(landmark_points).query(landmark_points, k=n_neighbors)
+    _, full_neighbors = cKDTree(full_points).query(full_points, k=n_neighbors)
+    overlap = [len(np.intersect1d(a[1:], b[1:])) for a, b in zip(landmark_neighbors, full_neighbors)]
+
+    _, _, disparity = procrustes(full_points, landmark_points)
+    return {
+        "n_samples": len(landmark_points),
+        "n_neighbors": n_neighbors - 1,
+        "neighbor_overlap": float(np.mean(overlap) / max(n_neighbors - 1, 1)),
+        "procrustes_disparity": float(disparity),
+    }
+
+
+def interpolate_positions(landmark_embedding, neighbors, distances):
+    """
+    Place samples at the weighted mean of the embedding of their nearest landmarks. Weights decay exponentially with
+    the distance beyond the nearest landmark, on the scale of the mean neighbor distance, like UMAP's membership
+    strengths.
+
+    Args:
+        landmark_embedding (np.ndarray): (landmark, 2) embedding of the landmarks.
+        neighbors (np.ndarray): (sample, k) positions of the nearest landmarks of each sample.
+        distances (np.ndarray): (sample, k) distances to those landmarks.
+
+    Returns:
+        np.ndarray: (sample, 2) positions.
+    """
+    offsets = distances - distances[:, :1]
+    scale = np.maximum(offsets.mean(axis=1, keepdims=True), 1e-12)
+    weights = np.exp(-offsets / scale)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.einsum("ik,ikd->id", weights, landmark_embedding[neighbors])
+
+
+class MCMLandmarkUmap(MCMUmap):
+    """
+    UMAP layout for very large compendia. UMAP is fit on a stratified subsample of landmark samples and every other
+    sample is placed afterwards in parallel batches, so time and memory of the expensive fit no longer grow with the
+    full number of samples.
+
+    Remaining samples are placed either by kNN interpolation, a weighted mean of the embedding of their nearest
+    landmarks in expression space, or with UMAP's own transform. Transform is more faithful but slower and is not
+    available with fast_correlation or knn_workers.
+
+    Args:
+        n_landmarks (int): Number of landmark samples. Compendia with fewer samples get a full fit. Default 10000.
+        strata (pd.DataFrame or pd.Series): Labels indexed by sample id to stratify the landmarks by, ie the
+            'compendium' and 'disease' columns of the clinical compendium. Default None, uniform sample.
+        placement (str): 'knn' or 'transform'. Default 'knn'.
+        placement_neighbors (int): Number of landmarks used to place each sample with 'knn'. Default 15.
+        batch_size (int): Number of samples placed per batch. Default 2000.
+        n_jobs (int): Number of threads placing batches. Default None, one per CPU.
+        **kwargs: Arguments of MCMUmap.
+    """
+
+    def __init__(self, n_landmarks=10000, strata=None, placement="knn", placement_neighbors=15, batch_size=2000,
+                 n_jobs=None, **kwargs):
+        super().__init__(**kwargs)
+        if placement not in ("knn", "transform"):
+            raise ValueError(f"Invalid placement '{placement}'. Use 'knn' or 'transform'.")
+        if placement == "transform" and self.fast_correlation:
+            raise ValueError("placement='transform' is not available with fast_correlation.")
+        if placement == "transform" and self.knn_workers is not None:
+            raise ValueError("placement='transform' is not available with knn_workers, UMAP keeps no search index for a "
+                             "precomputed kNN graph.")
+        self.n_landmarks = n_landmarks
+        self.strata = strata
+        self.placement = placement
+        self.placement_neighbors = placement_neighbors
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def fit_transform_array(self, matrix, sample_index, copy=True):
+        """
+        Perform landmark UMAP on a raw (sample, gene) array.
+
+        Args:
+            matrix (np.ndarray or scipy.sparse.spmatrix): The gene expression data in (sample, gene) format, ie an
+                np.memmap or a CSR matrix.
+            sample_index (pd.Index): The sample ids of the matrix rows.
+            copy (bool): Whether the matrix must be left untouched. Default True.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y'. The positions of the landmarks are
+                stored in the landmarks_ attribute.
+        """
+        if matrix.shape[0] <= self.n_landmarks:
+            self.landmarks_ = np.arange(matrix.shape[0])
+            return super().fit_transform_array(matrix, sample_index, copy=copy)
+
+        expression_scaled = self.scale(matrix, copy=copy)
+
+        # Correlation neighbors can be found with a euclidean search once samples are normalized
+        search_metric = self.metric
+        if self.fast_correlation and self.metric == "correlation":
+            must_copy = copy or not expression_scaled.flags["WRITEABLE"]
+            if not self.standardize and must_copy and np.shares_memory(expression_scaled, matrix):
+                expression_scaled = expression_scaled.copy()
+            center_and_normalize_rows(expression_scaled)
+            search_metric = "euclidean"
+
+        # Fit UMAP on the landmarks
+        if self.strata is None:
+            strata = pd.Series(0, index=sample_index)
+        else:
+            strata = self.strata.reindex(sample_index)
+        self.landmarks_ = stratified_sample(strata, self.n_landmarks, random_state=self.random_state)
+        landmark_matrix = expression_scaled[self.landmarks_]
+        landmark_embedding, reducer = self.embed(landmark_matrix, copy=False)
+        # The graph of the landmark fit does not cover every sample
+        self.knn_indices_ = self.knn_dists_ = None
+
+        # Place the remaining samples in parallel batches
+        embedding = np.empty((matrix.shape[0], 2), dtype=np.float32)
+        embedding[self.landmarks_] = landmark_embedding
+        remaining = np.setdiff1d(np.arange(matrix.shape[0]), self.landmarks_)
+        batches = [remaining[start:start + self.batch_size] for start in range(0, len(remaining), self.batch_size)]
+
+        if self.placement == "transform":
+            def place(batch):
+                return reducer.transform(expression_scaled[batch])
+        else:
+            from pynndescent import NNDescent
+            index = NNDescent(landmark_matrix, n_neighbors=min(self.placement_neighbors, len(landmark_matrix)),
+                              metric=search_metric, random_state=self.random_state)
+            index.prepare()
+
+            def place(batch):
+                neighbors, distances = index.query(expression_scaled[batch], k=self.placement_neighbors)
+                return interpolate_positions(landmark_embedding, neighbors, distances)
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            for batch, positions in zip(batches, executor.map(place, batches)):
+                embedding[batch] = positions
+
+        return pd.DataFrame(embedding, index=sample_index, columns=['x', 'y'])
+
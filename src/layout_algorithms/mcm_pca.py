@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from scipy import linalg
+from preprocessing import auto_block_size, iter_row_blocks, column_moments
+from .base_layout import BaseLayout
+
+def randomized_pca(matrix, n_components=2, standardize=True, block_size=None, n_oversamples=10, n_iter=4,
+                   random_state=42):
+    """
+    Randomized truncated SVD (Halko et al.) of the centered, optionally standardized, matrix. Centering and scaling are
+    applied implicitly inside the matrix products, and every product streams over blocks of rows, so the input is never
+    copied as a whole. This makes it usable on memmapped matrices larger than RAM. The matrix is read
+    2 * n_iter + 3 times.
+
+    Args:
+        matrix (np.ndarray): The matrix in (sample, gene) format. Can be an np.memmap.
+        n_components (int): Number of principal components. Default 2.
+        standardize (bool): Scale genes to unit variance before the decomposition, like StandardScaler. Default True.
+        block_size (int): Number of rows per block. Default None, chosen from the number of genes.
+        n_oversamples (int): Extra random vectors used to improve the approximation. Default 10.
+        n_iter (int): Number of power iterations. Default 4.
+        random_state (int): Seed of the random projection. Default 42.
+
+    Returns:
+        tuple: (scores, components, mean, scale, singular_values). Scores are the (sample, component) coordinates,
+            components are (component, gene) loadings in the scaled space, and mean and scale are the per gene
+            centering and scaling that were applied.
+    """
+    # sklearn takes about a second to import and is only needed for the sign convention
+    from sklearn.utils.extmath import svd_flip
+
+    n_samples, n_features = matrix.shape
+    block_size = block_size or auto_block_size(n_features)
+    n_random = min(n_components + n_oversamples, n_samples, n_features)
+
+    mean, scale = column_moments(matrix, block_size)
+    if standardize:
+        # Like StandardScaler, genes with zero variance are left unscaled
+        scale[scale == 0] = 1.0
+    else:
+        scale = np.ones(n_features)
+    inverse_scale = 1.0 / scale
+
+    def project(basis):
+        # (X - mean) / scale @ basis, computed blockwise
+        scaled_basis = basis * inverse_scale[:, None]
+        shift = mean @ scaled_basis
+        result = np.empty((n_samples, basis.shape[1]))
+        for rows, block in iter_row_blocks(matrix, block_size):
+            result[rows] = block @ scaled_basis - shift
+        return result
+
+    def project_transpose(basis):
+        # ((X - mean) / scale).T @ basis, computed blockwise
+        result = np.zeros((n_features, basis.shape[1]))
+        for rows, block in iter_row_blocks(matrix, block_size):
+            result += block.T @ basis[rows]
+        result -= np.outer(mean, basis.sum(axis=0))
+        return result * inverse_scale[:, None]
+
+    rng = np.random.default_rng(random_state)
+    sample_basis = project(rng.standard_normal((n_features, n_random)))
+    for _ in range(n_iter):
+        sample_basis, _ = linalg.qr(sample_basis, mode="economic")
+        gene_basis, _ = linalg.qr(project_transpose(sample_basis), mode="economic")
+        sample_basis = project(gene_basis)
+    sample_basis, _ = linalg.qr(sample_basis, mode="economic")
+
+    small_u, singular_values, components = linalg.svd(project_transpose(sample_basis).T, full_matrices=False)
+    u, components = svd_flip(sample_basis @ small_u, components)
+
+    scores = u[:, :n_components] * singular_values[:n_components]
+    return scores, components[:n_components], mean, scale, singular_values[:n_components]
+
+
+class MCMPca(BaseLayout):
+    """
+    Linear layout from the first two principal components, computed with a streaming randomized SVD. This is much faster
+    than UMAP on large compendia and works on memmapped input, ie a DataFrame wrapping an np.memmap.
+
+    Args:
+        standardize (bool): Scale genes to unit variance before the decomposition. Default True.
+        block_size (int): Number of rows per block. Default None, chosen from the number of genes.
+        n_iter (int): Number of power iterations. Default 4.
+        random_state (int): Seed of the random projection. Default 42.
+    """
+
+    def __init__(self, standardize=True, block_size=None, n_iter=4, random_state=42):
+        self.standardize = standardize
+        self.block_size = block_size
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def fit_transform(self, expression_df):
+        """
+        Perform the PCA layout algorithm on the given dataframe.
+
+        Args:
+            expression_df (pd.DataFrame): The gene expression data. All columns should be genes and all rows should be
+                samples. The index should be the sample ids. There should be no missing values ie no NaNs. All samples
+                should have the same genes.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y', the scores of the first two
+                principal components.
+        """
+        return self.fit_transform_array(expression_df.to_numpy(), expression_df.index)
+
+    def fit_transform_array(self, matrix, sample_index, copy=True):
+        """
+        Perform the PCA layout algorithm on a raw (sample, gene) array. The matrix is only read in row blocks, so it is
+        never copied or modified regardless of copy.
+
+        Args:
+            matrix (np.ndarray): The gene expression data in (sample, gene) format, ie an np.memmap.
+            sample_index (pd.Index): The sample ids of the matrix rows.
+            copy (bool): Unused, the matrix is never modified.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y'.
+        """
+        scores, self.components_, self.mean_, self.scale_, self.singular_values_ = randomized_pca(
+            matrix, n_components=2, standardize=self.standardize, block_size=self.block_size, n_iter=self.n_iter,
+            random_state=self.random_state)
+
+        return pd.DataFrame(scores, index=sample_index, columns=['x', 'y'])
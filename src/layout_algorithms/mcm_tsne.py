@@ -0,0 +1,143 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from preprocessing import standardize_matrix
+from neighbors import cached_nearest_neighbors, matrix_fingerprint
+from .base_layout import BaseLayout
+from .mcm_pca import randomized_pca
+
+class MCMTsne(BaseLayout):
+    """
+    t-SNE layout algorithm for large compendia using openTSNE. Negative gradients use FFT accelerated interpolation and
+    affinities are built from an approximate kNN graph, so the cost grows roughly linearly with the number of samples.
+
+    Affinities are cached per perplexity, both on the instance and in cache_dir when given. Runs that only change the
+    exaggeration schedule reuse the affinity matrix, and runs with a new perplexity reuse the cached kNN graph as long
+    as it has at least 3 * perplexity neighbors. After fitting, knn_indices_ holds the kNN graph the affinities were built
+    from, or None when the affinities came from a cache.
+
+    Args:
+        perplexity (float): Effective number of neighbors of each sample. Default 30.
+        early_exaggeration (float): Exaggeration during the early exaggeration phase. Default 12.
+        early_exaggeration_iter (int): Number of early exaggeration iterations. Default 250.
+        exaggeration (float): Exaggeration after the early phase. Values above 1 give more compact clusters. Default 1.
+        n_iter (int): Number of iterations after the early phase. Default 500.
+        metric (str): Distance metric used in the expression space. Default 'correlation'.
+        standardize (bool): Whether to standardize each gene before computing affinities. Default True.
+        cache_dir (str): Directory for cached kNN graphs and affinities. Default None, cache on the instance only.
+        random_state (int): Seed for reproducible layouts. Default 42.
+        n_jobs (int): Number of threads. Default -1, all CPUs.
+    """
+
+    def __init__(self, perplexity=30, early_exaggeration=12, early_exaggeration_iter=250, exaggeration=1, n_iter=500,
+                 metric="correlation", standardize=True, cache_dir=None, random_state=42, n_jobs=-1):
+        self.perplexity = perplexity
+        self.early_exaggeration = early_exaggeration
+        self.early_exaggeration_iter = early_exaggeration_iter
+        self.exaggeration = exaggeration
+        self.n_iter = n_iter
+        self.metric = metric
+        self.standardize = standardize
+        self.cache_dir = cache_dir
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self._affinities = {}
+
+    def affinities(self, matrix, fingerprint=None):
+        """
+        Get the symmetric t-SNE affinity matrix P for the data, from the cache if possible.
+
+        Args:
+            matrix (np.ndarray): Data in (sample, feature) format, already standardized if required.
+            fingerprint (str): Precomputed neighbors.matrix_fingerprint of the matrix. Default None, computed here.
+
+        Returns:
+            sparse.csr_matrix: Affinities normalized to sum to 1.
+        """
+        from openTSNE.affinity import joint_probabilities_nn
+
+        fingerprint = fingerprint or matrix_fingerprint(matrix)
+        key = (fingerprint, self.metric, float(self.perplexity))
+        if key in self._affinities:
+            return self._affinities[key]
+
+        cache_path = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir,
+                                      f"affinities-{self.metric}-{float(self.perplexity):g}-{fingerprint}.npz")
+            if os.path.exists(cache_path):
+                logging.info(f"Reusing cached affinities {os.path.basename(cache_path)}")
+                self._affinities[key] = sparse.load_npz(cache_path).tocsr()
+                return self._affinities[key]
+
+        # openTSNE uses 3 * perplexity neighbors, not counting the sample itself
+        n_neighbors = min(matrix.shape[0] - 1, int(np.ceil(3 * self.perplexity))) + 1
+        indices, distances = cached_nearest_neighbors(matrix, n_neighbors, metric=self.metric,
+                                                      cache_dir=self.cache_dir, random_state=self.random_state,
+                                                      fingerprint=fingerprint)
+        self.knn_indices_ = indices
+        effective_perplexity = min(self.perplexity, (n_neighbors - 1) / 3)
+        P = joint_probabilities_nn(indices[:, 1:], distances[:, 1:], [effective_perplexity], symmetrize=True,
+                                   normalization="pair-wise", n_jobs=self.n_jobs)
+
+        if cache_path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            sparse.save_npz(cache_path, P)
+        self._affinities[key] = P
+        return P
+
+    def fit_transform(self, expression_df):
+        """
+        Perform t-SNE layout algorithm on the given dataframe.
+
+        Args:
+            expression_df (pd.DataFrame): The gene expression data. All columns should be genes and all rows should be
+                samples. The index should be the sample ids. There should be no missing values ie no NaNs. All samples
+                should have the same genes.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y' representing the coordinates of the
+                t-SNE embedding.
+        """
+        return self.fit_transform_array(expression_df.to_numpy(), expression_df.index)
+
+    def fit_transform_array(self, matrix, sample_index, copy=True):
+        """
+        Perform t-SNE layout algorithm on a raw (sample, gene) array. The matrix is standardized straight into float32
+        in blocks, in place when copy is False and the matrix is a writable C-contiguous float32 array.
+
+        Args:
+            matrix (np.ndarray): The gene expression data in (sample, gene) format, ie an np.memmap.
+            sample_index (pd.Index): The sample ids of the matrix rows.
+            copy (bool): Whether the matrix must be left untouched. Default True.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y'.
+        """
+        from openTSNE import TSNEEmbedding
+        from openTSNE.affinity import PrecomputedAffinities
+
+        self.knn_indices_ = None
+
+        # Standardize expression data
+        if self.standardize:
+            matrix = standardize_matrix(matrix, copy=copy, dtype=np.float32)
+        else:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+        P = self.affinities(matrix)
+
+        # Initialize from the first two principal components, rescaled to a small spread as recommended for t-SNE
+        init, *_ = randomized_pca(matrix, n_components=2, standardize=False, random_state=self.random_state)
+        init = init / np.std(init[:, 0]) * 1e-4
+
+        embedding = TSNEEmbedding(init, PrecomputedAffinities(P, normalize=False), negative_gradient_method="fft",
+                                  learning_rate="auto", random_state=self.random_state, n_jobs=self.n_jobs)
+        embedding.optimize(n_iter=self.early_exaggeration_iter, exaggeration=self.early_exaggeration, momentum=0.5,
+                           inplace=True)
+        embedding.optimize(n_iter=self.n_iter, exaggeration=self.exaggeration, momentum=0.8, inplace=True)
+
+        # Convert the embedding to a DataFrame
+        return pd.DataFrame(np.asarray(embedding), index=sample_index, columns=['x', 'y'])
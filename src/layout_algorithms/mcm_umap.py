@@ -1,9 +1,48 @@
-from sklearn.preprocessing import StandardScaler
+import warnings
+import numpy as np
 import pandas as pd
-import umap
+from scipy import sparse as sp
+from preprocessing import standardize_matrix, center_and_normalize_rows, scale_sparse_columns
+from neighbors import EXACT_METRICS, nearest_neighbors, sharded_nearest_neighbors
 from .base_layout import BaseLayout
 
 class MCMUmap(BaseLayout):
+    """
+    UMAP layout algorithm for multi-compendia expression data.
+
+    Args:
+        n_neighbors (int): Size of the local neighborhood used by UMAP. Default 15.
+        min_dist (float): Minimum distance between embedded points. Default 0.1.
+        metric (str): Distance metric used in the expression space. Default 'correlation'.
+        random_state (int): Seed for reproducible layouts. Default 42.
+        standardize (bool): Whether to standardize each gene before running UMAP. Set to False when the data was already
+            standardized, ie once for a whole compendium before laying out subsets of it. Default True.
+        fast_correlation (bool): Only used with the correlation metric. Center and L2 normalize every sample once and
+            find neighbors with a euclidean search instead of recomputing the centering and norms inside every
+            correlation distance evaluation. The euclidean distances are converted back to correlation distances
+            before UMAP builds its graph, so the result is equivalent. Not available for sparse input. Default False.
+        knn_workers (int): Find exact neighbors with neighbors.sharded_nearest_neighbors, splitting the samples across
+            this many worker processes, -1 for one per CPU. Only for the euclidean, cosine and correlation metrics and
+            not available for sparse input. Default None, UMAP's approximate NN-descent search.
+
+    After fitting, knn_indices_ and knn_dists_ hold the expression space kNN graph UMAP built, with each sample in its
+    own row, or None when UMAP computed all pairwise distances instead (fewer than 4096 samples).
+
+    Sparse input, ie from process_expression_compendium_sparse, stays sparse end to end. Genes are then only scaled to
+    unit variance and not centered, like StandardScaler(with_mean=False), so zeros stay zeros.
+    """
+
+    def __init__(self, n_neighbors=15, min_dist=0.1, metric="correlation", random_state=42, standardize=True,
+                 fast_correlation=False, knn_workers=None):
+        self.n_neighbors = n_neighbors
+        self.min_dist = min_dist
+        self.metric = metric
+        self.random_state = random_state
+        self.standardize = standardize
+        self.fast_correlation = fast_correlation
+        self.knn_workers = knn_workers
+        if knn_workers is not None and metric not in EXACT_METRICS:
+            raise ValueError(f"Invalid metric '{metric}' for knn_workers. Use one of {', '.join(EXACT_METRICS)}.")
 
     def fit_transform(self, expression_df):
         """
@@ -13,23 +52,125 @@ class MCMUmap(BaseLayout):
         Args:
             expression_df (pd.DataFrame): The gene expression data. All columns should be genes and all rows should be
                 samples. The index should be the sample ids. There should be no missing values ie no NaNs. All samples
-                should have the same genes.
+                should have the same genes. Dataframes with sparse columns are passed to UMAP as a sparse matrix.
 
         Returns:
             pd.DataFrame: This dataframe should have dimension 2. Sample Ids are the index and the columns are 'UMAP1'
                 and 'UMAP2' representing the x and y coordinates of the UMAP embedding.
 
         """
+        if len(expression_df.columns) and all(isinstance(dtype, pd.SparseDtype) for dtype in expression_df.dtypes):
+            return self.fit_transform_array(expression_df.sparse.to_coo().tocsr(), expression_df.index)
+        return self.fit_transform_array(expression_df.to_numpy(), expression_df.index)
 
-        # Standardize expression data
-        scaler = StandardScaler()
-        expression_scaled = scaler.fit_transform(expression_df)
+    def fit_transform_array(self, matrix, sample_index, copy=True):
+        """
+        Perform UMAP layout algorithm on a raw (sample, gene) array. UMAP works in float32, so the matrix is
+        standardized straight into float32 in blocks. A writable C-contiguous float32 matrix passed with copy=False is
+        standardized in place and handed to UMAP without any copy.
 
-        # Perform UMAP dimensionality reduction
-        reducer = umap.UMAP(n_components=2, n_neighbors=15, min_dist=0.1, metric="correlation", random_state=42)
-        embedding = reducer.fit_transform(expression_scaled)
+        Args:
+            matrix (np.ndarray or scipy.sparse.spmatrix): The gene expression data in (sample, gene) format, ie an
+                np.memmap or a CSR matrix.
+            sample_index (pd.Index): The sample ids of the matrix rows.
+            copy (bool): Whether the matrix must be left untouched. Default True.
+
+        Returns:
+            pd.DataFrame: Sample Ids are the index and the columns are 'x' and 'y'.
+        """
+        expression_scaled = self.scale(matrix, copy=copy)
+
+        # A standardized matrix is already a working copy, or may be modified when copy is False
+        embedding, _ = self.embed(expression_scaled, copy=copy and not self.standardize)
 
         # Convert the embedding to a DataFrame
-        embedding_df = pd.DataFrame(embedding, index=expression_df.index, columns=['x', 'y'])
+        embedding_df = pd.DataFrame(embedding, index=sample_index, columns=['x', 'y'])
 
         return embedding_df
+
+    def scale(self, matrix, copy=True):
+        """
+        Standardize the expression data if required and convert it to the float32 format UMAP works in.
+
+        Args:
+            matrix (np.ndarray or scipy.sparse.spmatrix): The gene expression data in (sample, gene) format.
+            copy (bool): Whether the matrix must be left untouched. Default True.
+
+        Returns:
+            np.ndarray or scipy.sparse.csr_matrix: C-contiguous float32 data, or a float32 CSR matrix for sparse input.
+        """
+        if sp.issparse(matrix):
+            if self.fast_correlation or self.knn_workers is not None:
+                raise ValueError("fast_correlation and knn_workers are not available for sparse input.")
+            if self.standardize:
+                return scale_sparse_columns(matrix, dtype=np.float32)
+            return sp.csr_matrix(matrix, dtype=np.float32)
+        if self.standardize:
+            return standardize_matrix(matrix, copy=copy, dtype=np.float32)
+        return np.ascontiguousarray(matrix, dtype=np.float32)
+
+    def embed(self, expression_scaled, copy=True):
+        """
+        Run UMAP on data that was already standardized if required.
+
+        Args:
+            expression_scaled (np.ndarray or scipy.sparse.csr_matrix): float32 data in (sample, gene) format as returned
+                by scale.
+            copy (bool): Whether the data must be left untouched. Default True.
+
+        Returns:
+            tuple: The (sample, 2) embedding array and the fitted umap.UMAP reducer.
+        """
+        # umap is imported here because importing it compiles numba functions, which takes seconds
+        import umap
+
+        precomputed_knn = (None, None, None)
+        if self.knn_workers is not None:
+            precomputed_knn = self.sharded_neighbors(expression_scaled)
+        elif self.fast_correlation and self.metric == "correlation":
+            precomputed_knn = self.correlation_neighbors(expression_scaled, copy=copy)
+
+        # Perform UMAP dimensionality reduction
+        reducer = umap.UMAP(n_components=2, n_neighbors=self.n_neighbors, min_dist=self.min_dist, metric=self.metric,
+                            random_state=self.random_state, precomputed_knn=precomputed_knn)
+        with warnings.catch_warnings():
+            # Precomputed neighbors come without a search index, so the reducer cannot transform new data
+            warnings.filterwarnings("ignore", message=".*knn_search_index.*")
+            embedding = reducer.fit_transform(expression_scaled)
+        self.knn_indices_ = getattr(reducer, "_knn_indices", None)
+        self.knn_dists_ = getattr(reducer, "_knn_dists", None)
+
+        return embedding, reducer
+
+    def correlation_neighbors(self, matrix, copy=True):
+        """
+        Find the correlation neighbors of every sample with a euclidean search over centered, L2 normalized rows.
+
+        Args:
+            matrix (np.ndarray): C-contiguous float32 data in (sample, gene) format.
+            copy (bool): Whether the matrix must be left untouched. When False the rows are normalized in place.
+                Default True.
+
+        Returns:
+            tuple: (indices, distances, None) in the precomputed_knn format of umap.UMAP, with correlation distances.
+        """
+        normalized = center_and_normalize_rows(matrix.copy() if copy else matrix)
+        indices, distances = nearest_neighbors(normalized, self.n_neighbors, metric="euclidean",
+                                               random_state=self.random_state)
+        # For unit length, centered rows the squared euclidean distance is twice the correlation distance
+        return indices, np.square(distances) / 2, None
+
+    def sharded_neighbors(self, matrix):
+        """
+        Find the exact neighbors of every sample with a brute force search sharded across knn_workers processes.
+
+        Args:
+            matrix (np.ndarray): C-contiguous float32 data in (sample, gene) format. It is left untouched.
+
+        Returns:
+            tuple: (indices, distances, None) in the precomputed_knn format of umap.UMAP.
+        """
+        n_workers = None if self.knn_workers == -1 else self.knn_workers
+        indices, distances = sharded_nearest_neighbors(matrix, self.n_neighbors, metric=self.metric,
+                                                       n_workers=n_workers)
+        return indices, distances, None
@@ -0,0 +1,305 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+from preprocessing import auto_block_size, column_moments, center_and_normalize_rows
+
+"""
+Quantitative quality metrics for 2D layouts of a compendium, so parameter sweeps and layout engines can be compared by
+numbers instead of by eye. Expression space distances are correlation distances between standardized samples, the space
+the UMAP and t-SNE layouts work in, so every engine is judged against the same reference.
+
+No full pairwise distance matrix is built. Metrics that need expression space ranks are computed exactly for a
+stratified sample of query samples, whose correlations to every sample are computed in batches while the matrix is
+streamed block by block. kNN preservation reuses the expression space kNN graph of the layout when it exposes one, ie
+MCMUmap.knn_indices_, and 2D neighbors come from a KD-tree.
+
+Functions:
+    embedding_metrics(matrix: np.ndarray, layout_df: pd.DataFrame, labels_df: pd.DataFrame, n_neighbors: int,
+                      knn_indices: np.ndarray, standardize: bool, n_queries: int, batch_size: int,
+                      random_state: int) -> dict:
+        Compute every metric for a layout.
+
+    trustworthiness_from_ranks(ranks: np.ndarray, n_neighbors: int, n_samples: int) -> float:
+        Trustworthiness from the expression space ranks of 2D neighbors.
+
+    neighbor_preservation(high_neighbors: np.ndarray, low_neighbors: np.ndarray) -> float:
+        Mean fraction of expression space neighbors kept in 2D.
+
+    label_mixing(labels: pd.Series, low_neighbors: np.ndarray, alpha: float) -> dict:
+        Entropy and kBET style acceptance of label mixing in 2D neighborhoods.
+
+    label_silhouette(points: np.ndarray, labels: pd.Series, queries: np.ndarray, batch_size: int) -> dict:
+        Silhouette of labels in 2D for a sample of query points.
+
+    write_metrics(file_path: str, metrics: dict, layout_algorithm: BaseLayout):
+        Write metrics and the parameters of the layout algorithm to a JSON file.
+"""
+
+
+def _without_self(indices, n_neighbors):
+    """
+    Drop each sample from its own neighbor list and keep n_neighbors columns. Duplicated samples may not list
+    themselves first, so self matches are moved to the end rather than assumed to be in the first column.
+    """
+    is_self = indices == np.arange(len(indices))[:, None]
+    order = np.argsort(is_self, axis=1, kind="stable")
+    return np.take_along_axis(indices, order, axis=1)[:, :n_neighbors]
+
+
+def trustworthiness_from_ranks(ranks, n_neighbors, n_samples):
+    """
+    Trustworthiness (Venna and Kaski) from the expression space ranks of the 2D neighbors of each query. 2D neighbors
+    that are not expression space neighbors are penalized by how far down the expression space ranking they are. 1 means
+    every 2D neighbor is a true neighbor.
+
+    Args:
+        ranks (np.ndarray): (query, n_neighbors) expression space rank of each 2D neighbor, 1 for the nearest sample.
+        n_neighbors (int): Neighborhood size.
+        n_samples (int): Number of samples in the compendium.
+
+    Returns:
+        float: Trustworthiness between 0 and 1.
+    """
+    penalty = np.maximum(ranks - n_neighbors, 0).sum()
+    normalization = len(ranks) * n_neighbors * (2 * n_samples - 3 * n_neighbors - 1)
+    return float(1 - 2 * penalty / max(normalization, 1))
+
+
+def neighbor_preservation(high_neighbors, low_neighbors):
+    """
+    Mean fraction of each sample's expression space neighbors that are also among its 2D neighbors.
+
+    Args:
+        high_neighbors (np.ndarray): (sample, k) expression space neighbors without the sample itself. Negative entries
+            mark missing neighbors, as in UMAP's disconnected vertices.
+        low_neighbors (np.ndarray): (sample, k) 2D neighbors of the same samples.
+
+    Returns:
+        float: Neighbor preservation between 0 and 1.
+    """
+    n_neighbors = low_neighbors.shape[1]
+    shared = (high_neighbors[:, :, None] == low_neighbors[:, None, :]).any(axis=2) & (high_neighbors >= 0)
+    return float(shared.sum(axis=1).mean() / max(n_neighbors, 1))
+
+
+def label_mixing(labels, low_neighbors, alpha=0.05):
+    """
+    How well labels, ie compendia, are mixed in 2D neighborhoods. The entropy of the labels of each sample's neighbors
+    is normalized by the entropy of a perfectly uniform mix. The kBET style test compares each neighborhood's label
+    counts to the global label frequencies with a chi-squared test; well mixed layouts accept most neighborhoods.
+
+    Args:
+        labels (pd.Series): Label of every sample, in layout order. Samples with missing labels are skipped.
+        low_neighbors (np.ndarray): (sample, k) 2D neighbors without the sample itself.
+        alpha (float): Significance level of the chi-squared test. Default 0.05.
+
+    Returns:
+        dict: 'entropy' (mean normalized neighborhood entropy), 'kbet_acceptance' (fraction of neighborhoods matching
+            the global frequencies) and 'per_label' (mean entropy around the samples of each label).
+    """
+    from scipy.stats import chi2
+
+    codes, uniques = pd.factorize(labels)
+    if len(uniques) < 2:
+        return {"entropy": None, "kbet_acceptance": None, "per_label": {}}
+
+    labelled = codes >= 0
+    neighbor_codes = codes[low_neighbors[labelled]]
+    counts = np.zeros((len(neighbor_codes), len(uniques)))
+    rows = np.repeat(np.arange(len(neighbor_codes)), neighbor_codes.shape[1])
+    valid = neighbor_codes.ravel() >= 0
+    np.add.at(counts, (rows[valid], neighbor_codes.ravel()[valid]), 1)
+    totals = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+    frequencies = counts / totals
+    with np.errstate(divide="ignore", invalid="ignore"):
+        entropy = -np.where(frequencies > 0, frequencies * np.log(frequencies), 0).sum(axis=1) / np.log(len(uniques))
+
+    expected = totals * np.bincount(codes[labelled], minlength=len(uniques)) / labelled.sum()
+    statistic = (np.square(counts - expected) / expected).sum(axis=1)
+    p_values = chi2.sf(statistic, df=len(uniques) - 1)
+
+    sample_codes = codes[labelled]
+    return {
+        "entropy": float(entropy.mean()),
+        "kbet_acceptance": float((p_values >= alpha).mean()),
+        "per_label": {str(label): float(entropy[sample_codes == code].mean()) for code, label in enumerate(uniques)},
+    }
+
+
+def label_silhouette(points, labels, queries, batch_size=256):
+    """
+    Silhouette of labels, ie diseases, in 2D for a sample of query points. Distances from each batch of queries to every
+    point are reduced to per label means with a matrix product, so only a (batch, sample) block is held at once.
+
+    Args:
+        points (np.ndarray): (sample, 2) layout positions.
+        labels (pd.Series): Label of every sample, in layout order. Samples with missing labels are skipped.
+        queries (np.ndarray): Positions of the query samples.
+        batch_size (int): Number of queries per batch. Default 256.
+
+    Returns:
+        dict: 'mean' (mean silhouette of the labelled queries) and 'per_label' (mean silhouette of the queries of each
+            label). Labels with one sample have a silhouette of 0.
+    """
+    codes, uniques = pd.factorize(labels)
+    if len(uniques) < 2:
+        return {"mean": None, "per_label": {}}
+
+    labelled = codes >= 0
+    label_points = points[labelled]
+    one_hot = np.zeros((labelled.sum(), len(uniques)))
+    one_hot[np.arange(len(one_hot)), codes[labelled]] = 1
+    sizes = one_hot.sum(axis=0)
+
+    queries = queries[labelled[queries]]
+    silhouettes = np.empty(len(queries))
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        distances = np.sqrt(np.square(points[batch, None, :] - label_points[None, :, :]).sum(axis=2))
+        mean_distances = distances @ one_hot
+        own = codes[batch]
+        rows = np.arange(len(batch))
+        # The query itself is at distance 0 in its own label
+        own_sizes = sizes[own] - 1
+        within = mean_distances[rows, own] / np.maximum(own_sizes, 1)
+        mean_distances /= sizes
+        mean_distances[rows, own] = np.inf
+        nearest_other = mean_distances.min(axis=1)
+        silhouette = (nearest_other - within) / np.maximum(np.maximum(within, nearest_other), 1e-12)
+        silhouettes[start:start + len(batch)] = np.where(own_sizes > 0, silhouette, 0)
+
+    query_codes = codes[queries]
+    return {
+        "mean": float(silhouettes.mean()),
+        "per_label": {str(label): float(silhouettes[query_codes == code].mean())
+                      for code, label in enumerate(uniques) if (query_codes == code).any()},
+    }
+
+
+def _expression_ranks(matrix, queries, low_neighbors, n_neighbors, standardize, batch_size):
+    """
+    Expression space ranks of the 2D neighbors of each query, and the exact expression space neighbors of each query.
+    Correlations of a batch of queries to every sample are computed block by block, then sorted per query.
+    """
+    block_size = auto_block_size(matrix.shape[1])
+    if standardize:
+        mean, scale = column_moments(matrix, block_size)
+        scale[scale == 0] = 1.0
+    else:
+        mean, scale = np.zeros(matrix.shape[1]), np.ones(matrix.shape[1])
+    mean, scale = mean.astype(np.float32), scale.astype(np.float32)
+
+    def normalized(rows):
+        block = matrix[rows].toarray() if sp.issparse(matrix) else matrix[rows]
+        return center_and_normalize_rows((np.asarray(block, dtype=np.float32) - mean) / scale)
+
+    ranks = np.empty((len(queries), low_neighbors.shape[1]), dtype=np.int64)
+    high_neighbors = np.empty((len(queries), n_neighbors), dtype=np.int64)
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        query_rows = normalized(batch)
+        similarities = np.empty((len(batch), matrix.shape[0]), dtype=np.float32)
+        for block_start in range(0, matrix.shape[0], block_size):
+            rows = slice(block_start, min(block_start + block_size, matrix.shape[0]))
+            similarities[:, rows] = query_rows @ normalized(rows).T
+        similarities[np.arange(len(batch)), batch] = -np.inf
+
+        order = np.argsort(-similarities, axis=1, kind="stable")
+        high_neighbors[start:start + len(batch)] = order[:, :n_neighbors]
+        sorted_similarities = -np.take_along_axis(similarities, order, axis=1)
+        neighbor_similarities = -np.take_along_axis(similarities, low_neighbors[batch], axis=1)
+        for row in range(len(batch)):
+            ranks[start + row] = np.searchsorted(sorted_similarities[row], neighbor_similarities[row], side="left") + 1
+    return ranks, high_neighbors
+
+
+def embedding_metrics(matrix, layout_df, labels_df=None, n_neighbors=15, knn_indices=None, standardize=True,
+                      n_queries=2000, batch_size=256, random_state=42):
+    """
+    Compute quality metrics of a 2D layout: trustworthiness, kNN preservation, mixing of compendia and silhouette of
+    diseases.
+
+    Args:
+        matrix (np.ndarray or scipy.sparse.spmatrix): Expression data in (sample, gene) format, in layout order. It is
+            not modified.
+        layout_df (pd.DataFrame): Layout with 'x' and 'y' columns, indexed by sample id.
+        labels_df (pd.DataFrame): Clinical labels indexed by sample id, ie with 'compendium' and 'disease' columns.
+            Default None, no label metrics.
+        n_neighbors (int): Neighborhood size, not counting the sample itself. Default 15.
+        knn_indices (np.ndarray): Expression space kNN graph of the layout, (sample, k) with each sample in its own row
+            as in neighbors.nearest_neighbors. kNN preservation is then computed over every sample. Default None,
+            computed exactly for the query samples.
+        standardize (bool): Whether to standardize genes first. Set to False when the matrix was already standardized
+            in place by the layout. Default True.
+        n_queries (int): Number of query samples for trustworthiness, silhouette and, without a graph, kNN
+            preservation. Queries are stratified by the labels. Default 2000.
+        batch_size (int): Number of queries per batch. Default 256.
+        random_state (int): Seed for the query sample. Default 42.
+
+    Returns:
+        dict: The metrics, with None for metrics that do not apply.
+    """
+    from scipy.spatial import cKDTree
+    from layout_algorithms.landmark_umap import stratified_sample
+
+    start_time = time.time()
+    n_samples = matrix.shape[0]
+    n_neighbors = min(n_neighbors, n_samples - 1)
+    points = layout_df[['x', 'y']].to_numpy(dtype=np.float64)
+
+    _, low_neighbors = cKDTree(points).query(points, k=n_neighbors + 1)
+    low_neighbors = _without_self(low_neighbors.reshape(n_samples, -1), n_neighbors)
+
+    if labels_df is None:
+        labels_df = pd.DataFrame(index=layout_df.index)
+    labels_df = labels_df.reindex(layout_df.index)
+    strata = [column for column in ("compendium", "disease") if column in labels_df]
+    strata_df = labels_df[strata] if strata else pd.Series(0, index=layout_df.index)
+    queries = stratified_sample(strata_df, n_queries, random_state=random_state)
+
+    ranks, query_neighbors = _expression_ranks(matrix, queries, low_neighbors, n_neighbors, standardize, batch_size)
+    if knn_indices is not None and len(knn_indices) == n_samples and knn_indices.shape[1] > 1:
+        graph_neighbors = min(n_neighbors, knn_indices.shape[1] - 1)
+        preservation = neighbor_preservation(_without_self(knn_indices, graph_neighbors),
+                                             low_neighbors[:, :graph_neighbors])
+        preservation_source = "graph"
+    else:
+        preservation = neighbor_preservation(query_neighbors, low_neighbors[queries])
+        preservation_source = "queries"
+
+    metrics = {
+        "n_samples": n_samples,
+        "n_queries": len(queries),
+        "n_neighbors": n_neighbors,
+        "trustworthiness": trustworthiness_from_ranks(ranks, n_neighbors, n_samples),
+        "knn_preservation": preservation,
+        "knn_preservation_source": preservation_source,
+    }
+    if "compendium" in labels_df:
+        metrics["compendium_mixing"] = label_mixing(labels_df["compendium"], low_neighbors)
+    if "disease" in labels_df:
+        metrics["disease_silhouette"] = label_silhouette(points, labels_df["disease"], queries, batch_size)
+    metrics["seconds"] = time.time() - start_time
+    return metrics
+
+
+def write_metrics(file_path, metrics, layout_algorithm=None):
+    """
+    Write metrics to a JSON file, with the parameters of the layout algorithm so parameter sweeps can be compared.
+
+    Args:
+        file_path (str): Path of the JSON file.
+        metrics (dict): Metrics as returned by embedding_metrics.
+        layout_algorithm (BaseLayout): The layout algorithm that produced the layout. Default None.
+    """
+    report = dict(metrics)
+    if layout_algorithm is not None:
+        report["layout"] = type(layout_algorithm).__name__
+        report["parameters"] = {name: value for name, value in vars(layout_algorithm).items()
+                                if not name.startswith("_") and not name.endswith("_")
+                                and isinstance(value, (bool, int, float, str, type(None)))}
+    with open(file_path, "w") as metrics_file:
+        json.dump(report, metrics_file, indent=2)
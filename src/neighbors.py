@@ -0,0 +1,394 @@
+import os
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from preprocessing import auto_block_size, center_and_normalize_rows
+
+"""
+Approximate nearest neighbor graphs shared by the layout algorithms. The kNN graph is the most expensive part of
+neighbor based layouts, so graphs can be cached on disk and reused by later runs on the same matrix, ie t-SNE runs with
+different perplexities or exaggeration schedules.
+
+Graphs follow the pynndescent convention: row i holds the indices of the neighbors of sample i sorted by distance, with
+sample i itself in the first column at distance 0.
+
+Functions:
+    nearest_neighbors(matrix: np.ndarray, n_neighbors: int, metric: str, random_state: int) -> tuple:
+        Compute an approximate kNN graph with NN-descent.
+
+    matrix_fingerprint(matrix: np.ndarray) -> str:
+        Hash the contents of a matrix to key caches.
+
+    cached_nearest_neighbors(matrix: np.ndarray, n_neighbors: int, metric: str, cache_dir: str,
+                             random_state: int) -> tuple:
+        Load a kNN graph from the cache or compute and store it.
+
+    prepare_exact_rows(matrix: np.ndarray, metric: str, copy: bool, out: np.ndarray) -> np.ndarray:
+        Prepare rows so exact distances are computed with matrix products.
+
+    exact_distances(queries: np.ndarray, rows: np.ndarray, metric: str) -> np.ndarray:
+        Exact distances between prepared rows.
+
+    exact_nearest_neighbors(rows: np.ndarray, start: int, stop: int, n_neighbors: int, metric: str,
+                            block_size: int) -> tuple:
+        Exact neighbors of a range of prepared rows among every row.
+
+    sharded_nearest_neighbors(matrix: np.ndarray, n_neighbors: int, metric: str, n_workers: int, executor,
+                              scratch_dir: str, block_size: int) -> tuple:
+        Compute an exact kNN graph with shards of samples searched in parallel worker processes.
+
+    update_nearest_neighbors(rows: np.ndarray, indices: np.ndarray, distances: np.ndarray, new_rows: np.ndarray,
+                             stale_rows: np.ndarray, metric: str, block_size: int) -> tuple:
+        Update a kNN graph after samples were added or removed, only touching the rows they affect.
+
+    save_knn_graph(file_path: str, sample_ids: pd.Index, indices: np.ndarray, distances: np.ndarray):
+        Save a kNN graph with the sample ids of its rows.
+
+    load_knn_graph(file_path: str) -> tuple:
+        Load a kNN graph saved with save_knn_graph.
+"""
+
+# Rows hashed at a time when fingerprinting a matrix
+FINGERPRINT_BLOCK_ROWS = 1024
+# Metrics whose exact distances are computed from matrix products of prepared rows
+EXACT_METRICS = ("euclidean", "cosine", "correlation")
+# Shard workers are spawned because forking a process that already started numba threads, ie after a UMAP fit, hangs
+SPAWN = multiprocessing.get_context("spawn")
+
+
+def nearest_neighbors(matrix, n_neighbors, metric="euclidean", random_state=42, n_jobs=-1):
+    """
+    Compute an approximate kNN graph with NN-descent.
+
+    Args:
+        matrix (np.ndarray): Data in (sample, feature) format.
+        n_neighbors (int): Number of neighbors per sample, including the sample itself.
+        metric (str): Any metric supported by pynndescent, ie 'euclidean' or 'correlation'. Default 'euclidean'.
+        random_state (int): Seed for the random projection trees. Default 42.
+        n_jobs (int): Number of threads. Default -1, all CPUs.
+
+    Returns:
+        tuple: (indices, distances) arrays of shape (n_samples, n_neighbors).
+    """
+    from pynndescent import NNDescent
+
+    n_neighbors = min(n_neighbors, matrix.shape[0])
+    index = NNDescent(matrix, n_neighbors=n_neighbors, metric=metric, random_state=random_state, n_jobs=n_jobs)
+    indices, distances = index.neighbor_graph
+    return indices, distances
+
+
+def matrix_fingerprint(matrix):
+    """
+    Hash the shape, dtype and contents of a matrix. The matrix is hashed in blocks of rows so memmaps are not loaded
+    whole.
+
+    Args:
+        matrix (np.ndarray): The matrix to hash.
+
+    Returns:
+        str: Hex digest identifying the matrix.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((matrix.shape, str(matrix.dtype))).encode())
+    for start in range(0, matrix.shape[0], FINGERPRINT_BLOCK_ROWS):
+        digest.update(np.ascontiguousarray(matrix[start:start + FINGERPRINT_BLOCK_ROWS]).tobytes())
+    return digest.hexdigest()
+
+
+def cached_nearest_neighbors(matrix, n_neighbors, metric="euclidean", cache_dir=None, random_state=42,
+                             fingerprint=None):
+    """
+    Load a kNN graph for the matrix from the cache directory, or compute it with nearest_neighbors and store it. A
+    cached graph with more neighbors than requested is reused by keeping its nearest columns.
+
+    Args:
+        matrix (np.ndarray): Data in (sample, feature) format.
+        n_neighbors (int): Number of neighbors per sample, including the sample itself.
+        metric (str): Any metric supported by pynndescent. Default 'euclidean'.
+        cache_dir (str): Directory for cached graphs. Default None, no caching.
+        random_state (int): Seed for the random projection trees. Default 42.
+        fingerprint (str): Precomputed matrix_fingerprint of the matrix. Default None, computed when caching.
+
+    Returns:
+        tuple: (indices, distances) arrays of shape (n_samples, n_neighbors).
+    """
+    if cache_dir is None:
+        return nearest_neighbors(matrix, n_neighbors, metric=metric, random_state=random_state)
+
+    fingerprint = fingerprint or matrix_fingerprint(matrix)
+    cache_path = os.path.join(cache_dir, f"knn-{metric}-{fingerprint}.npz")
+    n_neighbors = min(n_neighbors, matrix.shape[0])
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if cached["indices"].shape[1] >= n_neighbors:
+                logging.info(f"Reusing cached kNN graph {os.path.basename(cache_path)}")
+                return cached["indices"][:, :n_neighbors], cached["distances"][:, :n_neighbors]
+
+    indices, distances = nearest_neighbors(matrix, n_neighbors, metric=metric, random_state=random_state)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(cache_path, indices=indices, distances=distances)
+    logging.info(f"Cached kNN graph at {cache_path}")
+    return indices, distances
+
+
+def prepare_exact_rows(matrix, metric="euclidean", copy=True, out=None):
+    """
+    Prepare rows so exact distances reduce to matrix products: rows are centered and normalized for correlation and
+    normalized for cosine, so both distances are 1 minus a dot product.
+
+    Args:
+        matrix (np.ndarray): Data in (sample, feature) format.
+        metric (str): One of EXACT_METRICS. Default 'euclidean'.
+        copy (bool): Whether the matrix must be left untouched. When False a writable float32 matrix is prepared in
+            place. Default True.
+        out (np.ndarray): C-contiguous float32 array of the same shape to prepare the rows in, ie an np.memmap. Default
+            None, copy is used instead.
+
+    Returns:
+        np.ndarray: C-contiguous float32 rows.
+    """
+    if metric not in EXACT_METRICS:
+        raise ValueError(f"Invalid metric '{metric}' for exact neighbors. Use one of {', '.join(EXACT_METRICS)}.")
+    block_size = auto_block_size(matrix.shape[1])
+    if out is not None:
+        for start in range(0, matrix.shape[0], block_size):
+            out[start:start + block_size] = matrix[start:start + block_size]
+        rows = out
+    else:
+        rows = np.array(matrix, dtype=np.float32, order="C", copy=copy or None)
+        if not rows.flags["WRITEABLE"]:
+            rows = rows.copy()
+    if metric == "correlation":
+        center_and_normalize_rows(rows)
+    elif metric == "cosine":
+        for start in range(0, rows.shape[0], block_size):
+            norms = np.linalg.norm(rows[start:start + block_size], axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            rows[start:start + block_size] /= norms
+    return rows
+
+
+def exact_distances(queries, rows, metric="euclidean"):
+    """
+    Exact distances between rows prepared with prepare_exact_rows.
+
+    Args:
+        queries (np.ndarray): Prepared query rows.
+        rows (np.ndarray): Prepared rows to measure the queries against.
+        metric (str): The metric the rows were prepared for. Default 'euclidean'.
+
+    Returns:
+        np.ndarray: float32 (query, row) distances.
+    """
+    products = queries @ rows.T
+    if metric == "euclidean":
+        squared = np.einsum("ij,ij->i", queries, queries)[:, None] + np.einsum("ij,ij->i", rows, rows)[None, :]
+        squared -= 2 * products
+        return np.sqrt(np.maximum(squared, 0, out=squared))
+    return np.maximum(1 - products, 0, out=products)
+
+
+def _nearest_columns(block_distances, n_neighbors):
+    """
+    Indices and distances of the n_neighbors smallest distances of every row, sorted by distance.
+    """
+    nearest = np.argpartition(block_distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+    nearest_distances = np.take_along_axis(block_distances, nearest, axis=1)
+    order = np.argsort(nearest_distances, axis=1, kind="stable")
+    return np.take_along_axis(nearest, order, axis=1), np.take_along_axis(nearest_distances, order, axis=1)
+
+
+def exact_nearest_neighbors(rows, start, stop, n_neighbors, metric="euclidean", block_size=None):
+    """
+    Exact neighbors of the rows from start to stop among every row, following the pynndescent convention with each
+    sample first in its own row.
+
+    Args:
+        rows (np.ndarray): Every sample, prepared with prepare_exact_rows. Can be an np.memmap.
+        start (int): First row to find neighbors for.
+        stop (int): Row after the last row to find neighbors for.
+        n_neighbors (int): Number of neighbors per sample, including the sample itself.
+        metric (str): The metric the rows were prepared for. Default 'euclidean'.
+        block_size (int): Number of samples whose distances are computed at once. Default None, chosen from the number
+            of samples.
+
+    Returns:
+        tuple: (indices, distances) arrays of shape (stop - start, n_neighbors).
+    """
+    n_neighbors = min(n_neighbors, rows.shape[0])
+    indices = np.empty((stop - start, n_neighbors), dtype=np.int64)
+    distances = np.empty((stop - start, n_neighbors), dtype=np.float32)
+    block_size = block_size or auto_block_size(rows.shape[0])
+    for block_start in range(start, stop, block_size):
+        block_stop = min(block_start + block_size, stop)
+        block_distances = exact_distances(np.asarray(rows[block_start:block_stop]), rows, metric)
+        # Rounding leaves a sample a tiny distance from itself, and duplicates tie with it, so pin it first
+        block_distances[np.arange(block_stop - block_start), np.arange(block_start, block_stop)] = -1
+        block_indices, block_nearest = _nearest_columns(block_distances, n_neighbors)
+        block_nearest[:, 0] = 0
+        indices[block_start - start:block_stop - start] = block_indices
+        distances[block_start - start:block_stop - start] = block_nearest
+    return indices, distances
+
+
+def _shard_nearest_neighbors(rows_path, start, stop, n_neighbors, metric, block_size, n_threads):
+    """
+    Worker for sharded_nearest_neighbors. Memory maps the prepared rows and searches the neighbors of one shard.
+    """
+    from threadpoolctl import threadpool_limits
+
+    rows = np.load(rows_path, mmap_mode="r")
+    with threadpool_limits(limits=n_threads):
+        return exact_nearest_neighbors(rows, start, stop, n_neighbors, metric=metric, block_size=block_size)
+
+
+def sharded_nearest_neighbors(matrix, n_neighbors, metric="euclidean", n_workers=None, executor=None,
+                              scratch_dir=None, block_size=None):
+    """
+    Compute an exact kNN graph in parallel. The rows are prepared once into a .npy file in a scratch directory and split
+    into one contiguous shard of samples per worker. Every worker memory maps the whole file, computes the distances of
+    its shard to every sample with matrix products and keeps the nearest ones, so shards share no state and the graph is
+    the concatenation of the shard graphs. The work of a shard is fixed, so throughput grows with the number of
+    workers until the file no longer fits in the page cache.
+
+    The brute force search is quadratic in the number of samples, unlike NN-descent, but it is exact and each worker
+    only holds a block of distances and its part of the graph.
+
+    Args:
+        matrix (np.ndarray): Data in (sample, feature) format. Can be an np.memmap.
+        n_neighbors (int): Number of neighbors per sample, including the sample itself.
+        metric (str): One of EXACT_METRICS. Default 'euclidean'.
+        n_workers (int): Number of shards, ie worker processes. Default None, one per CPU.
+        executor (concurrent.futures.Executor): Executor the shards are submitted to, ie the executor of a local dask
+            cluster. Default None, a process pool of n_workers processes. Workers must be able to read scratch_dir.
+        scratch_dir (str): Directory for the prepared rows, ie on a filesystem shared by every node. Default None, the
+            system temporary directory.
+        block_size (int): Number of samples whose distances are computed at once in a worker. Default None, chosen from
+            the number of samples.
+
+    Returns:
+        tuple: (indices, distances) arrays of shape (n_samples, n_neighbors).
+    """
+    n_samples = matrix.shape[0]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, n_samples))
+    # BLAS threads are shared out between the workers so they do not oversubscribe the CPUs
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    bounds = np.linspace(0, n_samples, n_workers + 1).astype(int)
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as shard_dir:
+        rows_path = os.path.join(shard_dir, "rows.npy")
+        rows = np.lib.format.open_memmap(rows_path, mode="w+", dtype=np.float32, shape=matrix.shape)
+        prepare_exact_rows(matrix, metric, out=rows)
+        rows.flush()
+        del rows
+
+        own_executor = executor is None
+        executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=SPAWN) if own_executor else executor
+        try:
+            futures = [executor.submit(_shard_nearest_neighbors, rows_path, start, stop, n_neighbors, metric,
+                                       block_size, n_threads)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            shards = [future.result() for future in futures]
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    logging.info(f"Computed exact kNN graph of {n_samples} samples in {n_workers} shards.")
+    return np.concatenate([indices for indices, _ in shards]), np.concatenate([distances for _, distances in shards])
+
+
+def update_nearest_neighbors(rows, indices, distances, new_rows, stale_rows=(), metric="euclidean", block_size=None):
+    """
+    Update a kNN graph after samples were added or removed without rebuilding it. New samples and stale rows, ie samples
+    that lost a removed neighbor, get their neighbors computed exactly against every sample. A new sample then joins
+    the neighbors of any other sample it is closer to than that sample's farthest neighbor. This is exact because the
+    distances of the new samples to every sample are computed anyway, so only the rows a new sample actually enters
+    change.
+
+    Args:
+        rows (np.ndarray): Every sample, prepared with prepare_exact_rows.
+        indices (np.ndarray): (sample, k) neighbor indices in the order of rows. Entries of new and stale rows are
+            ignored.
+        distances (np.ndarray): (sample, k) neighbor distances.
+        new_rows (np.ndarray): Positions of the new samples.
+        stale_rows (np.ndarray): Positions of other samples whose neighbors must be recomputed. Default (), none.
+        metric (str): The metric the rows were prepared for. Default 'euclidean'.
+        block_size (int): Number of samples whose distances are computed at once. Default None, chosen from the number
+            of samples.
+
+    Returns:
+        tuple: The updated (indices, distances) and the sorted positions of every row that changed.
+    """
+    indices = np.array(indices, dtype=np.int64)
+    distances = np.array(distances, dtype=np.float32)
+    n_samples, n_neighbors = indices.shape
+    recompute = np.union1d(np.asarray(new_rows, dtype=np.int64), np.asarray(stale_rows, dtype=np.int64))
+    is_new = np.zeros(n_samples, dtype=bool)
+    is_new[new_rows] = True
+    # Recomputed rows are exact, so nothing is inserted into them
+    farthest = distances[:, -1].copy()
+    farthest[recompute] = -np.inf
+
+    targets, sources, candidate_distances = [], [], []
+    block_size = block_size or auto_block_size(n_samples)
+    for start in range(0, len(recompute), block_size):
+        block = recompute[start:start + block_size]
+        block_distances = exact_distances(rows[block], rows, metric)
+        indices[block], distances[block] = _nearest_columns(block_distances, n_neighbors)
+
+        new_block = is_new[block]
+        if new_block.any():
+            source, target = np.nonzero(block_distances[new_block] < farthest)
+            targets.append(target)
+            sources.append(block[new_block][source])
+            candidate_distances.append(block_distances[new_block][source, target])
+
+    inserted = np.array([], dtype=np.int64)
+    if targets:
+        targets, sources = np.concatenate(targets), np.concatenate(sources)
+        candidate_distances = np.concatenate(candidate_distances)
+        order = np.argsort(targets, kind="stable")
+        targets, sources, candidate_distances = targets[order], sources[order], candidate_distances[order]
+        inserted, starts = np.unique(targets, return_index=True)
+        for row, source, candidate in zip(inserted, np.split(sources, starts[1:]),
+                                          np.split(candidate_distances, starts[1:])):
+            merged = np.concatenate([indices[row], source])
+            merged_distances = np.concatenate([distances[row], candidate])
+            nearest = np.argsort(merged_distances, kind="stable")[:n_neighbors]
+            indices[row], distances[row] = merged[nearest], merged_distances[nearest]
+
+    return indices, distances, np.union1d(recompute, inserted)
+
+
+def save_knn_graph(file_path, sample_ids, indices, distances):
+    """
+    Save a kNN graph with the sample ids of its rows, so a later run on a compendium with added or removed samples can
+    update it with update_nearest_neighbors.
+
+    Args:
+        file_path (str): Path of the .npz file.
+        sample_ids (pd.Index): Sample ids of the rows.
+        indices (np.ndarray): (sample, k) neighbor indices.
+        distances (np.ndarray): (sample, k) neighbor distances.
+    """
+    np.savez(file_path, sample_ids=pd.Index(sample_ids).to_numpy(dtype=str), indices=indices, distances=distances)
+
+
+def load_knn_graph(file_path):
+    """
+    Load a kNN graph saved with save_knn_graph.
+
+    Args:
+        file_path (str): Path of the .npz file.
+
+    Returns:
+        tuple: (sample_ids, indices, distances) where sample_ids is a pd.Index.
+    """
+    with np.load(file_path) as graph:
+        return pd.Index(graph["sample_ids"]), graph["indices"], graph["distances"]
@@ -0,0 +1,316 @@
+import os
+import re
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from preprocessing import expression_statistics, merge_expression_statistics, select_genes
+from quantization import quantization_parameters, encode
+from storage import write_quantized_matrix, iter_expression_tsv
+
+"""
+Blockwise processing of expression files that do not fit in memory. Expression files are stored in (gene, sample)
+format, so a block of rows holds a chunk of genes for every sample of one compendium. Samples are therefore blocked by
+compendium file and genes by row chunks sized from a memory budget.
+
+The engine makes two passes over the raw files. The first pass collects per gene statistics which are merged across
+compendia to decide which genes to keep, exactly as process_expression_compendium would. The second pass scatters the
+kept genes into a disk backed matrix which is then streamed out to the processed compendium file, either as text or as
+quantized uint16 codes.
+
+Per gene statistics are cached beside each raw file, so the first pass only reads a file once. Gene selection for any
+combination of compendia, ie when a compendium is added or removed or filter thresholds change, is then computed from
+the cached summaries in seconds and only the assembly of the final matrix reads the data.
+"""
+
+# Suffix of the statistics cache written beside a raw expression file
+STATISTICS_SUFFIX = ".stats.npz"
+# Memory budget used to scan a file for statistics when no budget is given
+DEFAULT_SCAN_MEMORY = "1G"
+
+# Parsing a block of text into a DataFrame takes several times the size of the final float64 values
+PARSE_OVERHEAD = 4
+BYTES_PER_VALUE = 8
+MEMORY_UNITS = {"": 1, "B": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_memory_size(size):
+    """
+    Parse a human readable memory size into bytes.
+
+    Args:
+        size (str or int): Size in bytes, or a number followed by a unit such as '512M', '8GB' or '1.5G'.
+
+    Returns:
+        int: The size in bytes.
+    """
+    if isinstance(size, (int, np.integer)):
+        return int(size)
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)(?:I?B)?\s*", str(size).upper())
+    if match is None:
+        raise ValueError(f"Invalid memory size '{size}'. Use a number of bytes or a unit like 512M or 8G.")
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+def choose_chunk_rows(max_memory, n_columns):
+    """
+    Choose how many gene rows to hold in memory at once so that a parsed block stays within the memory budget.
+
+    Args:
+        max_memory (int): Memory budget in bytes.
+        n_columns (int): Number of samples in a row.
+
+    Returns:
+        int: Number of rows per chunk, at least 1.
+    """
+    bytes_per_row = max(n_columns, 1) * BYTES_PER_VALUE * PARSE_OVERHEAD
+    return max(1, int(max_memory // bytes_per_row))
+
+
+def read_header(file_path):
+    """
+    Read the header of a (gene, sample) expression file.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+
+    Returns:
+        tuple: The name of the gene index column and a pd.Index of sample ids.
+    """
+    header = pd.read_csv(file_path, sep="\t", index_col=0, nrows=0)
+    return header.index.name, header.columns
+
+
+def iter_expression_chunks(file_path, chunk_rows, parser="c"):
+    """
+    Iterate over a (gene, sample) expression file in chunks of genes.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        chunk_rows (int): Number of gene rows per chunk. Approximate with the pyarrow parser.
+        parser (str): 'c' or 'pyarrow', see storage.read_tsv. Default 'c'.
+
+    Yields:
+        pd.DataFrame: A chunk of the file in (sample, gene) format.
+    """
+    yield from iter_expression_tsv(file_path, chunk_rows, parser=parser)
+
+
+def scan_expression_file(file_path, chunk_rows, parser="c"):
+    """
+    Compute per gene statistics for an expression file without loading the whole file.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        chunk_rows (int): Number of gene rows per chunk.
+        parser (str): 'c' or 'pyarrow'. Default 'c'.
+
+    Returns:
+        pd.DataFrame: Statistics as returned by preprocessing.expression_statistics.
+    """
+    chunks = iter_expression_chunks(file_path, chunk_rows, parser=parser)
+    return pd.concat([expression_statistics(chunk) for chunk in chunks])
+
+
+def statistics_cache_path(file_path):
+    """
+    Path of the statistics cache of an expression file, ie tumor_ribo_expression.stats.npz beside
+    tumor_ribo_expression.tsv.
+    """
+    return os.path.splitext(file_path)[0] + STATISTICS_SUFFIX
+
+
+def load_cached_statistics(file_path):
+    """
+    Load the cached statistics of an expression file. The cache is only used while the size and modification time of
+    the file match the ones recorded with it.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+
+    Returns:
+        pd.DataFrame: Statistics as returned by preprocessing.expression_statistics, or None when there is no valid
+            cache.
+    """
+    cache_path = statistics_cache_path(file_path)
+    if not os.path.exists(cache_path):
+        return None
+    file_stat = os.stat(file_path)
+    with np.load(cache_path) as cached:
+        if cached["source_size"] != file_stat.st_size or cached["source_mtime_ns"] != file_stat.st_mtime_ns:
+            return None
+        genes = pd.Index(cached["genes"], name=str(cached["gene_index_name"]) or None)
+        return pd.DataFrame({"count": cached["count"], "sum": cached["sum"], "m2": cached["m2"]}, index=genes)
+
+
+def save_cached_statistics(file_path, statistics):
+    """
+    Save the statistics of an expression file beside it, with the size and modification time of the file.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        statistics (pd.DataFrame): Statistics as returned by preprocessing.expression_statistics.
+    """
+    file_stat = os.stat(file_path)
+    np.savez(statistics_cache_path(file_path), genes=statistics.index.to_numpy(dtype=str),
+             gene_index_name=np.array(statistics.index.name or "", dtype=str),
+             count=statistics["count"].to_numpy(), sum=statistics["sum"].to_numpy(), m2=statistics["m2"].to_numpy(),
+             source_size=file_stat.st_size, source_mtime_ns=file_stat.st_mtime_ns)
+
+
+def compendium_statistics(file_path, chunk_rows=None, expression_df=None, parser="c"):
+    """
+    Get the per gene statistics of an expression file from its cache, or compute and cache them.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        chunk_rows (int): Number of gene rows per chunk when the file is scanned. Default None, chosen from
+            DEFAULT_SCAN_MEMORY.
+        expression_df (pd.DataFrame): The file already loaded in (sample, gene) format, used instead of scanning the
+            file on a cache miss. Default None.
+        parser (str): 'c' or 'pyarrow', used when the file is scanned. Default 'c'.
+
+    Returns:
+        pd.DataFrame: Statistics as returned by preprocessing.expression_statistics.
+    """
+    statistics = load_cached_statistics(file_path)
+    if statistics is not None:
+        return statistics
+
+    if expression_df is not None:
+        statistics = expression_statistics(expression_df)
+    else:
+        chunk_rows = chunk_rows or choose_chunk_rows(parse_memory_size(DEFAULT_SCAN_MEMORY),
+                                                     len(read_header(file_path)[1]))
+        logging.info(f"Scanning {os.path.basename(file_path)} in chunks of {chunk_rows} genes...")
+        statistics = scan_expression_file(file_path, chunk_rows, parser=parser)
+    save_cached_statistics(file_path, statistics)
+    return statistics
+
+
+def select_compendium_genes(file_paths, variance_threshold=None, minimum_expression=None, parser="c"):
+    """
+    Select the genes process_expression_compendium would keep for a combination of compendia, from their cached
+    statistics. Only files without a valid cache are read.
+
+    Args:
+        file_paths (list): Paths to (gene, sample) expression TSV files.
+        variance_threshold (int): What percentile of low variance genes to remove. Default None, no filtering.
+        minimum_expression (float): The threshold for minimum expression exclusive. Units: mean log2(TPM+1). Default
+            None, no filtering.
+        parser (str): 'c' or 'pyarrow', used for files without a valid cache. Default 'c'.
+
+    Returns:
+        tuple: The genes to keep, in the order of the union of genes, and the merged statistics of all genes.
+    """
+    statistics = merge_expression_statistics([compendium_statistics(file_path, parser=parser)
+                                              for file_path in file_paths])
+    return select_genes(statistics, variance_threshold, minimum_expression), statistics
+
+
+def process_expression_files_blockwise(file_paths, output_path, max_memory, variance_threshold=None,
+                                       minimum_expression=None, quantize=None, parser="c"):
+    """
+    Out of core equivalent of process_expression_compendium followed by writing the result in (gene, sample) format.
+    The union of genes, the zero filling of missing genes and both filters behave exactly like the in memory path. Only
+    a chunk of rows and the per gene statistics are held in memory; the assembled matrix lives in a temporary file next
+    to the output.
+
+    Args:
+        file_paths (list): Paths to (gene, sample) expression TSV files, in the order compendia should be concatenated.
+        output_path (str): Path of the processed compendium TSV file to write.
+        max_memory (int or str): Memory budget, see parse_memory_size.
+        variance_threshold (int): What percentile of low variance genes to remove. Default None, no filtering.
+        minimum_expression (float): The threshold for minimum expression exclusive. Units: mean log2(TPM+1). Default
+            None, no filtering.
+        quantize (str): Write a quantized .npz file instead of a TSV file, with one offset and scale for the whole
+            matrix ('global') or one per gene ('per_gene'). The codes are identical to quantizing the in memory
+            result. Default None, write a TSV file.
+        parser (str): 'c' or 'pyarrow'. Default 'c'.
+
+    Returns:
+        pd.Index: The genes written to the output file.
+    """
+    max_memory = parse_memory_size(max_memory)
+    headers = [read_header(file_path) for file_path in file_paths]
+    chunk_rows = [choose_chunk_rows(max_memory, len(samples)) for _, samples in headers]
+
+    # Pass 1: per gene statistics for each compendium, from the cache when possible, merged to select genes
+    statistics = [compendium_statistics(file_path, rows, parser=parser)
+                  for file_path, rows in zip(file_paths, chunk_rows)]
+    genes = select_genes(merge_expression_statistics(statistics), variance_threshold, minimum_expression)
+    gene_positions = pd.Series(np.arange(len(genes)), index=genes)
+
+    samples = pd.Index(np.concatenate([np.asarray(samples) for _, samples in headers]))
+    index_names = {name for name, _ in headers}
+    index_name = index_names.pop() if len(index_names) == 1 else None
+    logging.info(f"Keeping {len(genes)} genes for {len(samples)} samples.")
+
+    # Pass 2: scatter kept genes into a disk backed (gene, sample) matrix. Missing genes stay 0.
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=output_dir) as scratch_dir:
+        matrix = np.memmap(os.path.join(scratch_dir, "compendium.dat"), dtype=np.float64, mode="w+",
+                           shape=(len(genes), len(samples)))
+        column_offset = 0
+        for file_path, (_, file_samples), rows in zip(file_paths, headers, chunk_rows):
+            for chunk in iter_expression_chunks(file_path, rows, parser=parser):
+                kept = chunk.columns.isin(genes)
+                if kept.any():
+                    row_positions = gene_positions[chunk.columns[kept]].to_numpy()
+                    block = chunk.loc[:, kept].fillna(0).to_numpy(dtype=np.float64).T
+                    matrix[row_positions, column_offset:column_offset + len(file_samples)] = block
+            column_offset += len(file_samples)
+        matrix.flush()
+
+        write_rows = choose_chunk_rows(max_memory, len(samples))
+        if quantize is not None:
+            write_quantized_blockwise(matrix, os.path.join(scratch_dir, "codes.dat"), output_path, write_rows,
+                                      per_gene=quantize == "per_gene", sample_ids=samples,
+                                      gene_ids=genes.rename(index_name))
+            del matrix
+            return genes
+
+        # Stream the assembled matrix out in row blocks
+        header = pd.DataFrame(columns=samples, index=pd.Index([], name=index_name))
+        header.to_csv(output_path, sep="\t")
+        for start in range(0, len(genes), write_rows):
+            stop = min(start + write_rows, len(genes))
+            block = pd.DataFrame(np.asarray(matrix[start:stop]), index=genes[start:stop], columns=samples)
+            block.to_csv(output_path, sep="\t", mode="a", header=False)
+        del matrix
+
+    return genes
+
+
+def write_quantized_blockwise(matrix, codes_path, output_path, block_rows, per_gene, sample_ids, gene_ids):
+    """
+    Quantize a disk backed (gene, sample) matrix into a (sample, gene) .npz file, one block of genes at a time.
+
+    Args:
+        matrix (np.ndarray): The (gene, sample) matrix, ie an np.memmap.
+        codes_path (str): Path of the scratch file holding the (sample, gene) codes before they are written.
+        output_path (str): Path of the .npz file to write.
+        block_rows (int): Number of genes per block.
+        per_gene (bool): Whether each gene gets its own offset and scale.
+        sample_ids (pd.Index): Sample ids, the columns of the matrix.
+        gene_ids (pd.Index): Gene ids, the rows of the matrix.
+    """
+    n_genes, n_samples = matrix.shape
+    minimum = np.empty(n_genes)
+    maximum = np.empty(n_genes)
+    for start in range(0, n_genes, block_rows):
+        block = np.asarray(matrix[start:start + block_rows])
+        minimum[start:start + block_rows] = block.min(axis=1, initial=np.inf)
+        maximum[start:start + block_rows] = block.max(axis=1, initial=-np.inf)
+    if not per_gene:
+        minimum, maximum = minimum.min(), maximum.max()
+    offset, scale = quantization_parameters(minimum, maximum)
+
+    codes = np.memmap(codes_path, dtype=np.uint16, mode="w+", shape=(n_samples, n_genes))
+    for start in range(0, n_genes, block_rows):
+        stop = min(start + block_rows, n_genes)
+        genes = slice(start, stop) if per_gene else slice(None)
+        codes[:, start:stop] = encode(np.asarray(matrix[start:stop]), offset[genes, None], scale[genes, None]).T
+    codes.flush()
+    write_quantized_matrix(output_path, codes, offset, scale, sample_ids, gene_ids)
+    del codes
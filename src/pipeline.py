@@ -0,0 +1,180 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+"""
+A small in-process DAG runner for the mapping workflow. Stages are plain functions that receive the results of the
+stages they depend on as keyword arguments, so data is handed from one stage to the next in memory instead of being
+written to and re-read from disk. Every stage is started as soon as its dependencies finish, so independent stages, ie
+clinical processing and expression filtering, run concurrently in a thread pool. NumPy, pandas parsing and numba release
+the GIL for most of their work, so threads overlap well without copying data between processes.
+
+Results are dropped as soon as no pending stage needs them, so a large intermediate matrix does not outlive its last
+consumer unless it is requested as an output.
+
+Stages can carry memory estimates, so a pipeline holding the stages of several configurations only starts a stage when
+its estimate fits in a memory budget next to the running stages and the results still held for later stages.
+
+Classes:
+    Pipeline: A DAG of named stages run with a thread pool within an optional memory budget.
+
+Functions:
+    launch_numba_threads():
+        Start numba's thread pool from the calling thread.
+"""
+
+
+def launch_numba_threads():
+    """
+    Start numba's parallel thread pool from the calling thread. When the TBB threading layer is first started from a
+    worker thread, ie by a layout running in a pipeline stage, the interpreter hangs on exit. Setting the number of
+    threads launches the pool without compiling anything.
+    """
+    import numba
+    numba.set_num_threads(numba.get_num_threads())
+
+
+class Pipeline:
+    """
+    A DAG of named stages. Add stages with add_stage in any order and run them with run.
+
+    Example:
+        pipeline = Pipeline()
+        pipeline.add_stage("clinical", load_clinical)
+        pipeline.add_stage("expression", load_expression)
+        pipeline.add_stage("layout", fit_layout, dependencies=["expression", "clinical"])
+        results = pipeline.run(outputs=["layout"])
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add_stage(self, name, function, dependencies=(), memory=0, result_memory=0):
+        """
+        Add a stage to the pipeline.
+
+        Args:
+            name (str): Unique name of the stage. Stages depending on it receive its result as a keyword argument of
+                this name.
+            function (callable): Function run for the stage. It is called with one keyword argument per dependency.
+            dependencies (list or dict): Names of the stages that must finish before this one starts, or a dict from
+                keyword argument names to stage names, ie when stage names are prefixed by a configuration name.
+                Default (), none.
+            memory (int or callable): Estimated peak memory of the stage in bytes while it runs. A callable is called
+                with the keyword arguments of the stage once its dependencies have finished, ie to size the stage from
+                the data it receives. Default 0.
+            result_memory (int or callable): Estimated memory of the result in bytes while it is held for later stages.
+                A callable is called with the result. Default 0.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already in the pipeline.")
+        if not isinstance(dependencies, dict):
+            dependencies = {dependency: dependency for dependency in dependencies}
+        self.stages[name] = (function, dict(dependencies), memory, result_memory)
+
+    def order(self):
+        """
+        Order the stages so every stage comes after its dependencies.
+
+        Returns:
+            list: Stage names in a valid execution order.
+        """
+        for name, (_, dependencies, _, _) in self.stages.items():
+            missing = [dependency for dependency in dependencies.values() if dependency not in self.stages]
+            if missing:
+                raise ValueError(f"Stage '{name}' depends on unknown stages: {', '.join(missing)}")
+
+        ordered = []
+        remaining = dict(self.stages)
+        while remaining:
+            ready = [name for name, (_, dependencies, _, _) in remaining.items()
+                     if all(dependency not in remaining for dependency in dependencies.values())]
+            if not ready:
+                raise ValueError(f"The pipeline has a dependency cycle between: {', '.join(remaining)}")
+            ordered.extend(ready)
+            for name in ready:
+                del remaining[name]
+        return ordered
+
+    def run(self, outputs=None, max_workers=None, max_memory=None):
+        """
+        Run every stage, starting each one as soon as its dependencies have finished. When a stage fails no new stages
+        are started, running stages are waited for, and the error is raised.
+
+        With a memory budget, a ready stage only starts when its memory estimate fits next to the estimates of the
+        running stages and of the results still held. Ready stages start in the order they were added, and a stage
+        that does not fit waits without blocking smaller stages behind it. When nothing is running, the first ready
+        stage starts anyway, because held results are only released by stages that run.
+
+        Args:
+            outputs (list): Names of the stages whose results are returned. Default None, all stages. Results of other
+                stages are released once no pending stage needs them.
+            max_workers (int): Number of threads running stages. Default None, one per independent stage.
+            max_memory (int): Memory budget in bytes. Default None, no budget.
+
+        Returns:
+            dict: Keys are stage names in outputs and values are their results.
+        """
+        self.order()
+        launch_numba_threads()
+        outputs = set(self.stages if outputs is None else outputs)
+        consumers = {name: 0 for name in self.stages}
+        for _, dependencies, _, _ in self.stages.values():
+            for dependency in dependencies.values():
+                consumers[dependency] += 1
+
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+        # Memory estimates of ready stages, and the memory reserved by running stages and held results
+        estimates, reserved = {}, {}
+        with ThreadPoolExecutor(max_workers=max_workers or max(len(self.stages), 1)) as executor:
+            while pending or running:
+                for name in [name for name, (_, dependencies, _, _) in pending.items()
+                             if all(dependency in results for dependency in dependencies.values())]:
+                    function, dependencies, memory, _ = pending[name]
+                    kwargs = {argument: results[dependency] for argument, dependency in dependencies.items()}
+                    if name not in estimates:
+                        estimates[name] = memory(**kwargs) if callable(memory) else memory
+                    memory = estimates[name]
+                    if max_memory is not None and sum(reserved.values()) + memory > max_memory:
+                        if running:
+                            continue
+                        logging.warning(f"Stage '{name}' needs an estimated {memory / 1024 ** 2:.0f}MB, over the "
+                                        f"memory budget. Starting it alone.")
+                    del pending[name]
+                    reserved[name] = memory
+                    running[executor.submit(self._run_stage, name, function, kwargs)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        # Let running stages finish, but start nothing new
+                        pending.clear()
+                        wait(running)
+                        raise error
+                    del reserved[name]
+                    if consumers[name] or name in outputs:
+                        results[name] = future.result()
+                        result_memory = self.stages[name][3]
+                        reserved[name] = result_memory(results[name]) if callable(result_memory) else result_memory
+                    for dependency in self.stages[name][1].values():
+                        consumers[dependency] -= 1
+                        if consumers[dependency] == 0 and dependency not in outputs:
+                            del results[dependency]
+                            del reserved[dependency]
+
+        return {name: result for name, result in results.items() if name in outputs}
+
+    @staticmethod
+    def _run_stage(name, function, kwargs):
+        """
+        Run one stage and log its duration.
+        """
+        logging.info(f"Stage '{name}' started.")
+        start_time = time.time()
+        result = function(**kwargs)
+        logging.info(f"Stage '{name}' finished. Time taken: {time.time() - start_time:.2f}s")
+        return result
@@ -149,14 +149,17 @@ def generate_disease_plot(data: pd.DataFrame, title: str) -> Figure:
     """
     label_column = 'disease'
 
-    # Convert the disease labels to lowercase
-    data[label_column] = data[label_column].str.lower()
+    # Convert the disease labels to lowercase. Categorical labels from process_clinical_compendium are already
+    # normalized, so only plain string labels need converting.
+    if not isinstance(data[label_column].dtype, pd.CategoricalDtype):
+        data = data.assign(**{label_column: data[label_column].str.lower()})
 
-    # Count the occurrences of each disease
+    # Count the occurrences of each disease. Categorical counts include unused categories so drop those.
     disease_counts = data[label_column].value_counts()
+    disease_counts = disease_counts[disease_counts > 0]
 
     # Get the top 10 most common diseases
-    top_10_diseases = disease_counts.nlargest(9).index.tolist()
+    top_10_diseases = disease_counts.drop('unknown', errors='ignore').nlargest(9).index.tolist()
     top_10_diseases.append('unknown')
 
     fig, ax = setup_plot(title)
@@ -1,5 +1,13 @@
+import os
+import hashlib
+import logging
 import pandas as pd
 import numpy as np
+from scipy import sparse as sp
+
+# Target size in bytes of a float64 row block when the block size is chosen automatically
+BLOCK_BYTES = 256 * 1024 ** 2
+
 
 def process_expression_compendium(expression_dict, variance_threshold=None, minimum_expression=None):
     """
@@ -24,7 +32,6 @@ def process_expression_compendium(expression_dict, variance_threshold=None, mini
         pd.DataFrame: A single dataframe containing all patient ids and corresponding gene expression data from all
             inputted compendia.
     """
-
     # Add a column to each dataframe with the compendium name
     compendium_labeled_dfs = []
     for compendium_name, df in expression_dict.items():
@@ -53,30 +60,441 @@ def process_expression_compendium(expression_dict, variance_threshold=None, mini
     return filtered_exp_df
 
 
+def assemble_expression_compendium(expression_dict, genes):
+    """
+    Build the compendium of process_expression_compendium for genes that were already selected, ie from cached
+    statistics with out_of_core.select_compendium_genes. Each dataframe is cut down to the selected genes before they
+    are concatenated, so the unfiltered union matrix is never built.
+
+    Args:
+        expression_dict (dict): Dictionary where keys are compendium names and values are dataframes in (sample, gene)
+            format.
+        genes (pd.Index): The genes to keep, in order.
+
+    Returns:
+        pd.DataFrame: The compendium in (sample, gene) format, with genes missing from a compendium filled with 0.
+    """
+    return pd.concat([df.reindex(columns=genes) for df in expression_dict.values()]).fillna(0)
+
+
+def process_expression_compendium_sparse(expression_dict, variance_threshold=None, minimum_expression=None):
+    """
+    Sparse equivalent of process_expression_compendium. Each compendium is converted to CSR on its own and its columns
+    are mapped onto the union of genes, so genes missing from a compendium cost no memory instead of being filled with
+    dense zeros. The filters are computed from sparse per gene statistics and keep the same genes.
+
+    Args:
+        expression_dict (dict): Dictionary where keys are compendium names and values are dataframes in (sample, gene)
+            format.
+        variance_threshold (int): What percentile of low variance genes to remove. Default None, no filtering.
+        minimum_expression (float): The threshold for minimum expression exclusive. Units: mean log2(TPM+1). Default
+            None, no filtering.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids) where matrix is a float64 scipy.sparse.csr_matrix in (sample, gene)
+            format and the ids are pd.Index objects in the order of process_expression_compendium.
+    """
+    # Union of genes in order of first appearance, like pd.concat
+    genes = pd.Index([])
+    for df in expression_dict.values():
+        genes = genes.append(df.columns.difference(genes, sort=False))
+    gene_names = {df.columns.name for df in expression_dict.values()}
+    genes = genes.rename(gene_names.pop() if len(gene_names) == 1 else None)
+
+    blocks = []
+    for df in expression_dict.values():
+        values = df.to_numpy(dtype=np.float64)
+        block = sp.csr_matrix(np.where(np.isnan(values), 0, values))
+        # Map the compendium columns onto the union of genes
+        columns = genes.get_indexer(df.columns)[block.indices]
+        blocks.append(sp.csr_matrix((block.data, columns, block.indptr), shape=(block.shape[0], len(genes))))
+    matrix = sp.vstack(blocks, format="csr")
+    matrix.sort_indices()
+    samples = pd.Index(np.concatenate([np.asarray(df.index) for df in expression_dict.values()]))
+
+    kept = select_genes(sparse_expression_statistics(matrix, genes), variance_threshold, minimum_expression)
+    if len(kept) < len(genes):
+        matrix = matrix[:, genes.get_indexer(kept)]
+    return matrix, samples, kept
+
+
+def sparse_expression_statistics(matrix, gene_ids):
+    """
+    Per gene statistics of a sparse (sample, gene) matrix without densifying it, in the format of expression_statistics.
+    Deviations are summed over the stored values and the implicit zeros are added in one term per gene.
+
+    Args:
+        matrix (scipy.sparse.spmatrix): Expression data in (sample, gene) format.
+        gene_ids (pd.Index): Gene ids of the columns.
+
+    Returns:
+        pd.DataFrame: Indexed by gene with columns 'count', 'sum' and 'm2'.
+    """
+    matrix = sp.csr_matrix(matrix)
+    count = matrix.shape[0]
+    columns = matrix.indices
+    gene_sums = np.bincount(columns, weights=matrix.data, minlength=matrix.shape[1])
+    gene_means = gene_sums / max(count, 1)
+    stored = np.bincount(columns, minlength=matrix.shape[1])
+    gene_m2 = (np.bincount(columns, weights=(matrix.data - gene_means[columns]) ** 2, minlength=matrix.shape[1])
+               + (count - stored) * gene_means ** 2)
+    return pd.DataFrame({"count": count, "sum": gene_sums, "m2": gene_m2}, index=gene_ids)
+
+
+def scale_sparse_columns(matrix, dtype=np.float32):
+    """
+    Scale each column of a sparse matrix to unit variance without centering it, like sklearn's StandardScaler with
+    with_mean=False, so zeros stay zeros and the matrix stays sparse. Columns with zero variance are left as they are.
+
+    Args:
+        matrix (scipy.sparse.spmatrix): Data in (sample, gene) format.
+        dtype (np.dtype): The dtype of the result. Default np.float32, what UMAP works in.
+
+    Returns:
+        scipy.sparse.csr_matrix: The scaled matrix, a new matrix.
+    """
+    matrix = sp.csr_matrix(matrix, dtype=np.float64, copy=True)
+    statistics = sparse_expression_statistics(matrix, pd.RangeIndex(matrix.shape[1]))
+    scale = np.sqrt(statistics["m2"].to_numpy() / max(matrix.shape[0], 1))
+    scale[scale == 0] = 1.0
+    matrix.data /= scale[matrix.indices]
+    return matrix.astype(dtype)
+
+
+def normalize_labels(labels, missing="unknown"):
+    """
+    Normalize free text labels such as disease names so that the same label is always spelled the same way. Labels are
+    stripped of surrounding whitespace and lowercased. Missing labels are replaced with the missing label.
+
+    Args:
+        labels (pd.Series): The labels to normalize.
+        missing (str): Label used for missing values. Default 'unknown'.
+
+    Returns:
+        pd.Series: Categorical series of normalized labels with the same index as the input.
+    """
+    normalized = labels.astype("string").str.strip().str.lower().fillna(missing)
+    normalized = normalized.mask(normalized == "", missing)
+    return normalized.astype(object).astype("category")
+
+
 def process_clinical_compendium(clinical_dict):
     """
-    Process a dictionary of clinical dataframes and return a compendium dataframe.
+    Process a dictionary of clinical dataframes and return a compendium dataframe. The input dataframes are not modified.
 
     Args:
         clinical_dict (dict): Dictionary where keys are compendium names and values are dataframes containing clinical data.
 
     Returns:
         pd.DataFrame: Compendia dataframe with clinical data and added 'compendium' column label that marks the
-        compendium of origin.
+        compendium of origin. The 'compendium' and 'disease' columns are categorical and disease labels are normalized
+        with normalize_labels.
     """
-    clinical_datasets = []
+    # Merge all clinical datasets into a single DataFrame
+    compendia_df = pd.concat(clinical_dict.values())
 
-    for compendium, clinical_df in clinical_dict.items():
-        # Add compendium label to clinical data
-        clinical_df["compendium"] = compendium
+    # Add compendium label to clinical data. Codes follow the order of the clinical dictionary.
+    codes = np.repeat(np.arange(len(clinical_dict)), [len(df) for df in clinical_dict.values()])
+    compendia_df["compendium"] = pd.Categorical.from_codes(codes, categories=list(clinical_dict.keys()))
 
-        # Store clinical dataset
-        clinical_datasets.append(clinical_df)
+    compendia_df["disease"] = normalize_labels(compendia_df["disease"])
 
-    # Merge all clinical datasets into a single DataFrame
-    compendia_df = pd.concat(clinical_datasets)
+    return compendia_df
 
-    compendia_df['disease'] = compendia_df['disease'].fillna('unknown')
 
-    return compendia_df
+def build_sample_index(sample_ids, clinical_index):
+    """
+    Build a positional index from expression samples to clinical rows. Storing this index once lets later steps align
+    clinical data to the expression samples with a positional lookup instead of merging on sample ids.
+
+    Args:
+        sample_ids (pd.Index or list): Sample ids in the order of the expression compendium.
+        clinical_index (pd.Index): Index of the clinical compendium. Only the first row of duplicated ids is used.
+
+    Returns:
+        np.ndarray: int32 array with the clinical row of each sample, or -1 when a sample has no clinical data.
+    """
+    first_rows = np.flatnonzero(~clinical_index.duplicated())
+    positions = clinical_index[first_rows].get_indexer(pd.Index(sample_ids))
+    sample_index = np.full(len(positions), -1, dtype=np.int32)
+    sample_index[positions >= 0] = first_rows[positions[positions >= 0]]
+    return sample_index
+
+
+def sample_index_fingerprint(sample_ids, clinical_index):
+    """
+    Hash the expression sample ids and the clinical index a sample index was built from. A saved index is only valid for
+    the same ids in the same order, which its length alone cannot tell, ie after the clinical file is regenerated with
+    rows in another order.
+
+    Args:
+        sample_ids (pd.Index or list): Sample ids in the order of the expression compendium.
+        clinical_index (pd.Index): Index of the clinical compendium.
+
+    Returns:
+        str: Hex digest of both lists of ids.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for ids in (sample_ids, clinical_index):
+        digest.update(str(len(ids)).encode())
+        digest.update("\0".join(map(str, ids)).encode())
+    return digest.hexdigest()
+
+
+def save_sample_index(file_path, sample_index, sample_ids, clinical_index):
+    """
+    Save a sample index with the fingerprint of the ids it was built from.
+
+    Args:
+        file_path (str): Path of the .npz file.
+        sample_index (np.ndarray): Positions as returned by build_sample_index.
+        sample_ids (pd.Index or list): Sample ids in the order of the expression compendium.
+        clinical_index (pd.Index): Index of the clinical compendium.
+    """
+    np.savez(file_path, sample_index=sample_index,
+             fingerprint=np.array(sample_index_fingerprint(sample_ids, clinical_index)))
 
+
+def load_sample_index(file_path, sample_ids, clinical_index):
+    """
+    Load a sample index saved with save_sample_index, if it was built from the same expression samples and clinical
+    rows. A missing, unreadable or out of date index is rebuilt, with a warning when it is out of date.
+
+    Args:
+        file_path (str): Path of the .npz file.
+        sample_ids (pd.Index or list): Sample ids in the order of the expression compendium.
+        clinical_index (pd.Index): Index of the clinical compendium.
+
+    Returns:
+        np.ndarray: Positions as returned by build_sample_index.
+    """
+    if os.path.exists(file_path):
+        try:
+            with np.load(file_path) as saved:
+                if str(saved["fingerprint"]) == sample_index_fingerprint(sample_ids, clinical_index):
+                    return saved["sample_index"]
+            logging.warning(f"Sample index {file_path} was built from other samples or clinical rows, rebuilding it.")
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not read sample index {file_path} ({e}), rebuilding it.")
+    return build_sample_index(sample_ids, clinical_index)
+
+
+def align_clinical(layout_df, clinical_df, sample_index=None):
+    """
+    Attach clinical data to a layout using a positional sample index. Samples without clinical data are dropped, which
+    matches an inner merge on sample ids.
+
+    Args:
+        layout_df (pd.DataFrame): Layout indexed by sample id, in the order of the expression compendium.
+        clinical_df (pd.DataFrame): The clinical compendium.
+        sample_index (np.ndarray): Positions as returned by build_sample_index or load_sample_index, built from the ids of
+            layout_df and clinical_df. If None or of the wrong length it is rebuilt.
+
+    Returns:
+        pd.DataFrame: The layout columns followed by the clinical columns for every sample with clinical data.
+    """
+    if sample_index is None or len(sample_index) != len(layout_df) or sample_index.max(initial=-1) >= len(clinical_df):
+        sample_index = build_sample_index(layout_df.index, clinical_df.index)
+
+    has_clinical = sample_index >= 0
+    clinical_rows = clinical_df.iloc[sample_index[has_clinical]]
+    clinical_rows.index = layout_df.index[has_clinical]
+    return pd.concat([layout_df[has_clinical], clinical_rows], axis=1)
+
+
+def expression_statistics(expression_df):
+    """
+    Compute per gene sufficient statistics for a block of expression data. Missing values are treated as 0 to match
+    process_expression_compendium. Statistics from blocks of different samples can be combined with
+    merge_expression_statistics.
+
+    Args:
+        expression_df (pd.DataFrame): Gene expression data in (sample, gene) format.
+
+    Returns:
+        pd.DataFrame: Indexed by gene with columns 'count' (number of samples), 'sum' (sum of expression) and 'm2' (sum
+            of squared deviations from the gene mean).
+    """
+    values = expression_df.fillna(0).to_numpy(dtype=np.float64)
+    count = values.shape[0]
+    gene_sums = values.sum(axis=0)
+    gene_m2 = ((values - gene_sums / max(count, 1)) ** 2).sum(axis=0)
+    return pd.DataFrame({"count": count, "sum": gene_sums, "m2": gene_m2}, index=expression_df.columns)
+
+
+def merge_expression_statistics(statistics):
+    """
+    Merge per gene statistics computed over disjoint sets of samples, ie one per compendium. The union of all genes is
+    taken. A gene missing from one set of samples is counted as 0 expression for those samples, which mirrors the
+    fillna(0) behaviour of process_expression_compendium. Deviations are merged with the pairwise update of Chan et
+    al. so the result does not suffer from the cancellation of a naive sum of squares.
+
+    Args:
+        statistics (list): List of statistics dataframes as returned by expression_statistics.
+
+    Returns:
+        pd.DataFrame: Merged statistics indexed by the union of genes, in order of first appearance.
+    """
+    # Start from an empty index of the gene dtype, ie int32 gene codes, so the union keeps it
+    genes = statistics[0].index[:0] if statistics else pd.Index([])
+    for stats in statistics:
+        genes = genes.append(stats.index.difference(genes, sort=False))
+    # Keep the name of the gene index when all compendia agree on it, like pd.concat
+    names = {stats.index.name for stats in statistics}
+    genes = genes.rename(names.pop() if len(names) == 1 else None)
+
+    count = 0
+    gene_sums = np.zeros(len(genes))
+    gene_m2 = np.zeros(len(genes))
+    for stats in statistics:
+        stats = stats.reindex(genes)
+        block_count = stats["count"].max()
+        block_sums = stats["sum"].fillna(0).to_numpy()
+        block_m2 = stats["m2"].fillna(0).to_numpy()
+        if count == 0:
+            gene_sums, gene_m2 = block_sums.copy(), block_m2.copy()
+        else:
+            delta = block_sums / block_count - gene_sums / count
+            gene_m2 = gene_m2 + block_m2 + delta ** 2 * count * block_count / (count + block_count)
+            gene_sums = gene_sums + block_sums
+        count += block_count
+
+    return pd.DataFrame({"count": count, "sum": gene_sums, "m2": gene_m2}, index=genes)
+
+
+def select_genes(statistics, variance_threshold=None, minimum_expression=None):
+    """
+    Apply the filters of process_expression_compendium to per gene statistics instead of the expression matrix.
+
+    Args:
+        statistics (pd.DataFrame): Statistics as returned by expression_statistics or merge_expression_statistics.
+        variance_threshold (int): What percentile of low variance genes to remove. Default None, no filtering.
+        minimum_expression (float): The threshold for minimum expression exclusive. Units: mean log2(TPM+1). Default
+            None, no filtering.
+
+    Returns:
+        pd.Index: The genes that pass the filters, in the order of the statistics index.
+    """
+    genes_to_keep = np.ones(len(statistics), dtype=bool)
+
+    if minimum_expression is not None:
+        gene_means = statistics["sum"] / statistics["count"]
+        genes_to_keep &= (gene_means > minimum_expression).to_numpy()
+
+    if variance_threshold is not None:
+        kept = statistics[genes_to_keep]
+        gene_variances = (kept["m2"] / (kept["count"] - 1)).to_numpy()
+        keep_variance = gene_variances > np.percentile(gene_variances, variance_threshold)
+        genes_to_keep[np.flatnonzero(genes_to_keep)] = keep_variance
+
+    return statistics.index[genes_to_keep]
+
+
+def auto_block_size(n_features):
+    """
+    Choose the number of rows per block so that a float64 block takes about BLOCK_BYTES.
+
+    Args:
+        n_features (int): Number of columns in the matrix.
+
+    Returns:
+        int: Number of rows per block, at least 1.
+    """
+    return max(1, BLOCK_BYTES // (max(n_features, 1) * 8))
+
+
+def iter_row_blocks(matrix, block_size):
+    """
+    Iterate over a matrix in blocks of rows, converting one block at a time to float64. Only the current block is held
+    in memory, so the matrix can be a memmap larger than RAM, or a sparse matrix that is densified one block at a time.
+
+    Args:
+        matrix (np.ndarray or scipy.sparse.spmatrix): The matrix, ie an np.memmap or a CSR matrix.
+        block_size (int): Number of rows per block.
+
+    Yields:
+        tuple: The row slice of the block and the block as a dense float64 array.
+    """
+    is_sparse = sp.issparse(matrix)
+    for start in range(0, matrix.shape[0], block_size):
+        rows = slice(start, min(start + block_size, matrix.shape[0]))
+        block = matrix[rows].toarray() if is_sparse else matrix[rows]
+        yield rows, np.asarray(block, dtype=np.float64)
+
+
+def column_moments(matrix, block_size):
+    """
+    Compute the mean and population standard deviation of each column in one pass over row blocks.
+
+    Args:
+        matrix (np.ndarray): The matrix in (sample, gene) format.
+        block_size (int): Number of rows per block.
+
+    Returns:
+        tuple: The column means and standard deviations as float64 arrays.
+    """
+    count = 0
+    mean = np.zeros(matrix.shape[1])
+    m2 = np.zeros(matrix.shape[1])
+    for _, block in iter_row_blocks(matrix, block_size):
+        block_count = block.shape[0]
+        block_mean = block.mean(axis=0)
+        block_m2 = ((block - block_mean) ** 2).sum(axis=0)
+        delta = block_mean - mean
+        total = count + block_count
+        m2 += block_m2 + delta ** 2 * count * block_count / total
+        mean += delta * block_count / total
+        count = total
+    return mean, np.sqrt(m2 / max(count, 1))
+
+
+def standardize_matrix(matrix, copy=True, dtype=np.float32, block_size=None):
+    """
+    Standardize each column to zero mean and unit variance like sklearn's StandardScaler, without holding more than one
+    block of float64 values in memory. Columns with zero variance are only centered.
+
+    When copy is False and the matrix is a writable, C-contiguous array of the requested dtype it is scaled in place.
+    Otherwise the result is written to a single new array of the requested dtype, which for the default float32 is half
+    the size of the float64 copy StandardScaler would make.
+
+    Args:
+        matrix (np.ndarray): Data in (sample, gene) format. Can be an np.memmap.
+        copy (bool): Whether the input must be left untouched. Default True.
+        dtype (np.dtype): The dtype of the result. Default np.float32, what UMAP works in.
+        block_size (int): Number of rows per block. Default None, chosen from the number of genes.
+
+    Returns:
+        np.ndarray: The standardized matrix. This is the input matrix when it was scaled in place.
+    """
+    block_size = block_size or auto_block_size(matrix.shape[1])
+    mean, scale = column_moments(matrix, block_size)
+    scale[scale == 0] = 1.0
+
+    in_place = (not copy and matrix.dtype == dtype and matrix.flags["C_CONTIGUOUS"] and matrix.flags["WRITEABLE"])
+    scaled = matrix if in_place else np.empty(matrix.shape, dtype=dtype)
+    for rows, block in iter_row_blocks(matrix, block_size):
+        scaled[rows] = (block - mean) / scale
+    return scaled
+
+
+def center_and_normalize_rows(matrix, block_size=None):
+    """
+    Center each row to zero mean and scale it to unit L2 norm, in place and one block of rows at a time. For rows
+    prepared this way the squared euclidean distance is 2 * (1 - r), where r is the Pearson correlation of the original
+    rows, so a fast euclidean neighbor search finds exactly the correlation neighbors. Rows that are constant are left
+    as zeros.
+
+    Args:
+        matrix (np.ndarray): Writable floating point data in (sample, gene) format.
+        block_size (int): Number of rows per block. Default None, chosen from the number of genes.
+
+    Returns:
+        np.ndarray: The input matrix, modified in place.
+    """
+    block_size = block_size or auto_block_size(matrix.shape[1])
+    for rows, block in iter_row_blocks(matrix, block_size):
+        block = block - block.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix[rows] = block / norms
+    return matrix
@@ -0,0 +1,134 @@
+import numpy as np
+from preprocessing import auto_block_size, iter_row_blocks
+
+"""
+Fixed point uint16 encoding of expression matrices. log2(TPM + 1) values span roughly 0 to 20, so 65536 evenly spaced
+levels between the minimum and maximum of the data give a step of about 3e-4 and a maximum rounding error of half a
+step. Values are stored as uint16 codes with an offset and a scale, either one pair for the whole matrix or one pair per
+gene, which is a quarter of the size of float64 values and far smaller than text.
+
+Functions:
+    quantization_parameters(minimum: np.ndarray, maximum: np.ndarray) -> tuple:
+        Offset and scale mapping a value range onto the uint16 codes.
+
+    encode(values: np.ndarray, offset: np.ndarray, scale: np.ndarray) -> np.ndarray:
+        Encode values to uint16 codes.
+
+    decode(codes: np.ndarray, offset: np.ndarray, scale: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        Decode uint16 codes back to values.
+
+    quantize_matrix(matrix: np.ndarray, per_gene: bool, block_size: int) -> tuple:
+        Encode a (sample, gene) matrix block by block.
+
+    dequantize_matrix(codes: np.ndarray, offset: np.ndarray, scale: np.ndarray, dtype: np.dtype,
+                      block_size: int) -> np.ndarray:
+        Decode a (sample, gene) matrix block by block.
+"""
+
+# Largest uint16 code
+QUANTIZATION_LEVELS = np.iinfo(np.uint16).max
+
+
+def quantization_parameters(minimum, maximum):
+    """
+    Offset and scale mapping the range [minimum, maximum] onto the codes 0 to 65535. Constant ranges get a scale of 1
+    so they decode exactly.
+
+    Args:
+        minimum (np.ndarray): Smallest value, one per gene or a single value.
+        maximum (np.ndarray): Largest value, one per gene or a single value.
+
+    Returns:
+        tuple: (offset, scale) float64 arrays. The largest rounding error is scale / 2.
+    """
+    offset = np.atleast_1d(np.asarray(minimum, dtype=np.float64))
+    scale = (np.atleast_1d(np.asarray(maximum, dtype=np.float64)) - offset) / QUANTIZATION_LEVELS
+    scale[scale == 0] = 1.0
+    return offset, scale
+
+
+def encode(values, offset, scale):
+    """
+    Encode values to uint16 codes, rounding to the nearest level.
+
+    Args:
+        values (np.ndarray): Values to encode. There should be no missing values ie no NaNs.
+        offset (np.ndarray): Offset broadcastable against values.
+        scale (np.ndarray): Scale broadcastable against values.
+
+    Returns:
+        np.ndarray: uint16 codes with the shape of values.
+    """
+    codes = np.rint((values - offset) / scale)
+    return np.clip(codes, 0, QUANTIZATION_LEVELS, out=codes).astype(np.uint16)
+
+
+def decode(codes, offset, scale, dtype=np.float32):
+    """
+    Decode uint16 codes back to values.
+
+    Args:
+        codes (np.ndarray): uint16 codes.
+        offset (np.ndarray): Offset broadcastable against codes.
+        scale (np.ndarray): Scale broadcastable against codes.
+        dtype (np.dtype): dtype of the values. Default np.float32, what the layouts work in.
+
+    Returns:
+        np.ndarray: Values with the shape of codes.
+    """
+    return (codes * scale + offset).astype(dtype, copy=False)
+
+
+def quantize_matrix(matrix, per_gene=False, block_size=None):
+    """
+    Encode a (sample, gene) matrix to uint16 codes in two passes over row blocks, one for the value range and one to
+    encode, so the matrix can be an np.memmap larger than memory.
+
+    Args:
+        matrix (np.ndarray): Expression data in (sample, gene) format. There should be no missing values ie no NaNs.
+        per_gene (bool): Whether each gene gets its own offset and scale, which is more precise for genes with a small
+            range. Default False, one offset and scale for the whole matrix.
+        block_size (int): Number of rows per block. Default None, chosen from the number of genes.
+
+    Returns:
+        tuple: (codes, offset, scale) where codes is a uint16 (sample, gene) array and offset and scale hold one value
+            per gene, or a single value.
+    """
+    block_size = block_size or auto_block_size(matrix.shape[1])
+    minimum = np.full(matrix.shape[1], np.inf)
+    maximum = np.full(matrix.shape[1], -np.inf)
+    for _, block in iter_row_blocks(matrix, block_size):
+        np.minimum(minimum, block.min(axis=0), out=minimum)
+        np.maximum(maximum, block.max(axis=0), out=maximum)
+    if np.isnan(minimum).any() or np.isnan(maximum).any():
+        raise ValueError("Cannot quantize a matrix with missing values.")
+    if not per_gene:
+        minimum, maximum = minimum.min(), maximum.max()
+    offset, scale = quantization_parameters(minimum, maximum)
+
+    codes = np.empty(matrix.shape, dtype=np.uint16)
+    for rows, block in iter_row_blocks(matrix, block_size):
+        codes[rows] = encode(block, offset, scale)
+    return codes, offset, scale
+
+
+def dequantize_matrix(codes, offset, scale, dtype=np.float32, block_size=None):
+    """
+    Decode a (sample, gene) matrix of uint16 codes block by block into a single C-contiguous array.
+
+    Args:
+        codes (np.ndarray): uint16 codes in (sample, gene) format.
+        offset (np.ndarray): One offset per gene, or a single value.
+        scale (np.ndarray): One scale per gene, or a single value.
+        dtype (np.dtype): dtype of the values. Default np.float32, what the layouts work in.
+        block_size (int): Number of rows per block. Default None, chosen from the number of genes.
+
+    Returns:
+        np.ndarray: The decoded (sample, gene) matrix.
+    """
+    block_size = block_size or auto_block_size(codes.shape[1])
+    matrix = np.empty(codes.shape, dtype=dtype)
+    for start in range(0, codes.shape[0], block_size):
+        rows = slice(start, min(start + block_size, codes.shape[0]))
+        matrix[rows] = decode(codes[rows], offset, scale, dtype)
+    return matrix
@@ -0,0 +1,195 @@
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from preprocessing import auto_block_size, iter_row_blocks, column_moments, center_and_normalize_rows
+
+"""
+Patient similarity search over a processed compendium. Genes are standardized like the layouts do, every sample is
+centered and normalized once, and an NN-descent index is built over the normalized samples. The squared euclidean
+distance between normalized samples is 2 * (1 - r), so a euclidean search returns the samples with the highest
+Pearson correlation to a query patient without scanning the whole compendium.
+
+Classes:
+    SimilarityIndex: Approximate correlation neighbor index with a query API and disk persistence.
+"""
+
+# Files of a saved index inside its directory
+INDEX_FILE = "index.pkl"
+METADATA_FILE = "metadata.npz"
+SETTINGS_FILE = "settings.json"
+# Spread in standard deviations below which a query counts as constant, ie rounding noise around the compendium mean
+CONSTANT_TOLERANCE = 1e-5
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest neighbor index returning the compendium samples most correlated to a query patient.
+
+    Build it with SimilarityIndex.build, or load a saved index with SimilarityIndex.load. Queries must be in the same
+    units as the processed compendium, ie log2(TPM + 1). Genes missing from a query are set to the mean of its present
+    genes after standardizing, so they are 0 once the query is centered and add nothing to the covariance or to the
+    norm of the query. The norm of each compendium sample still spans every indexed gene, so with missing genes the
+    reported correlation is the correlation over the present genes times the square root of the share of the sample's
+    variance on those genes. Neighbors are ranked by it, which favors samples varying mostly on the present genes, so
+    query with as many indexed genes as possible.
+
+    Args:
+        index (pynndescent.NNDescent): Euclidean index over the standardized, normalized samples.
+        sample_ids (pd.Index): Sample ids of the indexed rows.
+        gene_ids (pd.Index): Gene ids of the indexed columns.
+        mean (np.ndarray): Mean of each gene in the compendium.
+        scale (np.ndarray): Standard deviation of each gene in the compendium, 1 for constant genes.
+        clinical_df (pd.DataFrame): Clinical annotations indexed by sample id, joined to query results. Default None.
+    """
+
+    def __init__(self, index, sample_ids, gene_ids, mean, scale, clinical_df=None):
+        self.index = index
+        self.sample_ids = pd.Index(sample_ids)
+        self.gene_ids = pd.Index(gene_ids)
+        self.mean = mean
+        self.scale = scale
+        self.clinical_df = clinical_df
+
+    @classmethod
+    def build(cls, matrix, sample_ids, gene_ids, clinical_df=None, n_neighbors=30, random_state=42, n_jobs=-1,
+              copy=True):
+        """
+        Build an index over an expression matrix.
+
+        Args:
+            matrix (np.ndarray): Expression data in (sample, gene) format, ie from storage.read_expression_matrix.
+            sample_ids (pd.Index): Sample ids of the matrix rows.
+            gene_ids (pd.Index): Gene ids of the matrix columns.
+            clinical_df (pd.DataFrame): Clinical annotations indexed by sample id. Default None.
+            n_neighbors (int): Degree of the NN-descent graph. Higher values give better recall and slower builds.
+                Default 30.
+            random_state (int): Seed for the random projection trees. Default 42.
+            n_jobs (int): Number of threads used to build the graph. Default -1, all CPUs.
+            copy (bool): Whether the matrix must be left untouched. A writable float32 matrix passed with copy=False is
+                standardized and normalized in place. Default True.
+
+        Returns:
+            SimilarityIndex: The index, ready to query.
+        """
+        from pynndescent import NNDescent
+
+        block_size = auto_block_size(matrix.shape[1])
+        mean, scale = column_moments(matrix, block_size)
+        scale[scale == 0] = 1.0
+        mean, scale = mean.astype(np.float32), scale.astype(np.float32)
+
+        # Standardizing is folded into the row normalization, which runs block by block
+        in_place = (not copy and matrix.dtype == np.float32 and matrix.flags["C_CONTIGUOUS"]
+                    and matrix.flags["WRITEABLE"])
+        normalized = matrix if in_place else np.empty(matrix.shape, dtype=np.float32)
+        for rows, block in iter_row_blocks(matrix, block_size):
+            normalized[rows] = (block - mean) / scale
+        center_and_normalize_rows(normalized, block_size)
+
+        index = NNDescent(normalized, n_neighbors=min(n_neighbors, matrix.shape[0] - 1), metric="euclidean",
+                          random_state=random_state, n_jobs=n_jobs)
+        # Build the search graph now so the first query is fast
+        index.prepare()
+        return cls(index, sample_ids, gene_ids, mean, scale, clinical_df)
+
+    def prepare_query(self, expression):
+        """
+        Bring query patients onto the indexed genes, standardize them with the compendium statistics and normalize them.
+        Missing genes and missing values take the mean of the present standardized genes of their patient, so they are
+        0 after centering.
+
+        Args:
+            expression (pd.DataFrame or pd.Series): Expression in (gene, patient) format, or a single patient indexed by
+                gene.
+
+        Returns:
+            np.ndarray: (patient, gene) float32 array comparable to the indexed samples.
+
+        Raises:
+            ValueError: If a patient has no indexed gene, or the same standardized value for every present gene, since
+                its correlation is undefined.
+        """
+        if isinstance(expression, pd.Series):
+            expression = expression.to_frame()
+        # Drop duplicated genes so the reindex is well defined
+        expression = expression[~expression.index.duplicated()]
+        standardized = (expression.reindex(self.gene_ids).to_numpy(dtype=np.float32).T - self.mean) / self.scale
+        present = ~np.isnan(standardized)
+        n_present = present.sum(axis=1)
+        if (n_present == 0).any():
+            raise ValueError(f"Queries {list(expression.columns[n_present == 0])} have no indexed gene.")
+        means = np.where(present, standardized, 0).sum(axis=1, keepdims=True) / n_present[:, None]
+        standardized = np.where(present, standardized, means)
+        constant = np.ptp(standardized, axis=1) < CONSTANT_TOLERANCE
+        if constant.any():
+            raise ValueError(f"Queries {list(expression.columns[constant])} are constant over the indexed genes.")
+        return center_and_normalize_rows(standardized)
+
+    def query(self, expression, k=10, epsilon=0.1):
+        """
+        Find the k compendium samples most correlated to each query patient.
+
+        Args:
+            expression (pd.DataFrame or pd.Series): Expression in (gene, patient) format, or a single patient indexed by
+                gene.
+            k (int): Number of neighbors per patient. Default 10.
+            epsilon (float): Search breadth of pynndescent. Higher values give better recall and slower queries.
+                Default 0.1.
+
+        Returns:
+            pd.DataFrame: One row per neighbor, sorted by patient then decreasing correlation, with columns 'query',
+                'rank', 'sample_id', 'correlation' and the clinical columns when clinical data is attached.
+
+        Raises:
+            ValueError: If a patient has no indexed gene or is constant over them, see prepare_query.
+        """
+        queries = expression.columns if isinstance(expression, pd.DataFrame) else pd.Index([expression.name])
+        k = min(k, len(self.sample_ids))
+        indices, distances = self.index.query(self.prepare_query(expression), k=k, epsilon=epsilon)
+
+        neighbors_df = pd.DataFrame({
+            "query": np.repeat(queries, k),
+            "rank": np.tile(np.arange(1, k + 1), len(queries)),
+            "sample_id": self.sample_ids[indices.ravel()],
+            # For centered, unit length rows the squared euclidean distance is 2 * (1 - r)
+            "correlation": 1 - np.square(distances.ravel()) / 2,
+        })
+        if self.clinical_df is not None:
+            clinical_df = self.clinical_df[~self.clinical_df.index.duplicated()]
+            neighbors_df = neighbors_df.join(clinical_df, on="sample_id")
+        return neighbors_df
+
+    def save(self, directory):
+        """
+        Save the index to a directory. The NN-descent index is pickled, so only load indexes from trusted locations.
+
+        Args:
+            directory (str): Output directory. It is created if it does not exist.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, INDEX_FILE), "wb") as index_file:
+            pickle.dump(self.index, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        np.savez(os.path.join(directory, METADATA_FILE), sample_ids=self.sample_ids.to_numpy(dtype=str),
+                 gene_ids=self.gene_ids.to_numpy(dtype=str), mean=self.mean, scale=self.scale)
+        with open(os.path.join(directory, SETTINGS_FILE), "w") as settings_file:
+            json.dump({"n_samples": len(self.sample_ids), "n_genes": len(self.gene_ids)}, settings_file, indent=2)
+
+    @classmethod
+    def load(cls, directory, clinical_df=None):
+        """
+        Load an index saved with save.
+
+        Args:
+            directory (str): Directory of the saved index.
+            clinical_df (pd.DataFrame): Clinical annotations indexed by sample id. Default None.
+
+        Returns:
+            SimilarityIndex: The index, ready to query.
+        """
+        with open(os.path.join(directory, INDEX_FILE), "rb") as index_file:
+            index = pickle.load(index_file)
+        with np.load(os.path.join(directory, METADATA_FILE)) as metadata:
+            return cls(index, metadata["sample_ids"], metadata["gene_ids"], metadata["mean"], metadata["scale"],
+                       clinical_df)
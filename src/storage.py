@@ -0,0 +1,349 @@
+import importlib.util
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+from quantization import quantize_matrix, dequantize_matrix
+
+"""
+Reading processed compendia into the arrays layout algorithms work on. Compendia are stored as (gene, sample) TSV
+files, as quantized .npz files holding uint16 codes in (sample, gene) format, see the quantization module, or as sparse
+.sparse.npz files holding a (sample, gene) CSR matrix in the format of scipy.sparse.save_npz next to the sample and
+gene ids.
+
+TSV files are parsed either by the pandas C parser ('c') or by pyarrow's multithreaded CSV reader ('pyarrow'), which
+converts every column straight to float32 or float64 and is several times faster on multi-GB files. Install pyarrow
+with `pip install -e .[arrow]` to use it.
+
+Functions:
+    default_parser() -> str:
+        The fastest TSV parser available.
+
+    read_tsv(file_path: str, parser: str, **kwargs) -> pd.DataFrame:
+        Read a TSV file into a dataframe with the chosen parser.
+
+    read_expression_tsv(file_path: str, parser: str, dtype: np.dtype) -> tuple:
+        Parse a (gene, sample) TSV file into a C-contiguous (sample, gene) array.
+
+    read_tsv_header(file_path: str) -> list:
+        Read the column names of a TSV file.
+
+    read_expression_frame(file_path: str, parser: str, dtype: np.dtype) -> pd.DataFrame:
+        Parse a (gene, sample) TSV file into a (sample, gene) dataframe.
+
+    iter_expression_tsv(file_path: str, chunk_rows: int, parser: str, dtype: np.dtype):
+        Parse a (gene, sample) TSV file in chunks of genes.
+
+    read_expression_matrix(file_path: str, parser: str, sparse: bool) -> tuple:
+        Read a processed compendium into a C-contiguous float32 (sample, gene) array or a CSR matrix.
+
+    write_quantized_matrix(file_path: str, codes: np.ndarray, offset: np.ndarray, scale: np.ndarray,
+                           sample_ids: pd.Index, gene_ids: pd.Index):
+        Write uint16 codes and their offset and scale to a .npz file.
+
+    write_quantized_expression(file_path: str, matrix: np.ndarray, sample_ids: pd.Index, gene_ids: pd.Index,
+                               per_gene: bool):
+        Quantize a (sample, gene) matrix and write it to a .npz file.
+
+    read_quantized_matrix(file_path: str) -> tuple:
+        Read and decode a quantized .npz file.
+
+    write_sparse_expression_tsv(file_path: str, matrix: scipy.sparse.spmatrix, sample_ids: pd.Index,
+                                gene_ids: pd.Index, block_genes: int):
+        Write a sparse (sample, gene) matrix to a (gene, sample) TSV file one block of genes at a time.
+
+    write_sparse_expression(file_path: str, matrix: scipy.sparse.spmatrix, sample_ids: pd.Index, gene_ids: pd.Index):
+        Write a sparse (sample, gene) matrix and its ids to a .sparse.npz file.
+
+    read_sparse_expression(file_path: str, dtype: np.dtype) -> tuple:
+        Read a .sparse.npz file into a CSR matrix.
+"""
+
+# File extension of quantized compendia
+QUANTIZED_EXTENSION = ".npz"
+# File extension of sparse compendia, checked before QUANTIZED_EXTENSION
+SPARSE_EXTENSION = ".sparse.npz"
+# TSV parsers selectable with the parser arguments
+PARSERS = ("c", "pyarrow")
+# Rough size of one value in an expression TSV file, used to size the blocks pyarrow streams
+TEXT_BYTES_PER_VALUE = 12
+
+
+def default_parser():
+    """
+    The fastest TSV parser available, 'pyarrow' when it is installed and 'c' otherwise.
+    """
+    return "pyarrow" if importlib.util.find_spec("pyarrow") is not None else "c"
+
+
+def _check_parser(parser):
+    if parser not in PARSERS:
+        raise ValueError(f"Invalid parser '{parser}'. Use one of: {', '.join(PARSERS)}")
+
+
+def read_tsv(file_path, parser="c", **kwargs):
+    """
+    Read a TSV file into a dataframe, ie a clinical file with mixed column types.
+
+    Args:
+        file_path (str): Path to the TSV file.
+        parser (str): 'c' or 'pyarrow'. Default 'c'.
+        **kwargs: Arguments of pd.read_csv supported by both parsers, ie index_col, usecols and dtype.
+
+    Returns:
+        pd.DataFrame: The parsed file.
+    """
+    _check_parser(parser)
+    return pd.read_csv(file_path, sep="\t", engine=parser, **kwargs)
+
+
+def _arrow_csv_options(header, dtype):
+    """
+    pyarrow read, parse and convert options for a (gene, sample) TSV file with the given header. Columns are named by
+    their positions so any sample id parses, gene ids are read as strings and values straight to dtype.
+    """
+    import pyarrow as pa
+    from pyarrow import csv
+
+    column_names = [str(position) for position in range(len(header))]
+    value_type = pa.from_numpy_dtype(np.dtype(dtype))
+    column_types = {name: value_type for name in column_names[1:]}
+    column_types[column_names[0]] = pa.string()
+    return (csv.ReadOptions(column_names=column_names, skip_rows=1, use_threads=True),
+            csv.ParseOptions(delimiter="\t"),
+            csv.ConvertOptions(column_types=column_types))
+
+
+def _arrow_to_expression(table, header, dtype):
+    """
+    Copy the columns of a parsed pyarrow table or record batch into the rows of a (sample, gene) array.
+    """
+    matrix = np.empty((table.num_columns - 1, table.num_rows), dtype=dtype)
+    for row in range(len(matrix)):
+        matrix[row] = table.column(row + 1).to_numpy(zero_copy_only=False)
+    gene_ids = pd.Index(table.column(0).to_numpy(zero_copy_only=False), name=header[0] or None)
+    return matrix, pd.Index(header[1:]), gene_ids
+
+
+def read_tsv_header(file_path):
+    """
+    Read the column names of a TSV file.
+
+    Args:
+        file_path (str): Path to the TSV file.
+
+    Returns:
+        list: The column names, including the first one.
+    """
+    with open(file_path) as tsv_file:
+        return tsv_file.readline().rstrip("\r\n").split("\t")
+
+
+def read_expression_tsv(file_path, parser="c", dtype=np.float32):
+    """
+    Parse a (gene, sample) TSV file into a C-contiguous (sample, gene) array.
+
+    With the C parser values are parsed straight to dtype, and pandas stores the parsed columns sample by sample, so the
+    (sample, gene) array is a view of the parsed data rather than a transposed copy. With pyarrow every column is parsed
+    to dtype in parallel and copied into its row of the array.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        parser (str): 'c' or 'pyarrow'. Default 'c'.
+        dtype (np.dtype): dtype of the values. Default np.float32, what the layouts work in.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids) where matrix is an np.ndarray in (sample, gene) format and the ids are
+            pd.Index objects.
+    """
+    _check_parser(parser)
+    if parser == "pyarrow":
+        from pyarrow import csv
+        header = read_tsv_header(file_path)
+        read_options, parse_options, convert_options = _arrow_csv_options(header, dtype)
+        table = csv.read_csv(file_path, read_options=read_options, parse_options=parse_options,
+                             convert_options=convert_options)
+        return _arrow_to_expression(table, header, dtype)
+
+    header = pd.read_csv(file_path, sep="\t", index_col=0, nrows=0)
+    expression_df = pd.read_csv(file_path, sep="\t", index_col=0, dtype={sample: dtype for sample in header.columns})
+    matrix = np.ascontiguousarray(expression_df.to_numpy(dtype=dtype).T)
+    return matrix, expression_df.columns, expression_df.index
+
+
+def read_expression_frame(file_path, parser="c", dtype=np.float64):
+    """
+    Parse a (gene, sample) TSV file into a (sample, gene) dataframe, ie a raw compendium file.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        parser (str): 'c' or 'pyarrow'. Default 'c'.
+        dtype (np.dtype): dtype of the values. Default np.float64.
+
+    Returns:
+        pd.DataFrame: Expression data in (sample, gene) format indexed by sample id.
+    """
+    matrix, sample_ids, gene_ids = read_expression_tsv(file_path, parser=parser, dtype=dtype)
+    return pd.DataFrame(matrix, index=sample_ids, columns=gene_ids, copy=False)
+
+
+def iter_expression_tsv(file_path, chunk_rows, parser="c", dtype=np.float64):
+    """
+    Parse a (gene, sample) TSV file in chunks of genes. pyarrow streams blocks of bytes sized to hold about chunk_rows
+    genes, so chunks only approximately have chunk_rows genes.
+
+    Args:
+        file_path (str): Path to the expression TSV file.
+        chunk_rows (int): Number of gene rows per chunk.
+        parser (str): 'c' or 'pyarrow'. Default 'c'.
+        dtype (np.dtype): dtype of the values. Default np.float64.
+
+    Yields:
+        pd.DataFrame: A chunk of the file in (sample, gene) format.
+    """
+    _check_parser(parser)
+    if parser == "c":
+        for chunk in pd.read_csv(file_path, sep="\t", index_col=0, chunksize=chunk_rows):
+            yield chunk.T.astype(dtype, copy=False)
+        return
+
+    from pyarrow import csv
+    header = read_tsv_header(file_path)
+    read_options, parse_options, convert_options = _arrow_csv_options(header, dtype)
+    read_options.block_size = int(np.clip(chunk_rows * len(header) * TEXT_BYTES_PER_VALUE, 1 << 20, 1 << 30))
+    with csv.open_csv(file_path, read_options=read_options, parse_options=parse_options,
+                      convert_options=convert_options) as reader:
+        for batch in reader:
+            matrix, sample_ids, gene_ids = _arrow_to_expression(batch, header, dtype)
+            yield pd.DataFrame(matrix, index=sample_ids, columns=gene_ids, copy=False)
+
+
+def read_expression_matrix(file_path, parser="c", sparse=False):
+    """
+    Read a processed compendium into a C-contiguous float32 (sample, gene) array. Quantized .npz files are decoded, TSV
+    files are parsed with read_expression_tsv and sparse .sparse.npz files are read with read_sparse_expression.
+
+    Args:
+        file_path (str): Path to the expression TSV, .npz or .sparse.npz file, ie the processed compendium.
+        parser (str): 'c' or 'pyarrow', used for TSV files. Default 'c'.
+        sparse (bool): Whether a sparse compendium is returned as a float32 CSR matrix, for callers that accept one.
+            Default False, it is densified.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids) where matrix is a float32 np.ndarray in (sample, gene) format, or a CSR
+            matrix, and the ids are pd.Index objects.
+    """
+    if str(file_path).endswith(SPARSE_EXTENSION):
+        matrix, sample_ids, gene_ids = read_sparse_expression(file_path)
+        return (matrix if sparse else matrix.toarray()), sample_ids, gene_ids
+    if str(file_path).endswith(QUANTIZED_EXTENSION):
+        return read_quantized_matrix(file_path)
+    return read_expression_tsv(file_path, parser=parser, dtype=np.float32)
+
+
+def write_quantized_matrix(file_path, codes, offset, scale, sample_ids, gene_ids):
+    """
+    Write uint16 codes and their offset and scale to an uncompressed .npz file. Arrays are written in chunks, so codes
+    can be an np.memmap larger than memory.
+
+    Args:
+        file_path (str): Path of the .npz file.
+        codes (np.ndarray): uint16 codes in (sample, gene) format.
+        offset (np.ndarray): One offset per gene, or a single value.
+        scale (np.ndarray): One scale per gene, or a single value.
+        sample_ids (pd.Index): Sample ids of the rows.
+        gene_ids (pd.Index): Gene ids of the columns.
+    """
+    np.savez(file_path, codes=codes, offset=offset, scale=scale,
+             sample_ids=pd.Index(sample_ids).to_numpy(dtype=str), gene_ids=pd.Index(gene_ids).to_numpy(dtype=str),
+             gene_index_name=np.array(pd.Index(gene_ids).name or "", dtype=str))
+
+
+def write_quantized_expression(file_path, matrix, sample_ids, gene_ids, per_gene=False):
+    """
+    Quantize a (sample, gene) matrix and write it to a .npz file.
+
+    Args:
+        file_path (str): Path of the .npz file.
+        matrix (np.ndarray): Expression data in (sample, gene) format.
+        sample_ids (pd.Index): Sample ids of the rows.
+        gene_ids (pd.Index): Gene ids of the columns.
+        per_gene (bool): Whether each gene gets its own offset and scale. Default False, one for the whole matrix.
+    """
+    codes, offset, scale = quantize_matrix(matrix, per_gene=per_gene)
+    write_quantized_matrix(file_path, codes, offset, scale, sample_ids, gene_ids)
+
+
+def read_quantized_matrix(file_path):
+    """
+    Read and decode a quantized .npz file.
+
+    Args:
+        file_path (str): Path of the .npz file.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids) like read_expression_matrix.
+    """
+    with np.load(file_path) as quantized:
+        matrix = dequantize_matrix(quantized["codes"], quantized["offset"], quantized["scale"])
+        sample_ids = pd.Index(quantized["sample_ids"])
+        gene_ids = pd.Index(quantized["gene_ids"], name=str(quantized["gene_index_name"]) or None)
+    return matrix, sample_ids, gene_ids
+
+
+def write_sparse_expression_tsv(file_path, matrix, sample_ids, gene_ids, block_genes=1000):
+    """
+    Write a sparse (sample, gene) matrix to a (gene, sample) TSV file one block of genes at a time, so only one dense
+    block is held in memory. The file is identical to writing the dense dataframe transposed.
+
+    Args:
+        file_path (str): Path of the TSV file.
+        matrix (scipy.sparse.spmatrix): Expression data in (sample, gene) format.
+        sample_ids (pd.Index): Sample ids of the rows.
+        gene_ids (pd.Index): Gene ids of the columns.
+        block_genes (int): Number of genes per block. Default 1000.
+    """
+    matrix = matrix.tocsc()
+    header = pd.DataFrame(columns=sample_ids, index=pd.Index([], name=gene_ids.name))
+    header.to_csv(file_path, sep="\t")
+    for start in range(0, len(gene_ids), block_genes):
+        stop = min(start + block_genes, len(gene_ids))
+        block = pd.DataFrame(matrix[:, start:stop].toarray().T, index=gene_ids[start:stop], columns=sample_ids)
+        block.to_csv(file_path, sep="\t", mode="a", header=False)
+
+
+def write_sparse_expression(file_path, matrix, sample_ids, gene_ids):
+    """
+    Write a sparse (sample, gene) matrix to an uncompressed .npz file in the CSR format of scipy.sparse.save_npz, with
+    the sample and gene ids added, so the file can also be opened with scipy.sparse.load_npz.
+
+    Args:
+        file_path (str): Path of the .sparse.npz file.
+        matrix (scipy.sparse.spmatrix): Expression data in (sample, gene) format.
+        sample_ids (pd.Index): Sample ids of the rows.
+        gene_ids (pd.Index): Gene ids of the columns.
+    """
+    matrix = sp.csr_matrix(matrix)
+    np.savez(file_path, format=np.array("csr"), shape=np.array(matrix.shape), data=matrix.data,
+             indices=matrix.indices, indptr=matrix.indptr, sample_ids=pd.Index(sample_ids).to_numpy(dtype=str),
+             gene_ids=pd.Index(gene_ids).to_numpy(dtype=str),
+             gene_index_name=np.array(pd.Index(gene_ids).name or "", dtype=str))
+
+
+def read_sparse_expression(file_path, dtype=np.float32):
+    """
+    Read a sparse compendium written with write_sparse_expression.
+
+    Args:
+        file_path (str): Path of the .sparse.npz file.
+        dtype (np.dtype): dtype of the values. Default np.float32, what the layouts work in.
+
+    Returns:
+        tuple: (matrix, sample_ids, gene_ids) where matrix is a scipy.sparse.csr_matrix in (sample, gene) format and
+            the ids are pd.Index objects.
+    """
+    with np.load(file_path) as saved:
+        matrix = sp.csr_matrix((saved["data"].astype(dtype, copy=False), saved["indices"], saved["indptr"]),
+                               shape=tuple(saved["shape"]))
+        sample_ids = pd.Index(saved["sample_ids"])
+        gene_ids = pd.Index(saved["gene_ids"], name=str(saved["gene_index_name"]) or None)
+    return matrix, sample_ids, gene_ids
@@ -0,0 +1,127 @@
+import os
+import re
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+"""
+Batch layouts of sample subgroups, ie one layout per disease or per compendium. The expression matrix is loaded and
+standardized once by the caller, written to a temporary .npy file and memory mapped by every worker, so each process
+only materializes the rows of its own subgroup.
+
+Functions:
+    split_subgroups(labels: pd.Series, min_samples: int, groups: list = None) -> dict:
+        Map each clinical label to the positions of its samples.
+
+    subgroup_dir_name(group: str) -> str:
+        Turn a clinical label into a safe directory name.
+
+    subgroup_dir_names(groups: list) -> dict:
+        Turn clinical labels into distinct safe directory names.
+
+    fit_subgroup_layouts(matrix: np.ndarray, sample_ids: pd.Index, subgroups: dict, layout_class, layout_kwargs: dict,
+                         max_workers: int) -> dict:
+        Fit a layout for every subgroup in parallel across a process pool.
+"""
+
+def split_subgroups(labels, min_samples=30, groups=None):
+    """
+    Split samples into subgroups by a clinical label.
+
+    Args:
+        labels (pd.Series): Clinical label of each sample, in the order of the expression matrix. Samples with a missing
+            label are skipped.
+        min_samples (int): Subgroups with fewer samples are skipped because a layout of them is not meaningful.
+            Default 30.
+        groups (list): Only build these subgroups. Default None, build all subgroups.
+
+    Returns:
+        dict: Keys are labels and values are integer positions of the subgroup samples in the expression matrix.
+    """
+    codes, uniques = pd.factorize(labels, sort=True)
+    subgroups = {}
+    for code, group in enumerate(uniques):
+        if groups is not None and group not in groups:
+            continue
+        positions = np.flatnonzero(codes == code)
+        if len(positions) < min_samples:
+            logging.info(f"Skipping subgroup '{group}' with {len(positions)} samples (minimum {min_samples}).")
+            continue
+        subgroups[group] = positions
+    return subgroups
+
+
+def subgroup_dir_name(group):
+    """
+    Turn a clinical label into a directory name, ie 'Acute Myeloid Leukemia' -> 'acute_myeloid_leukemia'.
+
+    Args:
+        group (str): The clinical label.
+
+    Returns:
+        str: The directory name.
+    """
+    return re.sub(r"[^a-z0-9]+", "_", str(group).lower()).strip("_") or "unnamed"
+
+
+def subgroup_dir_names(groups):
+    """
+    Turn clinical labels into distinct directory names. Labels whose names collide, ie 'B-cell ALL' and 'B cell ALL',
+    get a short hash of the label appended so no subgroup overwrites another. Pass every label of the clinical column,
+    not only the subgroups being fit, so names do not depend on which subgroups are run.
+
+    Args:
+        groups (list): The clinical labels.
+
+    Returns:
+        dict: Keys are labels and values are directory names.
+    """
+    names = {group: subgroup_dir_name(group) for group in groups}
+    counts = pd.Series(list(names.values()), dtype=object).value_counts()
+    return {group: f"{name}_{hashlib.blake2b(str(group).encode(), digest_size=4).hexdigest()}"
+            if counts[name] > 1 else name for group, name in names.items()}
+
+
+def _fit_subgroup(matrix_path, positions, sample_ids, layout_class, layout_kwargs):
+    """
+    Worker for fit_subgroup_layouts. Memory maps the shared matrix and fits a layout on the subgroup rows.
+    """
+    matrix = np.load(matrix_path, mmap_mode="r")
+    return layout_class(**layout_kwargs).fit_transform_array(matrix[positions], sample_ids, copy=False)
+
+
+def fit_subgroup_layouts(matrix, sample_ids, subgroups, layout_class, layout_kwargs=None, max_workers=None):
+    """
+    Fit a layout on every subgroup in parallel across a process pool.
+
+    Args:
+        matrix (np.ndarray): Expression matrix in (sample, gene) format, already standardized if the layout expects it.
+        sample_ids (pd.Index): Sample ids of the matrix rows.
+        subgroups (dict): Subgroup positions as returned by split_subgroups.
+        layout_class (type): A BaseLayout subclass. It is constructed in each worker with layout_kwargs.
+        layout_kwargs (dict): Keyword arguments for the layout class. Default None, no arguments.
+        max_workers (int): Number of worker processes. Default None, one per CPU.
+
+    Returns:
+        dict: Keys are subgroup labels and values are layout dataframes indexed by sample id.
+    """
+    layout_kwargs = layout_kwargs or {}
+    layouts = {}
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        matrix_path = os.path.join(scratch_dir, "matrix.npy")
+        np.save(matrix_path, np.ascontiguousarray(matrix))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_fit_subgroup, matrix_path, positions, sample_ids[positions], layout_class,
+                                layout_kwargs): group
+                for group, positions in subgroups.items()
+            }
+            for future in as_completed(futures):
+                group = futures[future]
+                layouts[group] = future.result()
+                logging.info(f"Finished layout for subgroup '{group}' ({len(layouts[group])} samples).")
+    return layouts
@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+from src.gene_vocabulary import GeneVocabulary, build_coded_compendium, read_gene_aliases
+from src.preprocessing import assemble_expression_compendium, expression_statistics, merge_expression_statistics
+from src.preprocessing import process_expression_compendium, select_genes
+import pytest
+
+@pytest.fixture
+def expression_dict():
+    """
+    Three compendia with partially overlapping genes, in different orders, and a missing value.
+    """
+    rng = np.random.default_rng(0)
+    genes = [f"gene_{i}" for i in range(60)]
+    expression_dict = {}
+    for name, (start, stop) in {"one": (0, 40), "two": (20, 60), "three": (10, 50)}.items():
+        columns = pd.Index(rng.permutation(genes[start:stop]), name="Gene")
+        expression_dict[name] = pd.DataFrame(rng.gamma(2.0, 2.0, (5, len(columns))), columns=columns,
+                                             index=[f"{name}_{i}" for i in range(5)])
+    expression_dict["one"].iloc[2, 3] = np.nan
+    return expression_dict
+
+def test_encode_and_persist(tmp_path):
+    vocabulary = GeneVocabulary(["TP53", "MYCN"])
+    vocabulary.add_aliases({"P53": "TP53", "ALK1": "ALK", "MYCN": "MYC"})
+    # New alias targets, ALK and MYC, become symbols and the symbol MYCN is redirected to MYC
+    assert vocabulary.encode(["MYCN", "P53", "ALK1", "NOPE"]).tolist() == [3, 0, 2, -1]
+    assert vocabulary.encode(["NOPE", "ALK", "NOPE"], add=True).tolist() == [4, 2, 4]
+    assert vocabulary.decode([4, 3, 0]).tolist() == ["NOPE", "MYC", "TP53"]
+
+    file_path = tmp_path / "gene_vocabulary.npz"
+    vocabulary.save(file_path)
+    loaded = GeneVocabulary.load(file_path)
+    assert loaded.symbols.equals(vocabulary.symbols) and len(loaded) == 5
+    assert loaded.encode(["P53", "ALK1"]).dtype == np.int32
+    assert loaded.encode(["MYCN"]).tolist() == [3]
+
+    aliases_path = tmp_path / "aliases.tsv"
+    aliases_path.write_text("alias\tsymbol\nP53\tTP53\nEMPTY\t\n")
+    assert read_gene_aliases(aliases_path) == {"P53": "TP53"}
+
+def test_aliases_redirect_symbols_encoded_before(caplog):
+    """
+    A run without aliases encodes old symbols as genes of their own. Adding the aliases later should redirect them to
+    their current symbol, follow chains of renames and warn about aliases that would change an existing mapping.
+    """
+    vocabulary = GeneVocabulary()
+    assert vocabulary.encode(["OLD1", "NEW1"], add=True).tolist() == [0, 1]
+    vocabulary.add_aliases({"OLD1": "NEW1"})
+    assert vocabulary.encode(["OLD1", "NEW1"]).tolist() == [1, 1]
+
+    vocabulary.add_aliases({"NEW1": "NEWER", "OTHER": "OLD1"})
+    assert vocabulary.encode(["OLD1", "NEW1", "NEWER", "OTHER"]).tolist() == [2, 2, 2, 2]
+    assert vocabulary.decode([2]).tolist() == ["NEWER"]
+
+    # A current symbol of another alias and an already redirected symbol keep their codes
+    vocabulary.add_aliases({"OLD1": "ELSEWHERE", "NEWER": "NEW2", "NEW2": "NEWER"})
+    assert vocabulary.encode(["OLD1", "NEWER", "NEW2", "ELSEWHERE"]).tolist() == [2, 2, 4, 3]
+    assert "Ignored 3 gene aliases" in caplog.text
+
+@pytest.mark.parametrize("variance_threshold, minimum_expression", [(None, None), (20, None), (30, 3.5)])
+def test_build_coded_compendium_matches_labels(expression_dict, variance_threshold, minimum_expression):
+    """
+    Without aliases or duplicated genes, aligning on codes should give exactly the label based compendium, also when
+    the vocabulary already holds the genes in another order.
+    """
+    statistics = [expression_statistics(df) for df in expression_dict.values()]
+    genes = select_genes(merge_expression_statistics(statistics), variance_threshold, minimum_expression)
+    expected = assemble_expression_compendium(expression_dict, genes)
+    if variance_threshold is None and minimum_expression is None:
+        pd.testing.assert_frame_equal(expected, process_expression_compendium(expression_dict))
+
+    for vocabulary in (GeneVocabulary(), GeneVocabulary([f"gene_{i}" for i in range(59, -1, -1)])):
+        coded = build_coded_compendium(expression_dict, statistics, vocabulary, variance_threshold, minimum_expression)
+        pd.testing.assert_frame_equal(coded, expected, check_column_type=False)
+
+def test_build_coded_compendium_resolves_aliases(expression_dict):
+    """
+    A compendium using an old symbol should line up with the current symbol, and a symbol that appears twice should
+    use its first column.
+    """
+    renamed = dict(expression_dict)
+    renamed["two"] = expression_dict["two"].rename(columns={"gene_30": "old_30"})
+    duplicated = expression_dict["three"]
+    renamed["three"] = pd.concat([duplicated, duplicated[["gene_15"]] + 100], axis=1)
+    statistics = [expression_statistics(df) for df in renamed.values()]
+
+    vocabulary = GeneVocabulary()
+    vocabulary.add_aliases({"old_30": "gene_30"})
+    coded = build_coded_compendium(renamed, statistics, vocabulary)
+    expected = process_expression_compendium(expression_dict)
+    pd.testing.assert_frame_equal(coded, expected[coded.columns], check_column_type=False)
+    assert set(coded.columns) == set(expected.columns)
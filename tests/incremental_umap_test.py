@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial import procrustes
+from src.layout_algorithms.incremental_umap import MCMIncrementalUmap, remap_knn_graph, neighbor_positions
+from src.neighbors import prepare_exact_rows, exact_distances, update_nearest_neighbors
+
+@pytest.fixture
+def clustered_matrix():
+    """
+    Four clusters of samples. The last 30 samples are new in the current release.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(0, 3, (4, 50))
+    clusters = np.repeat(np.arange(4), 60)
+    matrix = centers[clusters] + rng.normal(0, 1, (240, 50))
+    sample_ids = pd.Index([f"sample_{i}" for i in range(240)])
+    return matrix, sample_ids
+
+def exact_graph(rows, n_neighbors, metric):
+    distances = exact_distances(rows, rows, metric)
+    indices = np.argsort(distances, axis=1, kind="stable")[:, :n_neighbors]
+    return indices, np.take_along_axis(distances, indices, axis=1)
+
+@pytest.mark.parametrize("metric", ["euclidean", "cosine", "correlation"])
+def test_update_nearest_neighbors_is_exact(clustered_matrix, metric):
+    """
+    Updating the graph of a previous release should give the exact graph of the current samples, after adding 30
+    samples and removing 10.
+    """
+    matrix, sample_ids = clustered_matrix
+    current = np.r_[np.arange(10, 240)]
+    rows = prepare_exact_rows(matrix, metric)
+    previous_indices, previous_distances = exact_graph(rows[:210], 10, metric)
+
+    indices, distances, new_rows, stale_rows = remap_knn_graph((sample_ids[:210], previous_indices, previous_distances),
+                                                               sample_ids[current], 10)
+    assert np.array_equal(new_rows, np.arange(200, 230))
+    updated_indices, updated_distances, updated_rows = update_nearest_neighbors(rows[current], indices, distances,
+                                                                                new_rows, stale_rows, metric=metric)
+    expected_indices, expected_distances = exact_graph(rows[current], 10, metric)
+    assert np.allclose(updated_distances, expected_distances, atol=1e-5)
+    assert (updated_indices == expected_indices).mean() > 0.99
+    assert len(updated_rows) < len(current)
+    assert np.isin(stale_rows, updated_rows).all()
+
+def test_neighbor_positions():
+    embedding = np.array([[0.0, 0.0], [2.0, 0.0], [0.0, 0.0], [0.0, 0.0]])
+    placed = np.array([True, True, False, False])
+    positions, found = neighbor_positions(embedding, placed, np.array([[0, 1, 3], [3, 2, -1]]),
+                                          np.array([[1.0, 1.0, 0.5], [0.5, 0.5, np.inf]]))
+    assert found.tolist() == [True, False]
+    assert np.allclose(positions[0], [1.0, 0.0])
+
+def test_incremental_layout_keeps_previous_positions(clustered_matrix):
+    """
+    Samples laid out before should stay close to their previous positions, and new samples should join their cluster.
+    """
+    matrix, sample_ids = clustered_matrix
+    rng = np.random.default_rng(1)
+    previous_layout = pd.DataFrame(np.repeat(np.array([[0, 0], [20, 0], [0, 20], [20, 20]]), 60, axis=0)
+                                   + rng.normal(0, 1, (240, 2)), index=sample_ids, columns=["x", "y"]).iloc[:210]
+    layout = MCMIncrementalUmap(previous_layout, n_neighbors=10, n_epochs=50)
+    layout_df = layout.fit_transform_array(matrix, sample_ids)
+
+    assert layout_df.index.equals(sample_ids)
+    assert np.array_equal(layout.new_samples_, np.arange(210, 240))
+    _, _, disparity = procrustes(previous_layout.to_numpy(), layout_df.iloc[:210].to_numpy())
+    assert disparity < 0.05
+    # New samples of the last cluster land next to the rest of it
+    cluster_center = layout_df.iloc[180:210].to_numpy().mean(axis=0)
+    assert np.linalg.norm(layout_df.iloc[210:].to_numpy().mean(axis=0) - cluster_center) < 5
+
+    with pytest.raises(ValueError, match="metric"):
+        MCMIncrementalUmap(previous_layout, metric="manhattan")
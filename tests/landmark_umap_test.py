@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.layout_algorithms.landmark_umap import MCMLandmarkUmap, stratified_sample, interpolate_positions
+from src.layout_algorithms.landmark_umap import landmark_quality_report
+
+def test_stratified_sample_keeps_proportions():
+    """
+    Every combination of compendium and disease should be represented in proportion to its size, and small strata
+    should still get a landmark.
+    """
+    strata = pd.DataFrame({
+        "compendium": ["a"] * 600 + ["b"] * 390 + ["b"] * 10,
+        "disease": ["x"] * 300 + ["y"] * 300 + ["x"] * 390 + ["z"] * 10,
+    })
+
+    positions = stratified_sample(strata, 100, random_state=0)
+
+    assert len(positions) == 100
+    assert len(np.unique(positions)) == 100
+    counts = strata.iloc[positions].value_counts()
+    assert counts[("a", "x")] == 30
+    assert counts[("a", "y")] == 30
+    assert counts[("b", "x")] == 39
+    assert counts[("b", "z")] == 1
+    assert np.array_equal(stratified_sample(strata, 2000), np.arange(1000))
+
+def test_interpolate_positions():
+    """
+    A sample equally far from two landmarks should land halfway, and a sample on top of a landmark should land closer
+    to it than to a distant one.
+    """
+    landmark_embedding = np.array([[0.0, 0.0], [2.0, 0.0], [10.0, 10.0]])
+    neighbors = np.array([[0, 1], [1, 0]])
+    distances = np.array([[1.0, 1.0], [0.0, 100.0]])
+
+    positions = interpolate_positions(landmark_embedding, neighbors, distances)
+
+    assert np.allclose(positions[0], [1.0, 0.0])
+    assert positions[1, 0] > 1.5 and np.isclose(positions[1, 1], 0.0)
+
+def test_landmark_quality_report():
+    """
+    Identical layouts up to rotation and scale should have full neighbor overlap and no Procrustes disparity.
+    """
+    rng = np.random.default_rng(0)
+    points = rng.normal(size=(100, 2))
+    rotation = np.array([[0.0, -1.0], [1.0, 0.0]])
+    index = [f"sample_{i}" for i in range(100)]
+    full_layout = pd.DataFrame(points, index=index, columns=["x", "y"])
+    landmark_layout = pd.DataFrame(3 * points @ rotation, index=index, columns=["x", "y"]).iloc[::-1]
+
+    report = landmark_quality_report(landmark_layout, full_layout, n_neighbors=10)
+
+    assert report["n_samples"] == 100
+    assert np.isclose(report["neighbor_overlap"], 1.0)
+    assert np.isclose(report["procrustes_disparity"], 0.0)
+
+def test_transform_placement_is_rejected_without_a_search_index():
+    """
+    UMAP keeps no search index for a precomputed kNN graph, so transform placement should be rejected up front with
+    knn_workers, like with fast_correlation.
+    """
+    with pytest.raises(ValueError, match="knn_workers"):
+        MCMLandmarkUmap(placement="transform", knn_workers=1)
+    with pytest.raises(ValueError, match="fast_correlation"):
+        MCMLandmarkUmap(placement="transform", fast_correlation=True)
+    assert MCMLandmarkUmap(placement="knn", knn_workers=1).knn_workers == 1
+
+@pytest.mark.parametrize("placement, fast_correlation", [("knn", False), ("transform", False), ("knn", True)])
+def test_fit_transform_array(placement, fast_correlation):
+    """
+    Landmarks should keep the positions of the landmark fit and every other sample should get a finite position, without
+    changing the input matrix. Compendia with no more samples than landmarks should get a full fit.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=3.0, size=(3, 40))
+    matrix = (centers[np.arange(600) % 3] + rng.normal(size=(600, 40))).astype(np.float32)
+    sample_index = pd.Index([f"sample_{i}" for i in range(600)])
+    original = matrix.copy()
+
+    layout = MCMLandmarkUmap(n_landmarks=200, placement=placement, fast_correlation=fast_correlation, batch_size=150)
+    fitted = {}
+    embed = layout.embed
+
+    def record_embed(landmark_matrix, copy=True):
+        fitted["embedding"], reducer = embed(landmark_matrix, copy=copy)
+        return fitted["embedding"], reducer
+    layout.embed = record_embed
+    embedding = layout.fit_transform_array(matrix, sample_index)
+
+    assert list(embedding.index) == list(sample_index)
+    assert len(layout.landmarks_) == 200
+    assert np.isfinite(embedding.to_numpy()).all()
+    assert np.array_equal(embedding.to_numpy()[layout.landmarks_], fitted["embedding"])
+    assert np.array_equal(matrix, original)
+
+    layout = MCMLandmarkUmap(n_landmarks=600, placement=placement, fast_correlation=fast_correlation)
+    embedding = layout.fit_transform_array(matrix, sample_index)
+    assert np.array_equal(layout.landmarks_, np.arange(600))
+    assert embedding.shape == (600, 2) and np.isfinite(embedding.to_numpy()).all()
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler
+from src.layout_algorithms.mcm_pca import MCMPca, randomized_pca
+import pytest
+
+@pytest.fixture
+def expression_matrix():
+    """
+    Create a low rank expression matrix with noise so the leading principal components are well separated.
+    """
+    rng = np.random.default_rng(0)
+    factors = rng.normal(size=(200, 3)) * [6.0, 3.0, 1.0]
+    return factors @ rng.normal(size=(3, 80)) + rng.normal(size=(200, 80)) + 5.0
+
+@pytest.mark.parametrize("standardize", [True, False])
+def test_randomized_pca_matches_exact_pca(expression_matrix, standardize):
+    """
+    The streaming randomized SVD should match exact PCA up to the sign of each component, regardless of block size.
+    """
+    data = StandardScaler().fit_transform(expression_matrix) if standardize else expression_matrix
+    exact_scores = PCA(n_components=2).fit_transform(data)
+
+    for block_size in [7, 200]:
+        scores, components, mean, scale, _ = randomized_pca(expression_matrix, n_components=2, standardize=standardize,
+                                                            block_size=block_size)
+        assert scores.shape == (200, 2)
+        assert components.shape == (2, 80)
+        assert np.allclose(np.abs(scores), np.abs(exact_scores), atol=1e-6)
+        assert np.allclose(mean, expression_matrix.mean(axis=0))
+
+def test_mcm_pca_memmap_input(tmp_path, expression_matrix):
+    """
+    MCMPca should lay out a DataFrame wrapping a read only memmap and return sample ids with 'x' and 'y' columns.
+    """
+    np.save(tmp_path / "matrix.npy", expression_matrix)
+    matrix = np.load(tmp_path / "matrix.npy", mmap_mode="r")
+    samples = [f"sample_{i}" for i in range(matrix.shape[0])]
+    expression_df = pd.DataFrame(matrix, index=samples, copy=False)
+
+    layout_df = MCMPca(block_size=16).fit_transform(expression_df)
+
+    assert list(layout_df.columns) == ["x", "y"]
+    assert list(layout_df.index) == samples
+    assert np.allclose(layout_df.to_numpy(), MCMPca().fit_transform(pd.DataFrame(expression_matrix, index=samples)))
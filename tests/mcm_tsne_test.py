@@ -0,0 +1,47 @@
+import os
+import numpy as np
+import pandas as pd
+from src.layout_algorithms.mcm_tsne import MCMTsne
+import pytest
+
+@pytest.fixture
+def expression_df():
+    """
+    Create expression data with three well separated groups of samples.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(3, 40)) * 4
+    labels = np.repeat([0, 1, 2], 60)
+    samples = [f"sample_{i}" for i in range(len(labels))]
+    return pd.DataFrame(centers[labels] + rng.normal(size=(len(labels), 40)), index=samples)
+
+def test_mcm_tsne_reuses_cached_affinities(tmp_path, expression_df):
+    """
+    A second layout with a different exaggeration should reuse the cached affinities and a new perplexity should reuse
+    the cached kNN graph, while returning a layout in the expected format.
+    """
+    tsne = MCMTsne(perplexity=10, early_exaggeration_iter=50, n_iter=100, cache_dir=str(tmp_path))
+    layout_df = tsne.fit_transform(expression_df)
+
+    assert list(layout_df.columns) == ["x", "y"]
+    assert list(layout_df.index) == list(expression_df.index)
+    assert np.isfinite(layout_df.to_numpy()).all()
+
+    cached_files = sorted(os.listdir(tmp_path))
+    assert len([name for name in cached_files if name.startswith("knn-")]) == 1
+    assert len([name for name in cached_files if name.startswith("affinities-")]) == 1
+
+    # A new instance loads the affinities from disk. Changing the exaggeration does not create new affinities.
+    second = MCMTsne(perplexity=10, exaggeration=2, early_exaggeration_iter=50, n_iter=100, cache_dir=str(tmp_path))
+    second.fit_transform(expression_df)
+    assert sorted(os.listdir(tmp_path)) == cached_files
+    P_first, = tsne._affinities.values()
+    P_second, = second._affinities.values()
+    assert abs(P_first - P_second).max() == 0
+    assert np.isclose(P_first.sum(), 1.0)
+
+    # A smaller perplexity reuses the kNN graph and only adds an affinity file
+    second.perplexity = 5
+    second.fit_transform(expression_df)
+    new_files = set(os.listdir(tmp_path)) - set(cached_files)
+    assert len(new_files) == 1 and new_files.pop().startswith("affinities-")
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from scipy import sparse as sp
+from scipy.spatial.distance import cdist
+from src.layout_algorithms.mcm_umap import MCMUmap
+from src.preprocessing import center_and_normalize_rows
+from src.neighbors import nearest_neighbors, sharded_nearest_neighbors
+
+def test_center_and_normalize_rows():
+    """
+    Rows should end up centered with unit norm, constant rows should become zeros, and squared euclidean distances
+    should be twice the correlation distances of the original rows.
+    """
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(20, 30))
+    matrix[5] = 3.0
+    original = matrix.copy()
+
+    normalized = center_and_normalize_rows(matrix, block_size=6)
+    assert normalized is matrix
+    assert np.allclose(matrix.mean(axis=1), 0)
+    assert np.allclose(np.delete(np.linalg.norm(matrix, axis=1), 5), 1)
+    assert np.array_equal(matrix[5], np.zeros(30))
+
+    rows = np.delete(np.arange(20), 5)
+    squared = cdist(matrix[rows], matrix[rows], "sqeuclidean")
+    assert np.allclose(squared / 2, cdist(original[rows], original[rows], "correlation"))
+
+def test_fast_correlation_neighbors_match_correlation():
+    """
+    The fast correlation neighbor search should find correlation neighbors at least as well as an approximate search
+    with the correlation metric, report correlation distances and leave the input untouched when copying.
+    """
+    rng = np.random.default_rng(1)
+    matrix = (rng.normal(size=(300, 50)) + rng.normal(size=(300, 1)) * 5).astype(np.float32)
+    original = matrix.copy()
+
+    indices, distances, _ = MCMUmap(n_neighbors=10).correlation_neighbors(matrix)
+    assert np.array_equal(matrix, original)
+
+    exact = cdist(original.astype(np.float64), original.astype(np.float64), "correlation")
+    exact_indices = np.argsort(exact, axis=1)[:, :10]
+    def recall(found_indices):
+        return np.mean([len(set(found) & set(expected)) / 10 for found, expected in zip(found_indices, exact_indices)])
+
+    correlation_indices, _ = nearest_neighbors(original, 10, metric="correlation")
+    assert recall(indices) > 0.9
+    assert recall(indices) >= recall(correlation_indices)
+    assert np.allclose(distances, np.take_along_axis(exact, indices, axis=1), atol=1e-5)
+
+def test_sparse_input():
+    """
+    Sparse matrices and dataframes with sparse columns should be laid out without densifying, and fast correlation
+    should be rejected for sparse input.
+    """
+    rng = np.random.default_rng(2)
+    values = rng.gamma(0.5, 2.0, (60, 40)) * (rng.random((60, 40)) < 0.3)
+    sample_ids = pd.Index([f"sample_{i}" for i in range(60)])
+
+    layout = MCMUmap(n_neighbors=5).fit_transform_array(sp.csr_matrix(values), sample_ids)
+    assert list(layout.columns) == ["x", "y"] and list(layout.index) == list(sample_ids)
+    assert np.isfinite(layout.to_numpy()).all()
+
+    sparse_df = pd.DataFrame.sparse.from_spmatrix(sp.csr_matrix(values), index=sample_ids)
+    pd.testing.assert_frame_equal(MCMUmap(n_neighbors=5).fit_transform(sparse_df), layout)
+
+    with pytest.raises(ValueError):
+        MCMUmap(fast_correlation=True).fit_transform_array(sp.csr_matrix(values), sample_ids)
+
+@pytest.mark.parametrize("metric", ["euclidean", "cosine", "correlation"])
+def test_sharded_nearest_neighbors_are_exact(metric):
+    """
+    Shards searched in worker processes or by any executor should give the exact graph, with each sample first in its
+    own row even when it has a duplicate.
+    """
+    rng = np.random.default_rng(3)
+    matrix = rng.normal(size=(101, 20)) + rng.normal(size=(101, 1)) * 3
+    matrix[7] = matrix[3]
+    exact = cdist(matrix, matrix, "sqeuclidean" if metric == "euclidean" else metric)
+    np.fill_diagonal(exact, -1)
+
+    indices, distances = sharded_nearest_neighbors(matrix, 8, metric=metric, n_workers=3, block_size=10)
+    assert indices.shape == (101, 8)
+    assert np.array_equal(indices[:, 0], np.arange(101)) and np.all(distances[:, 0] == 0)
+    assert np.array_equal(np.sort(indices[:, 1:], axis=1), np.sort(np.argsort(exact, axis=1)[:, 1:8], axis=1))
+    expected = np.sort(exact, axis=1)[:, 1:8]
+    assert np.allclose(distances[:, 1:], np.sqrt(expected) if metric == "euclidean" else expected, atol=1e-4)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        threaded = sharded_nearest_neighbors(matrix, 8, metric=metric, n_workers=4, executor=executor)
+    assert np.array_equal(threaded[0], indices)
+
+def test_sharded_umap_layout():
+    """
+    UMAP should lay out samples from the sharded exact graph, and reject metrics that cannot be searched exactly.
+    """
+    rng = np.random.default_rng(4)
+    matrix = rng.normal(size=(200, 30)) + np.repeat(rng.normal(0, 4, (2, 30)), 100, axis=0)
+    sample_ids = pd.Index([f"sample_{i}" for i in range(200)])
+    layout = MCMUmap(n_neighbors=10, knn_workers=2)
+    layout_df = layout.fit_transform_array(matrix, sample_ids)
+
+    assert layout_df.index.equals(sample_ids) and np.isfinite(layout_df.to_numpy()).all()
+    assert layout.knn_indices_.shape == (200, 10)
+    assert np.array_equal(layout.knn_indices_[:, 0], np.arange(200))
+    with pytest.raises(ValueError, match="metric"):
+        MCMUmap(metric="manhattan", knn_workers=2)
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.manifold import trustworthiness
+from sklearn.metrics import silhouette_samples
+from src.metrics import embedding_metrics, label_mixing, label_silhouette, neighbor_preservation, write_metrics
+from src.preprocessing import standardize_matrix
+
+@pytest.fixture
+def clustered_data():
+    """
+    Three clusters of samples in expression space, from two compendia, with a layout that keeps the clusters apart.
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.normal(0, 3, (3, 40))
+    clusters = np.repeat(np.arange(3), 30)
+    matrix = centers[clusters] + rng.normal(0, 1, (90, 40))
+    sample_ids = pd.Index([f"sample_{i}" for i in range(90)])
+    layout_df = pd.DataFrame(np.array([[0, 0], [10, 0], [0, 10]])[clusters] + rng.normal(0, 1, (90, 2)),
+                             index=sample_ids, columns=["x", "y"])
+    labels_df = pd.DataFrame({
+        "disease": pd.Categorical(np.array(["a", "b", "c"])[clusters]),
+        "compendium": pd.Categorical(np.where(np.arange(90) % 2, "polyA", "ribo")),
+    }, index=sample_ids)
+    return matrix, layout_df, labels_df
+
+def test_trustworthiness_matches_sklearn(clustered_data):
+    """
+    With every sample as a query, trustworthiness should match sklearn's exact computation with correlation distance on
+    standardized genes.
+    """
+    matrix, layout_df, labels_df = clustered_data
+    metrics = embedding_metrics(matrix, layout_df, labels_df, n_neighbors=10, n_queries=len(matrix), batch_size=17)
+    expected = trustworthiness(standardize_matrix(matrix), layout_df.to_numpy(), n_neighbors=10, metric="correlation")
+    assert metrics["n_queries"] == len(matrix)
+    assert metrics["trustworthiness"] == pytest.approx(expected, abs=1e-6)
+    assert metrics["knn_preservation_source"] == "queries"
+
+    # Subsampled queries estimate the same value
+    sampled = embedding_metrics(matrix, layout_df, labels_df, n_neighbors=10, n_queries=45)
+    assert sampled["n_queries"] == 45
+    assert sampled["trustworthiness"] == pytest.approx(expected, abs=0.05)
+
+def test_knn_preservation_reuses_graph(clustered_data):
+    """
+    A graph passed in should be used for kNN preservation over every sample and agree with exact query neighbors.
+    """
+    matrix, layout_df, labels_df = clustered_data
+    normalized = standardize_matrix(matrix)
+    normalized = normalized - normalized.mean(axis=1, keepdims=True)
+    normalized /= np.linalg.norm(normalized, axis=1, keepdims=True)
+    knn_indices = np.argsort(-(normalized @ normalized.T), axis=1)[:, :11]
+
+    from_graph = embedding_metrics(matrix, layout_df, labels_df, n_neighbors=10, knn_indices=knn_indices,
+                                   n_queries=len(matrix))
+    from_queries = embedding_metrics(matrix, layout_df, labels_df, n_neighbors=10, n_queries=len(matrix))
+    assert from_graph["knn_preservation_source"] == "graph"
+    assert from_graph["knn_preservation"] == pytest.approx(from_queries["knn_preservation"])
+
+def test_neighbor_preservation():
+    neighbors = np.array([[1, 2], [0, 2], [0, 1]])
+    assert neighbor_preservation(neighbors, neighbors) == 1.0
+    assert neighbor_preservation(np.array([[1, -1], [0, -1], [0, -1]]), neighbors) == 0.5
+
+def test_label_mixing():
+    """
+    Neighborhoods drawn from one compendium should have zero entropy and be rejected by the kBET test, while evenly
+    mixed neighborhoods should have full entropy and be accepted.
+    """
+    labels = pd.Series(["polyA", "ribo"] * 10)
+    separated = np.array([[(i + 2 * j) % 20 for j in range(1, 7)] for i in range(20)])
+    mixed = np.array([[(i + j) % 20 for j in range(1, 7)] for i in range(20)])
+
+    assert label_mixing(labels, separated)["entropy"] == 0.0
+    assert label_mixing(labels, separated)["kbet_acceptance"] == 0.0
+    mixing = label_mixing(labels, mixed)
+    assert mixing["entropy"] == pytest.approx(1.0) and mixing["kbet_acceptance"] == 1.0
+    assert set(mixing["per_label"]) == {"polyA", "ribo"}
+    assert label_mixing(pd.Series(["a"] * 20), mixed)["entropy"] is None
+
+def test_label_silhouette_matches_sklearn(clustered_data):
+    _, layout_df, labels_df = clustered_data
+    points = layout_df.to_numpy()
+    labels = labels_df["disease"].astype(object)
+    labels.iloc[5] = None
+
+    silhouette = label_silhouette(points, labels, np.arange(len(points)), batch_size=7)
+    labelled = labels.notna().to_numpy()
+    expected = silhouette_samples(points[labelled], labels[labelled])
+    assert silhouette["mean"] == pytest.approx(expected.mean())
+    assert silhouette["per_label"]["b"] == pytest.approx(expected[labels[labelled] == "b"].mean())
+
+def test_write_metrics(tmp_path, clustered_data):
+    from src.layout_algorithms.mcm_pca import MCMPca
+    import json
+
+    matrix, layout_df, labels_df = clustered_data
+    path = tmp_path / "metrics.json"
+    write_metrics(path, embedding_metrics(matrix, layout_df, labels_df), MCMPca())
+    report = json.loads(path.read_text())
+    assert report["layout"] == "MCMPca" and report["parameters"]["standardize"] is True
+    assert set(report["compendium_mixing"]) == {"entropy", "kbet_acceptance", "per_label"}
+    assert report["disease_silhouette"]["mean"] > 0.5
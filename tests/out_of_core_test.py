@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+from src.preprocessing import process_expression_compendium
+from src.out_of_core import process_expression_files_blockwise, parse_memory_size, choose_chunk_rows
+from src.out_of_core import compendium_statistics, load_cached_statistics, select_compendium_genes
+from src.out_of_core import statistics_cache_path
+from src.preprocessing import assemble_expression_compendium
+import os
+from src.quantization import quantize_matrix
+from src.storage import read_expression_matrix
+import pytest
+
+@pytest.fixture
+def expression_files(tmp_path):
+    """
+    Write two (gene, sample) expression files with partially overlapping genes and a missing value. Returns the file
+    paths and the matching expression_dict in (sample, gene) format.
+    """
+    rng = np.random.default_rng(0)
+    genes1 = [f"gene_{i}" for i in range(40)]
+    genes2 = [f"gene_{i}" for i in range(20, 55)]
+    df1 = pd.DataFrame(rng.gamma(2.0, 2.0, (40, 7)), index=pd.Index(genes1, name="Gene"),
+                       columns=[f"A_{i}" for i in range(7)])
+    df2 = pd.DataFrame(rng.gamma(2.0, 2.0, (35, 5)), index=pd.Index(genes2, name="Gene"),
+                       columns=[f"B_{i}" for i in range(5)])
+    df1.iloc[3, 2] = np.nan
+    df2.iloc[4, :] = 0.0
+
+    paths = [str(tmp_path / "one_expression.tsv"), str(tmp_path / "two_expression.tsv")]
+    df1.to_csv(paths[0], sep="\t")
+    df2.to_csv(paths[1], sep="\t")
+
+    expression_dict = {path: pd.read_csv(path, sep="\t", index_col=0).T for path in paths}
+    return paths, expression_dict
+
+def test_parse_memory_size():
+    assert parse_memory_size(1000) == 1000
+    assert parse_memory_size("512M") == 512 * 1024 ** 2
+    assert parse_memory_size("1.5GB") == int(1.5 * 1024 ** 3)
+    with pytest.raises(ValueError):
+        parse_memory_size("lots")
+
+def test_choose_chunk_rows():
+    assert choose_chunk_rows(1, 1000) == 1
+    assert choose_chunk_rows(parse_memory_size("1G"), 1000) > choose_chunk_rows(parse_memory_size("1M"), 1000)
+
+@pytest.mark.parametrize("variance_threshold, minimum_expression", [(None, None), (20, None), (None, 3.0), (30, 2.5)])
+def test_blockwise_matches_in_memory(tmp_path, expression_files, variance_threshold, minimum_expression):
+    """
+    The blockwise path should write exactly the same file as the in memory path, even when the memory budget forces
+    one gene per chunk.
+    """
+    paths, expression_dict = expression_files
+    in_memory_path = tmp_path / "in_memory.tsv"
+    blockwise_path = tmp_path / "blockwise.tsv"
+
+    processed = process_expression_compendium(expression_dict, variance_threshold, minimum_expression)
+    processed.T.to_csv(in_memory_path, sep="\t")
+    genes = process_expression_files_blockwise(paths, str(blockwise_path), max_memory=1,
+                                               variance_threshold=variance_threshold,
+                                               minimum_expression=minimum_expression)
+
+    assert list(genes) == list(processed.columns)
+    assert blockwise_path.read_text() == in_memory_path.read_text()
+
+def test_blockwise_pyarrow_parser(tmp_path, expression_files):
+    """
+    The blockwise path should select the same genes and values with the pyarrow parser.
+    """
+    paths, _ = expression_files
+    c_path = tmp_path / "c.tsv"
+    arrow_path = tmp_path / "arrow.tsv"
+    c_genes = process_expression_files_blockwise(paths, str(c_path), max_memory=1, variance_threshold=20)
+    arrow_genes = process_expression_files_blockwise(paths, str(arrow_path), max_memory=1, variance_threshold=20,
+                                                     parser="pyarrow")
+    assert list(arrow_genes) == list(c_genes)
+    assert np.allclose(read_expression_matrix(arrow_path)[0], read_expression_matrix(c_path)[0])
+
+@pytest.mark.parametrize("quantize", ["global", "per_gene"])
+def test_blockwise_quantized_matches_in_memory(tmp_path, expression_files, quantize):
+    """
+    The blockwise path should write the same codes as quantizing the in memory result.
+    """
+    paths, expression_dict = expression_files
+    processed = process_expression_compendium(expression_dict, variance_threshold=20)
+    codes, offset, scale = quantize_matrix(processed.to_numpy(), per_gene=quantize == "per_gene")
+
+    blockwise_path = tmp_path / "blockwise.npz"
+    process_expression_files_blockwise(paths, str(blockwise_path), max_memory=1, variance_threshold=20,
+                                       quantize=quantize)
+
+    with np.load(blockwise_path) as quantized:
+        assert np.array_equal(quantized["codes"], codes)
+        assert np.array_equal(quantized["offset"], offset)
+        assert np.array_equal(quantized["scale"], scale)
+    matrix, sample_ids, gene_ids = read_expression_matrix(str(blockwise_path))
+    assert list(sample_ids) == list(processed.index)
+    assert list(gene_ids) == list(processed.columns)
+    assert gene_ids.name == "Gene"
+
+def test_statistics_cache(expression_files):
+    """
+    Statistics should be cached beside each file, reused while the file is unchanged and ignored once it changes.
+    """
+    paths, expression_dict = expression_files
+    assert load_cached_statistics(paths[0]) is None
+
+    statistics = compendium_statistics(paths[0], chunk_rows=3)
+    assert os.path.exists(statistics_cache_path(paths[0]))
+    pd.testing.assert_frame_equal(load_cached_statistics(paths[0]), statistics)
+
+    stat = os.stat(paths[0])
+    os.utime(paths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load_cached_statistics(paths[0]) is None
+
+@pytest.mark.parametrize("variance_threshold, minimum_expression", [(None, None), (20, None), (None, 3.0), (30, 2.5)])
+def test_select_compendium_genes_matches_in_memory(expression_files, variance_threshold, minimum_expression):
+    """
+    Genes selected from cached statistics should match the in memory path for every combination of compendia, and
+    assembling the compendium from them should give the same dataframe.
+    """
+    paths, expression_dict = expression_files
+    for subset in ([paths[0]], [paths[1]], paths):
+        subset_dict = {path: expression_dict[path] for path in subset}
+        processed = process_expression_compendium(subset_dict, variance_threshold, minimum_expression)
+        genes, statistics = select_compendium_genes(subset, variance_threshold, minimum_expression)
+
+        assert list(genes) == list(processed.columns)
+        assert statistics["count"].max() == len(processed)
+        pd.testing.assert_frame_equal(assemble_expression_compendium(subset_dict, genes), processed)
@@ -0,0 +1,102 @@
+import threading
+import time
+import pytest
+from src.pipeline import Pipeline
+
+def test_pipeline_passes_results():
+    """
+    Test that stages receive the results of their dependencies and that only the requested outputs are returned.
+    """
+    pipeline = Pipeline()
+    pipeline.add_stage("total", lambda left, right: left + right, dependencies=["left", "right"])
+    pipeline.add_stage("left", lambda: 2)
+    pipeline.add_stage("right", lambda: 3)
+    pipeline.add_stage("double", lambda total: 2 * total, dependencies=["total"])
+
+    assert pipeline.order().index("total") > max(pipeline.order().index("left"), pipeline.order().index("right"))
+    assert pipeline.run(outputs=["double"]) == {"double": 10}
+    assert pipeline.run() == {"left": 2, "right": 3, "total": 5, "double": 10}
+
+def test_pipeline_runs_independent_stages_concurrently():
+    """
+    Test that independent stages overlap. Each stage waits for the other at a barrier, which would time out if they
+    ran one after the other.
+    """
+    barrier = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline()
+    pipeline.add_stage("expression", lambda: barrier.wait() is not None)
+    pipeline.add_stage("clinical", lambda: barrier.wait() is not None)
+    assert pipeline.run() == {"expression": True, "clinical": True}
+
+def test_pipeline_errors():
+    pipeline = Pipeline()
+    pipeline.add_stage("a", lambda b: b, dependencies=["b"])
+    pipeline.add_stage("b", lambda a: a, dependencies=["a"])
+    with pytest.raises(ValueError, match="cycle"):
+        pipeline.run()
+
+    pipeline = Pipeline()
+    pipeline.add_stage("a", lambda missing: missing, dependencies=["missing"])
+    with pytest.raises(ValueError, match="unknown"):
+        pipeline.run()
+    with pytest.raises(ValueError, match="already"):
+        pipeline.add_stage("a", lambda: None)
+
+    # A failing stage stops the stages depending on it
+    started = []
+    pipeline = Pipeline()
+    pipeline.add_stage("fail", lambda: 1 / 0)
+    pipeline.add_stage("after", lambda fail: started.append(fail), dependencies=["fail"])
+    with pytest.raises(ZeroDivisionError):
+        pipeline.run()
+    assert started == []
+
+def recording_stage(name, running, overlaps, seconds=0.05):
+    """
+    A stage that records which stages run while it runs and returns its name.
+    """
+    def run(**kwargs):
+        running.add(name)
+        overlaps.append(set(running))
+        time.sleep(seconds)
+        overlaps.append(set(running))
+        running.discard(name)
+        return name
+    return run
+
+def test_pipeline_memory_budget():
+    """
+    Test that stages only overlap while their estimates fit in the budget, that a stage over the budget runs alone,
+    and that dependencies can be passed under another keyword argument name.
+    """
+    running, overlaps = set(), []
+    pipeline = Pipeline()
+    pipeline.add_stage("big_a", recording_stage("big_a", running, overlaps), memory=6)
+    pipeline.add_stage("big_b", recording_stage("big_b", running, overlaps), memory=6)
+    pipeline.add_stage("small", recording_stage("small", running, overlaps), memory=3)
+    pipeline.add_stage("huge", lambda data: running.add("huge") or overlaps.append(set(running)) or data.upper(),
+                       dependencies={"data": "big_b"}, memory=lambda data: 20)
+    assert pipeline.run(outputs=["huge"], max_memory=10) == {"huge": "BIG_B"}
+
+    assert not any({"big_a", "big_b"} <= overlap for overlap in overlaps)
+    assert {"big_a", "small"} in overlaps
+    assert overlaps[-1] == {"huge"}
+
+def test_pipeline_memory_budget_counts_held_results():
+    """
+    Test that a result held for a later stage keeps its memory reserved until that stage finishes.
+    """
+    running, overlaps = set(), []
+    pipeline = Pipeline()
+    pipeline.add_stage("load", recording_stage("load", running, overlaps), memory=2, result_memory=lambda result: 8)
+    pipeline.add_stage("use", recording_stage("use", running, overlaps, seconds=0.2), dependencies={"data": "load"},
+                       memory=2)
+    pipeline.add_stage("gate", lambda: time.sleep(0.1))
+    pipeline.add_stage("other", recording_stage("other", running, overlaps), dependencies=["gate"], memory=4)
+    pipeline.run(outputs=[], max_memory=10)
+
+    assert not any({"use", "other"} <= overlap for overlap in overlaps)
+    # Without a budget, the stages overlap
+    overlaps.clear()
+    pipeline.run(outputs=[])
+    assert any({"use", "other"} <= overlap for overlap in overlaps)
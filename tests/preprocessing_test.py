@@ -1,6 +1,13 @@
+import numpy as np
 import pandas as pd
 from src.preprocessing import process_expression_compendium, process_clinical_compendium
+from src.preprocessing import build_sample_index, align_clinical, standardize_matrix
+from src.preprocessing import save_sample_index, load_sample_index
+from src.preprocessing import process_expression_compendium_sparse
+from src.preprocessing import scale_sparse_columns, sparse_expression_statistics, expression_statistics
+from sklearn.preprocessing import StandardScaler
 import pytest
+from scipy import sparse as sp
 
 @pytest.fixture
 def expression_dict():
@@ -242,3 +249,116 @@ def test_process_clinical_compendium(clinical_dict):
 
     # Check that the compendium column is present
     assert "compendium" in processed_compendium.columns
+
+def test_process_clinical_compendium_categorical(clinical_dict):
+    """
+    Test that process_clinical_compendium stores 'compendium' and 'disease' as categoricals with normalized disease
+    labels, and that the input dataframes are left untouched.
+    """
+    clinical_dict["compendium2"].loc["TCGA-ZP-A9D1-01", "disease"] = "  Hepatocellular Carcinoma "
+    original_columns = {name: list(df.columns) for name, df in clinical_dict.items()}
+
+    processed_compendium = process_clinical_compendium(clinical_dict)
+
+    assert isinstance(processed_compendium["compendium"].dtype, pd.CategoricalDtype)
+    assert isinstance(processed_compendium["disease"].dtype, pd.CategoricalDtype)
+    assert list(processed_compendium["compendium"].cat.categories) == ["compendium1", "compendium2"]
+    assert set(processed_compendium["disease"]) == {"hepatocellular carcinoma", "unknown"}
+    assert (processed_compendium.loc["TCGA-ZP-A9D2-01", "compendium"]) == "compendium2"
+    for name, df in clinical_dict.items():
+        assert list(df.columns) == original_columns[name]
+
+def test_build_sample_index_and_align_clinical(clinical_dict):
+    """
+    Test that aligning clinical data with the positional sample index gives the same result as an inner merge on
+    sample ids.
+    """
+    processed_compendium = process_clinical_compendium(clinical_dict)
+    samples = ["TCGA-ZP-A9D2-01", "missing_sample", "TCGA-ZP-A9CV-01", "TCGA-ZP-A9CZ-01"]
+    layout_df = pd.DataFrame({"x": [1.0, 2.0, 3.0, 4.0], "y": [4.0, 3.0, 2.0, 1.0]}, index=samples)
+
+    sample_index = build_sample_index(layout_df.index, processed_compendium.index)
+    assert sample_index.dtype == np.int32
+    assert list(sample_index) == [5, -1, 0, 2]
+
+    aligned = align_clinical(layout_df, processed_compendium, sample_index)
+    merged = layout_df.merge(processed_compendium, left_index=True, right_index=True, how="inner")
+    pd.testing.assert_frame_equal(aligned, merged.loc[aligned.index], check_dtype=False)
+    assert list(aligned.index) == ["TCGA-ZP-A9D2-01", "TCGA-ZP-A9CV-01", "TCGA-ZP-A9CZ-01"]
+
+def test_saved_sample_index_is_checked_against_the_ids(clinical_dict, tmp_path):
+    """
+    Test that a saved sample index is reused for the same ids and rebuilt when the clinical rows are reordered, which
+    leaves its length and range valid.
+    """
+    processed_compendium = process_clinical_compendium(clinical_dict)
+    samples = pd.Index(["TCGA-ZP-A9D2-01", "missing_sample", "TCGA-ZP-A9CV-01", "TCGA-ZP-A9CZ-01"])
+    file_path = tmp_path / "sample_index.npz"
+    assert list(load_sample_index(file_path, samples, processed_compendium.index)) == [5, -1, 0, 2]
+
+    save_sample_index(file_path, np.array([1, 2, 3, 4], dtype=np.int32), samples, processed_compendium.index)
+    assert list(load_sample_index(file_path, samples, processed_compendium.index)) == [1, 2, 3, 4]
+
+    reordered = processed_compendium.iloc[::-1]
+    sample_index = load_sample_index(file_path, samples, reordered.index)
+    assert list(sample_index) == list(build_sample_index(samples, reordered.index))
+    aligned = align_clinical(pd.DataFrame(index=samples), reordered, sample_index)
+    assert list(aligned["compendium"]) == list(processed_compendium.loc[aligned.index, "compendium"])
+
+def test_standardize_matrix():
+    """
+    Test that standardize_matrix matches StandardScaler, leaves the input alone when copying and scales writable
+    float32 input in place when not copying.
+    """
+    rng = np.random.default_rng(0)
+    matrix = rng.gamma(2.0, 2.0, (50, 12))
+    matrix[:, 3] = 1.5
+    original = matrix.copy()
+    expected = StandardScaler().fit_transform(matrix)
+
+    scaled = standardize_matrix(matrix, block_size=7)
+    assert scaled.dtype == np.float32
+    assert np.allclose(scaled, expected, atol=1e-5)
+    assert np.array_equal(matrix, original)
+
+    scaled = standardize_matrix(matrix, dtype=np.float64, block_size=7)
+    assert np.allclose(scaled, expected)
+    assert np.array_equal(matrix, original)
+
+    matrix32 = matrix.astype(np.float32)
+    scaled = standardize_matrix(matrix32, copy=False)
+    assert scaled is matrix32
+    assert np.allclose(matrix32, expected, atol=1e-5)
+
+@pytest.mark.parametrize("variance_threshold, minimum_expression", [(None, None), (20, None), (None, 3.0), (30, 2.5)])
+def test_sparse_process_expression_compendium(expression_dict_mismatched_genes, variance_threshold,
+                                              minimum_expression):
+    """
+    The sparse path should keep the same samples and genes with the same values as the dense path.
+    """
+    dense = process_expression_compendium(expression_dict_mismatched_genes, variance_threshold, minimum_expression)
+    matrix, sample_ids, gene_ids = process_expression_compendium_sparse(expression_dict_mismatched_genes,
+                                                                        variance_threshold, minimum_expression)
+
+    assert matrix.format == "csr"
+    assert list(sample_ids) == list(dense.index)
+    assert list(gene_ids) == list(dense.columns)
+    assert np.array_equal(matrix.toarray(), dense.to_numpy())
+
+def test_sparse_statistics_and_scaling():
+    """
+    Sparse statistics should match the dense statistics, and scaling should match StandardScaler(with_mean=False)
+    without adding stored values.
+    """
+    rng = np.random.default_rng(0)
+    values = rng.gamma(0.5, 2.0, (40, 25)) * (rng.random((40, 25)) < 0.3)
+    values[:, 3] = 0.0
+    matrix = sp.csr_matrix(values)
+    gene_ids = pd.Index([f"gene_{i}" for i in range(25)])
+
+    pd.testing.assert_frame_equal(sparse_expression_statistics(matrix, gene_ids),
+                                  expression_statistics(pd.DataFrame(values, columns=gene_ids)))
+
+    scaled = scale_sparse_columns(matrix)
+    assert sp.issparse(scaled) and scaled.nnz == matrix.nnz and scaled.dtype == np.float32
+    assert np.allclose(scaled.toarray(), StandardScaler(with_mean=False).fit_transform(values), atol=1e-6)
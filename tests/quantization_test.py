@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.quantization import quantize_matrix, dequantize_matrix, encode, decode, quantization_parameters
+from src.storage import read_expression_matrix, write_quantized_expression
+
+@pytest.mark.parametrize("per_gene", [False, True])
+def test_quantize_round_trip(per_gene):
+    """
+    Decoded values should be within half a quantization step of the original values, block size should not matter,
+    and constant genes should decode exactly.
+    """
+    rng = np.random.default_rng(0)
+    matrix = np.log2(rng.gamma(0.5, 50.0, (50, 30)) + 1)
+    matrix[:, 4] = 2.5
+
+    codes, offset, scale = quantize_matrix(matrix, per_gene=per_gene, block_size=7)
+    assert codes.dtype == np.uint16
+    assert offset.shape == scale.shape == ((30,) if per_gene else (1,))
+    assert np.array_equal(codes, quantize_matrix(matrix, per_gene=per_gene)[0])
+
+    decoded = dequantize_matrix(codes, offset, scale, dtype=np.float64, block_size=7)
+    assert np.all(np.abs(decoded - matrix) <= scale / 2 + 1e-12)
+    assert np.abs(decoded - matrix).max() < 1e-3
+    if per_gene:
+        assert np.array_equal(decoded[:, 4], matrix[:, 4])
+
+def test_encode_clips_and_decode_inverts():
+    offset, scale = quantization_parameters(0.0, 10.0)
+    codes = encode(np.array([-1.0, 0.0, 5.0, 10.0, 11.0]), offset, scale)
+    assert list(codes) == [0, 0, 32768, 65535, 65535]
+    assert np.allclose(decode(codes, offset, scale), [0.0, 0.0, 5.0, 10.0, 10.0], atol=1e-3)
+
+def test_quantize_rejects_missing_values():
+    with pytest.raises(ValueError):
+        quantize_matrix(np.array([[1.0, np.nan]]))
+
+def test_quantized_file_round_trip(tmp_path):
+    """
+    read_expression_matrix should decode a quantized file into the same layout as reading the TSV file, and the
+    quantized file should be much smaller.
+    """
+    rng = np.random.default_rng(1)
+    expression_df = pd.DataFrame(np.log2(rng.gamma(0.5, 50.0, (200, 40)) + 1),
+                                 index=pd.Index([f"gene_{i}" for i in range(200)], name="Gene"),
+                                 columns=[f"sample_{i}" for i in range(40)])
+    tsv_path = tmp_path / "compendium.tsv"
+    npz_path = tmp_path / "compendium.npz"
+    expression_df.to_csv(tsv_path, sep="\t")
+    write_quantized_expression(str(npz_path), expression_df.T.to_numpy(), expression_df.columns, expression_df.index)
+
+    tsv_matrix, tsv_samples, tsv_genes = read_expression_matrix(str(tsv_path))
+    npz_matrix, npz_samples, npz_genes = read_expression_matrix(str(npz_path))
+
+    assert npz_matrix.dtype == np.float32 and npz_matrix.flags["C_CONTIGUOUS"]
+    assert np.allclose(npz_matrix, tsv_matrix, atol=1e-3)
+    assert list(npz_samples) == list(tsv_samples)
+    assert list(npz_genes) == list(tsv_genes) and npz_genes.name == "Gene"
+    assert npz_path.stat().st_size * 4 < tsv_path.stat().st_size
@@ -0,0 +1,111 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+# Scripts import each other by module name, like when they are run from the scripts directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import download_data
+from config import ScriptConfig
+from run_batch import build_batch_pipeline
+from run_pipeline import add_workflow_arguments, estimate_expression_bytes
+
+def test_link_file(tmp_path, monkeypatch):
+    """
+    A file should be hard linked into a new directory, and symbolically linked when hard links fail, ie across
+    filesystems.
+    """
+    source = tmp_path / "shared" / "expression.tsv"
+    source.parent.mkdir()
+    source.write_text("gene\ts1\n")
+
+    download_data.link_file(str(source), str(tmp_path / "one" / "raw" / "expression.tsv"))
+    assert os.path.samefile(source, tmp_path / "one" / "raw" / "expression.tsv")
+    assert not os.path.islink(tmp_path / "one" / "raw" / "expression.tsv")
+
+    def fail_link(source_path, file_path):
+        raise OSError("Invalid cross-device link")
+    monkeypatch.setattr(os, "link", fail_link)
+    download_data.link_file(str(source), str(tmp_path / "two" / "expression.tsv"))
+    assert os.path.islink(tmp_path / "two" / "expression.tsv")
+    assert (tmp_path / "two" / "expression.tsv").read_text() == "gene\ts1\n"
+
+def test_download_shared_files(tmp_path, monkeypatch):
+    """
+    Every URL should be downloaded once, other paths of a URL linked to its file, and a file already at one of its paths
+    reused without downloading.
+    """
+    downloads = []
+
+    def fake_download(url, file_path):
+        downloads.append(url)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as file:
+            file.write(url)
+    monkeypatch.setattr(download_data, "download_file", fake_download)
+
+    existing = tmp_path / "b" / "raw" / "old.tsv"
+    existing.parent.mkdir(parents=True)
+    existing.write_text("already here")
+    file_dict = {
+        str(tmp_path / "a" / "raw" / "new.tsv"): "https://example.org/new.tsv",
+        str(tmp_path / "b" / "raw" / "new.tsv"): "https://example.org/new.tsv",
+        str(tmp_path / "a" / "raw" / "old.tsv"): "https://example.org/old.tsv",
+        str(existing): "https://example.org/old.tsv",
+        str(tmp_path / "a" / "raw" / "missing.tsv"): "https://example.org/missing.tsv",
+    }
+
+    download_data.download_shared_files(file_dict, download=False)
+    assert downloads == []
+    assert os.path.samefile(tmp_path / "a" / "raw" / "old.tsv", existing)
+    assert not (tmp_path / "a" / "raw" / "new.tsv").exists()
+
+    download_data.download_shared_files(file_dict)
+    assert sorted(downloads) == ["https://example.org/missing.tsv", "https://example.org/new.tsv"]
+    assert os.path.samefile(tmp_path / "a" / "raw" / "new.tsv", tmp_path / "b" / "raw" / "new.tsv")
+    assert (tmp_path / "a" / "raw" / "old.tsv").read_text() == "already here"
+
+    download_data.download_shared_files(file_dict)
+    assert len(downloads) == 2
+
+def test_estimate_expression_bytes(tmp_path):
+    """
+    The estimate from the first lines should be close to the size of the parsed float64 values, and 0 for a missing or
+    empty file.
+    """
+    rng = np.random.default_rng(0)
+    n_genes, n_samples = 3000, 40
+    expression_df = pd.DataFrame(rng.gamma(2.0, 2.0, (n_genes, n_samples)),
+                                 index=pd.Index([f"gene_{i}" for i in range(n_genes)], name="Gene"),
+                                 columns=[f"sample_{i}" for i in range(n_samples)])
+    file_path = tmp_path / "expression.tsv"
+    expression_df.to_csv(file_path, sep="\t")
+
+    estimate = estimate_expression_bytes(str(file_path), sample_lines=200)
+    assert abs(estimate - n_genes * n_samples * 8) < 0.05 * n_genes * n_samples * 8
+    assert estimate_expression_bytes(str(tmp_path / "missing.tsv")) == 0
+    (tmp_path / "header.tsv").write_text("Gene\tsample_0\n")
+    assert estimate_expression_bytes(str(tmp_path / "header.tsv")) == 0
+
+def test_shared_parse_stages_are_keyed_on_the_url(tmp_path):
+    """
+    Configurations should share the parse stage of the same URL, but not of different URLs ending in the same file
+    name.
+    """
+    def make_config(name, url):
+        return type(name, (ScriptConfig,), {"project_root": str(tmp_path), "data_dir": name,
+                                            "results_dir": os.path.join("results", name),
+                                            "expression_targets": {"expression.tsv": url}})
+
+    configs = {
+        "one": make_config("one", "https://example.org/v1/expression.tsv"),
+        "two": make_config("two", "https://example.org/v1/expression.tsv"),
+        "three": make_config("three", "https://example.org/v2/expression.tsv"),
+    }
+    parser = argparse.ArgumentParser()
+    add_workflow_arguments(parser)
+    pipeline = build_batch_pipeline(configs, parser.parse_args([]))
+
+    parse_stages = sorted(name for name in pipeline.stages if name.startswith("parse:"))
+    assert parse_stages == ["parse:https://example.org/v1/expression.tsv", "parse:https://example.org/v2/expression.tsv"]
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+from src.similarity import SimilarityIndex
+
+def make_compendium(n_samples=400, n_genes=60, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(4, n_genes)) * 3
+    matrix = (centers[rng.integers(0, 4, n_samples)] + rng.normal(size=(n_samples, n_genes))).astype(np.float32)
+    sample_ids = pd.Index([f"sample_{i}" for i in range(n_samples)])
+    gene_ids = pd.Index([f"gene_{i}" for i in range(n_genes)])
+    return matrix, sample_ids, gene_ids
+
+def test_query_matches_brute_force_correlation():
+    """
+    Neighbors should be the samples with the highest correlation of standardized expression, with their clinical
+    annotations, and a compendium sample should find itself first.
+    """
+    matrix, sample_ids, gene_ids = make_compendium()
+    original = matrix.copy()
+    clinical_df = pd.DataFrame({"disease": [f"disease_{i % 3}" for i in range(len(sample_ids))]}, index=sample_ids)
+    index = SimilarityIndex.build(matrix, sample_ids, gene_ids, clinical_df=clinical_df)
+    assert np.array_equal(matrix, original)
+
+    patients = pd.DataFrame(original[[3, 7]].T, index=gene_ids, columns=["patient_a", "patient_b"])
+    neighbors_df = index.query(patients, k=5)
+
+    assert list(neighbors_df.columns) == ["query", "rank", "sample_id", "correlation", "disease"]
+    assert list(neighbors_df.loc[neighbors_df["rank"] == 1, "sample_id"]) == ["sample_3", "sample_7"]
+    assert np.allclose(neighbors_df.loc[neighbors_df["rank"] == 1, "correlation"], 1, atol=1e-4)
+    assert (neighbors_df["disease"] == clinical_df.loc[neighbors_df["sample_id"], "disease"].to_numpy()).all()
+
+    scaled = (original - original.mean(axis=0)) / original.std(axis=0)
+    exact = np.corrcoef(scaled)[[3, 7]]
+    for query, row in zip(["patient_a", "patient_b"], exact):
+        found = neighbors_df[neighbors_df["query"] == query]
+        expected = sample_ids[np.argsort(-row)[:5]]
+        assert set(found["sample_id"]) == set(expected)
+        assert np.allclose(found["correlation"], np.sort(row)[::-1][:5], atol=1e-4)
+
+def test_missing_genes_and_persistence(tmp_path):
+    """
+    Missing query genes should be ignored, extra genes dropped, and a saved index should return the same neighbors.
+    """
+    matrix, sample_ids, gene_ids = make_compendium(seed=1)
+    index = SimilarityIndex.build(matrix, sample_ids, gene_ids)
+
+    patient = pd.Series(matrix[10], index=gene_ids, name="patient")
+    partial = pd.concat([patient.iloc[:50], pd.Series([1.0], index=["not_a_gene"])]).rename("patient")
+    assert index.query(partial, k=1)["sample_id"].iloc[0] == "sample_10"
+
+    index.save(tmp_path / "index")
+    loaded = SimilarityIndex.load(tmp_path / "index")
+    pd.testing.assert_frame_equal(loaded.query(patient, k=5), index.query(patient, k=5))
+
+def test_missing_genes_only_scale_the_correlation():
+    """
+    Missing genes should add nothing to the covariance or the query norm. The reported correlation is then the
+    correlation over the present genes, scaled by the norm of each sample over those genes, and undefined queries raise.
+    """
+    matrix, sample_ids, gene_ids = make_compendium(seed=2)
+    original = matrix.copy()
+    index = SimilarityIndex.build(matrix, sample_ids, gene_ids)
+    rng = np.random.default_rng(0)
+    patient = pd.Series(original[5] + rng.normal(size=len(gene_ids)), index=gene_ids, name="patient")
+    present = np.arange(40)
+    partial = patient.copy()
+    partial.iloc[45] = np.nan
+    neighbors_df = index.query(partial.iloc[np.r_[present, 45]], k=10)
+
+    scaled = (original - original.mean(axis=0)) / original.std(axis=0)
+    query = (patient.to_numpy() - original.mean(axis=0)) / original.std(axis=0)
+    for sample_id, correlation in zip(neighbors_df["sample_id"], neighbors_df["correlation"]):
+        row = scaled[sample_ids.get_loc(sample_id)]
+        present_correlation = np.corrcoef(row[present], query[present])[0, 1]
+        centered = row - row.mean()
+        present_centered = row[present] - row[present].mean()
+        share = np.square(present_centered).sum() / np.square(centered).sum()
+        assert np.isclose(correlation, present_correlation * np.sqrt(share), atol=1e-4)
+
+    with pytest.raises(ValueError, match="no indexed gene"):
+        index.query(pd.Series([1.0, np.nan], index=["not_a_gene", "gene_0"], name="empty"))
+    with pytest.raises(ValueError, match="constant"):
+        index.query(pd.Series(original.mean(axis=0), index=gene_ids, name="flat"))
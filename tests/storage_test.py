@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+import pytest
+from src.storage import write_sparse_expression_tsv, read_expression_matrix, write_sparse_expression
+from src.storage import read_expression_frame, read_expression_tsv, iter_expression_tsv, read_tsv
+
+def test_write_sparse_expression_tsv(tmp_path):
+    """
+    Writing a sparse matrix in gene blocks should give the same file as writing the dense dataframe transposed.
+    """
+    rng = np.random.default_rng(0)
+    values = rng.gamma(0.5, 2.0, (12, 30)) * (rng.random((12, 30)) < 0.3)
+    expression_df = pd.DataFrame(values, index=[f"sample_{i}" for i in range(12)],
+                                 columns=pd.Index([f"gene_{i}" for i in range(30)], name="Gene"))
+    dense_path = tmp_path / "dense.tsv"
+    sparse_path = tmp_path / "sparse.tsv"
+
+    expression_df.T.to_csv(dense_path, sep="\t")
+    write_sparse_expression_tsv(sparse_path, sp.csr_matrix(values), expression_df.index, expression_df.columns,
+                                block_genes=7)
+
+    assert sparse_path.read_text() == dense_path.read_text()
+    matrix, sample_ids, gene_ids = read_expression_matrix(sparse_path)
+    assert np.allclose(matrix, values)
+
+def test_sparse_expression_round_trip(tmp_path):
+    """
+    A sparse compendium should read back as the same CSR matrix and ids, densified unless asked for sparse, and stay
+    readable by scipy.sparse.load_npz.
+    """
+    rng = np.random.default_rng(0)
+    values = rng.gamma(0.5, 2.0, (12, 30)) * (rng.random((12, 30)) < 0.3)
+    sample_ids = pd.Index([f"sample_{i}" for i in range(12)])
+    gene_ids = pd.Index([f"gene_{i}" for i in range(30)], name="Gene")
+    path = tmp_path / "processed_compendium.sparse.npz"
+    write_sparse_expression(path, sp.csr_matrix(values), sample_ids, gene_ids)
+
+    matrix, read_samples, read_genes = read_expression_matrix(path, sparse=True)
+    assert sp.issparse(matrix) and matrix.format == "csr" and matrix.dtype == np.float32
+    assert matrix.nnz == np.count_nonzero(values)
+    assert np.allclose(matrix.toarray(), values)
+    assert read_samples.equals(sample_ids) and read_genes.equals(gene_ids) and read_genes.name == "Gene"
+
+    dense, _, _ = read_expression_matrix(path)
+    assert isinstance(dense, np.ndarray) and np.allclose(dense, values)
+    assert np.array_equal(sp.load_npz(path).toarray(), values)
+
+@pytest.fixture
+def expression_tsv(tmp_path):
+    """
+    Write a (gene, sample) expression file with a missing value. Returns its path and the
+    file parsed with correctly rounded floats, in (sample, gene) format.
+    """
+    rng = np.random.default_rng(1)
+    expression_df = pd.DataFrame(rng.gamma(2.0, 2.0, (25, 6)), index=pd.Index([f"gene_{i}" for i in range(25)],
+                                 name="Gene"), columns=[f"s{i}" for i in range(6)])
+    expression_df.iloc[2, 3] = np.nan
+    path = tmp_path / "one_expression.tsv"
+    expression_df.to_csv(path, sep="\t")
+    expected = expression_df.copy()
+    expected.iloc[:, :] = pd.read_csv(path, sep="\t", index_col=0, float_precision="round_trip").to_numpy()
+    return path, expected.T
+
+def test_parsers_agree(expression_tsv):
+    """
+    Both parsers should give the same (sample, gene) data, index names and contiguous arrays. The pyarrow parser rounds
+    values exactly, which the C parser may miss by one unit in the last place.
+    """
+    path, expected = expression_tsv
+    for parser in ("c", "pyarrow"):
+        frame = read_expression_frame(path, parser=parser)
+        assert frame.index.equals(expected.index)
+        assert frame.columns.equals(expected.columns) and frame.columns.name == "Gene"
+        assert np.allclose(frame.to_numpy(), expected.to_numpy(), rtol=1e-15, atol=0, equal_nan=True)
+
+        matrix, sample_ids, gene_ids = read_expression_tsv(path, parser=parser)
+        assert matrix.dtype == np.float32 and matrix.flags["C_CONTIGUOUS"]
+        assert np.allclose(matrix, expected.to_numpy(dtype=np.float32), equal_nan=True)
+        assert gene_ids.equals(expected.columns) and gene_ids.name == "Gene"
+
+def test_iter_expression_tsv(expression_tsv):
+    """
+    Chunks of both parsers should concatenate to the whole file.
+    """
+    path, expected = expression_tsv
+    for parser in ("c", "pyarrow"):
+        chunks = list(iter_expression_tsv(path, 4, parser=parser))
+        assert np.allclose(pd.concat(chunks, axis=1).to_numpy(), expected.to_numpy(), rtol=1e-15, atol=0,
+                           equal_nan=True)
+
+def test_read_tsv(tmp_path):
+    path = tmp_path / "clinical.tsv"
+    pd.DataFrame({"disease": ["a", "b", "a"], "age": [1, 2, 3]}, index=pd.Index(["x", "y", "z"], name="id")).to_csv(
+        path, sep="\t")
+    c_df = read_tsv(path, parser="c", index_col=0, usecols=["id", "disease"], dtype={"disease": "category"})
+    arrow_df = read_tsv(path, parser="pyarrow", index_col=0, usecols=["id", "disease"], dtype={"disease": "category"})
+    assert c_df.equals(arrow_df)
+    assert list(arrow_df.columns) == ["disease"] and isinstance(arrow_df["disease"].dtype, pd.CategoricalDtype)
+    with pytest.raises(ValueError):
+        read_tsv(path, parser="python")
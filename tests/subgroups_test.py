@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from src.subgroups import split_subgroups, subgroup_dir_name, subgroup_dir_names
+
+def test_split_subgroups():
+    """
+    Test that split_subgroups maps labels to sample positions, skips small and missing subgroups, and honours the
+    requested groups.
+    """
+    labels = pd.Series(["b", "a", "b", None, "a", "b", "c"], dtype="category")
+
+    subgroups = split_subgroups(labels, min_samples=2)
+    assert list(subgroups) == ["a", "b"]
+    assert list(subgroups["a"]) == [1, 4]
+    assert list(subgroups["b"]) == [0, 2, 5]
+
+    subgroups = split_subgroups(labels, min_samples=1, groups=["c"])
+    assert list(subgroups) == ["c"]
+    assert np.array_equal(subgroups["c"], [6])
+
+def test_subgroup_dir_name():
+    assert subgroup_dir_name("Acute Myeloid Leukemia") == "acute_myeloid_leukemia"
+    assert subgroup_dir_name("PDX_polyA_clinical") == "pdx_polya_clinical"
+    assert subgroup_dir_name("///") == "unnamed"
+
+def test_subgroup_dir_names_do_not_collide():
+    """
+    Labels mapping to the same directory name should get distinct names that are stable across calls, and other labels
+    should keep their plain name.
+    """
+    names = subgroup_dir_names(["B-cell ALL", "B cell ALL", "Acute Myeloid Leukemia"])
+    assert names["Acute Myeloid Leukemia"] == "acute_myeloid_leukemia"
+    assert len(set(names.values())) == 3
+    assert all(names[group].startswith("b_cell_all_") for group in ("B-cell ALL", "B cell ALL"))
+    reordered = subgroup_dir_names(["B cell ALL", "B-cell ALL"])
+    assert reordered["B cell ALL"] == names["B cell ALL"] and reordered["B-cell ALL"] == names["B-cell ALL"]